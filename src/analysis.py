@@ -1,92 +1,282 @@
+import time
+
+# the imports are reported by --timing-startup
+IMPORT_START = time.perf_counter()
 import numpy as np
 import pandas as pd
 import argparse
 import os
+import zlib
+import multiprocessing
 import cv2
-import seaborn as sns
-from scipy import stats
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
+import catalog
+import crops
+import filtering
+import instrument
+import masks
 
-def get_layer_boundary(image):
-    img_gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
+
+
+def save_csv(df, save_path, csv_name):
+    """Write a table to save_path; nothing is written when save_path is None."""
+    if save_path is not None:
+        df.to_csv(os.path.join(save_path, csv_name), index=False)
+
+
+def read_master_data(image_path):
+    master_data_csv = [
+        file
+        for file in os.listdir(image_path)
+        if (file.endswith(".csv") and not file.startswith("."))
+    ]
+    return pd.read_csv(os.path.join(image_path, master_data_csv[0]))
+
+
+def get_layer_strips(img_gray):
     region1 = img_gray[:, -200:-100]  # Last 200 to last 100 columns
     region2 = img_gray[:, 100:200]  # Columns 100 to 200
 
     # Concatenate them side by side
-    img_crop = np.hstack((region1, region2))
-
-    gradient_y = cv2.Sobel(img_crop, cv2.CV_64F, 0, 1, ksize=5)
-    gradient_avgy = np.mean(gradient_y, axis=1)
+    return np.hstack((region1, region2))
+
+
+def get_layer_boundaries(strips):
+    """
+    Layer boundary of a batch of frames of the same size.
+    # Arguments
+        strips: (N, H, 200) grayscale column strips of the frames, see get_layer_strips
+
+    # Returns
+        The row of the strongest vertical gradient of every frame.
+    """
+    n_frames, height, width = strips.shape
+    # one Sobel over the frames stacked vertically; the rows mixed at the seams
+    # between frames are outside the filtered window
+    gradient_y = cv2.Sobel(
+        strips.reshape(n_frames * height, width), cv2.CV_16S, 0, 1, ksize=5
+    )
+    # the gradients are integers, so the row sums rank the rows as the mean does
+    gradient_sumy = gradient_y.reshape(n_frames, height, width).sum(
+        axis=2, dtype=np.int64
+    )
 
     top = 0  # the index from cropped location instead of original image
     start_filter_ind = 350
     ind = (
-        np.argmax(gradient_avgy[start_filter_ind:-550]) + top + start_filter_ind
+        np.argmax(gradient_sumy[:, start_filter_ind:-550], axis=1)
+        + top
+        + start_filter_ind
     )  # filter out the first 350 rows and last 550 rows
     return ind
 
 
-def get_layer_boundary_fodler(image_folder, save_path):
-    images = [
-        os.path.relpath(os.path.join(root, file), image_folder)
-        for root, _, files in os.walk(image_folder)
-        for file in files
-        if (file.endswith(".PNG") or file.endswith(".png")) and not file.startswith(".")
-    ]
+def get_layer_boundary(image):
+    # the grayscale of IMREAD_GRAYSCALE, so colour crops get the boundary of
+    # the crops analysis.py decodes in grayscale
+    img_gray = crops.to_gray(image)
+    return get_layer_boundaries(get_layer_strips(img_gray)[np.newaxis])[0]
 
-    ind_df = pd.DataFrame()
-    for img in images:
 
-        image_name = os.path.join(image_folder, img)
-        plant = os.path.dirname(image_name)
-        frame = os.path.splitext(os.path.basename(image_name))[0]
+def has_layer(image_name):
+    """Frames of concentration 0 have no layer to detect."""
+    return not (image_name.startswith("T0R") or image_name.startswith("T0.0R"))
 
-        if img.startswith("T0R") or img.startswith("T0.0R"):
-            ind = np.nan
-        else:
-            image = cv2.imread(image_name)
-            ind = get_layer_boundary(image)
 
-        ind_df = pd.concat(
-            [
-                ind_df,
-                pd.DataFrame(
-                    {
-                        "image_name": [img],
-                        "plant": [plant],
-                        "frame": [frame],
-                        "layer_ind": [ind],
-                    }
-                ),
-            ],
-            ignore_index=True,
-        )
+def get_layer_index_row(image_folder, img, ind):
+    image_name = os.path.join(image_folder, img)
+    plant = os.path.dirname(image_name)
+    frame = os.path.splitext(os.path.basename(image_name))[0]
+    return {"image_name": img, "plant": plant, "frame": frame, "layer_ind": ind}
 
-    # replace the concentration of 0 frames with median value
+
+def add_plant_boundary(ind_df):
+    """Add the per-plant boundary, the median of the layer index over the frames of a plant."""
+    ind_df["plant_layer_ind"] = ind_df.groupby("plant")["layer_ind"].transform("median")
+    return ind_df
+
+
+def get_layer_index_table(rows, save_path, plant_boundary=False):
+    ind_df = pd.DataFrame(rows, columns=["image_name", "plant", "frame", "layer_ind"])
+
+    # replace the concentration of 0 frames with the median value of the
+    # experiment; every frame of their plant is without a layer, see has_layer
     ind_df["layer_ind"] = ind_df["layer_ind"].fillna(ind_df["layer_ind"].median())
+    if plant_boundary:
+        ind_df = add_plant_boundary(ind_df)
 
-    csv_name = os.path.join(save_path, "layer_index.csv")
-    ind_df.to_csv(csv_name, index=False)
+    save_csv(ind_df, save_path, "layer_index.csv")
+    return ind_df
+
+
+def get_shard_layer_index(rows, save_path, plant_boundary=False):
+    """
+    Layer index of the frames of a shard. The detected boundaries are saved as
+    they are, for merge_shards to fill in like get_layer_index_table; the frames
+    without a layer are left empty, the median of the experiment needs every shard.
+    """
+    ind_df = pd.DataFrame(rows, columns=["image_name", "plant", "frame", "layer_ind"])
+    save_csv(ind_df, save_path, "layer_index.csv")
+    if plant_boundary:
+        ind_df = add_plant_boundary(ind_df)
     return ind_df
 
 
+def read_layer_index(save_path):
+    """Read the layer index saved by segment.py --stream."""
+    csv_name = os.path.join(save_path, "layer_index.csv")
+    return pd.read_csv(
+        csv_name, dtype={"image_name": str, "plant": str, "frame": str}
+    )
+
+
+def read_layer_strips(crop_reader, img):
+    # decode in grayscale and keep only the columns the boundary is detected on
+    return get_layer_strips(crop_reader.read_gray(img))
+
+
+def parse_shard(shard):
+    """Parse "i/N", the i-th of N shards, counted from 1."""
+    try:
+        index, count = (int(v) for v in shard.split("/"))
+    except ValueError:
+        raise ValueError(f"Invalid shard {shard}, expected i/N, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard {shard}, i must be between 1 and N")
+    return index, count
+
+
+def in_shard(image_name, shard):
+    """Whether the plant folder of an image (relative to the experiment) is in a shard."""
+    if shard is None:
+        return True
+    index, count = shard
+    # a checksum of the folder name, the same on every machine and Python run
+    plant = os.path.dirname(image_name).replace(os.sep, "/")
+    return zlib.crc32(plant.encode()) % count == index - 1
+
+
+def get_shard_folder(save_path, shard):
+    """Folder of the partial outputs of a shard, under the analysis folder."""
+    index, count = shard
+    return os.path.join(save_path, "shards", f"{index}of{count}")
+
+
+def list_images(image_folder):
+    """Images of a folder, sorted so that results do not depend on the file system."""
+    return sorted(
+        os.path.relpath(os.path.join(root, file), image_folder)
+        for root, _, files in os.walk(image_folder)
+        for file in files
+        if (file.endswith(".PNG") or file.endswith(".png")) and not file.startswith(".")
+    )
+
+
+def init_worker():
+    # the processes already share the cores
+    cv2.setNumThreads(1)
+
+
+def map_plants(function, plants, jobs=1, progress=None):
+    """
+    Apply a function to the data of every plant, in a pool of processes if jobs > 1.
+    progress is called with (plants done, total plants) after every plant.
+    # Returns
+        The results in the order of the plants.
+    """
+    results = []
+    if jobs > 1 and len(plants) > 1:
+        # spawned, not forked: batch.py analyses next to torch inference threads
+        with ProcessPoolExecutor(
+            max_workers=min(jobs, len(plants)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        ) as pool:
+            for result in pool.map(function, plants):
+                results.append(result)
+                if progress:
+                    progress(len(results), len(plants))
+        return results
+    for plant in plants:
+        results.append(function(plant))
+        if progress:
+            progress(len(results), len(plants))
+    return results
+
+
+def get_plant_layer_inds(image_folder, plant_images):
+    """Layer boundary of the frames of a plant that have a layer."""
+    # detect the boundaries of the frames together, by size in case the crops differ
+    strips = {}
+    crop_reader = crops.CropReader(image_folder)
+    for img in filter(has_layer, plant_images):
+        image_strips = read_layer_strips(crop_reader, img)
+        strips.setdefault(image_strips.shape, []).append((img, image_strips))
+
+    layer_inds = {}
+    for shape_strips in strips.values():
+        names, stack = zip(*shape_strips)
+        layer_inds.update(zip(names, get_layer_boundaries(np.stack(stack))))
+    return layer_inds
+
+
+def get_layer_boundary_fodler(
+    image_folder,
+    save_path,
+    plant_boundary=False,
+    jobs=1,
+    progress=None,
+    shard=None,
+    images=None,
+):
+    if images is None:
+        images = crops.list_frames(image_folder)
+    images = [img for img in images if in_shard(img, shard)]
+
+    plants = {}
+    for img in images:
+        plants.setdefault(os.path.dirname(img), []).append(img)
+
+    layer_inds = {}
+    for plant_layer_inds in map_plants(
+        partial(get_plant_layer_inds, image_folder),
+        list(plants.values()),
+        jobs,
+        progress,
+    ):
+        layer_inds.update(plant_layer_inds)
+
+    rows = [
+        get_layer_index_row(image_folder, img, layer_inds.get(img, np.nan))
+        for img in images
+    ]
+    if shard is not None:
+        return get_shard_layer_index(rows, save_path, plant_boundary)
+    return get_layer_index_table(rows, save_path, plant_boundary)
+
+
 def get_area(seg_image, index_median, threshold_area):
-    upper_layer = seg_image[170 : index_median - threshold_area, :, 0]
+    if seg_image.ndim == 3:
+        seg_image = seg_image[:, :, 0]
+    upper_layer = seg_image[170 : index_median - threshold_area, :]
     value, count = np.unique(upper_layer[:, :], return_counts=True)
     upper_area = count[1] if len(count) > 1 else 0
 
-    bottom_layer = seg_image[index_median + threshold_area : -5, :, 0]
+    bottom_layer = seg_image[index_median + threshold_area : -5, :]
     value, count = np.unique(bottom_layer[:, :], return_counts=True)
     bottom_area = count[1] if len(count) > 1 else 0
     return upper_area, bottom_area
 
 
 def get_count(seg_image, index_median, threshold_area, threshold_count):
+    if seg_image.ndim == 3:
+        seg_image = seg_image[:, :, 0]
     upper_layer = seg_image[
         index_median - threshold_area - threshold_count : index_median - threshold_area,
         :,
-        0,
     ]
     contours, stats = cv2.findContours(
         upper_layer, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
@@ -104,7 +294,6 @@ def get_count(seg_image, index_median, threshold_area, threshold_count):
     bottom_layer = seg_image[
         index_median + threshold_area : index_median + threshold_area + threshold_count,
         :,
-        0,
     ]
     contours, stats = cv2.findContours(
         bottom_layer, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
@@ -121,42 +310,166 @@ def get_count(seg_image, index_median, threshold_area, threshold_count):
     return upper_root_count, bottom_root_count
 
 
-def get_statistics_frames(df_filtered, save_path):
-    data = df_filtered
-    data = data[~data.isin([np.nan, np.inf, -np.inf]).any(axis=1)]
-
-    # filter out outliers > 2
-    z_score_threshold = 2
-    filtered_df_count = pd.DataFrame()
-    filtered_df_area = pd.DataFrame()
-    data_plant = data.groupby("plant")
-    for name, group in data_plant:
-        # Calculate the z-scores for 'root_count_ratio' and 'root_area_ratio' columns within each wave
-        group = group.dropna()  # drop nan values
-        # Identify all-zero rows for root_count_ratio and root_area_ratio
-        zero_count_mask = group["root_count_ratio"] == 0
-        zero_area_mask = group["root_area_ratio"] == 0
-
-        # Calculate z-scores (only if standard deviation is not zero)
-        if group["root_count_ratio"].std() == 0:
-            outlier_mask_count = pd.Series([False] * len(group), index=group.index)
-        else:
-            z_scores_count = np.abs(stats.zscore(group["root_count_ratio"]))
-            outlier_mask_count = z_scores_count <= z_score_threshold
+def get_band_bounds(starts, stops, height):
+    """
+    Rows [start, stop) selected by image[start:stop] for arrays of slice bounds.
+    # Arguments
+        starts, stops: slice bounds of every frame, negative bounds count from the end
+        height: number of rows of the frames
+
+    # Returns
+        The normalized start and stop rows, with stop >= start.
+    """
+    bounds = []
+    for bound in [starts, stops]:
+        bound = np.asarray(bound)
+        bound = np.where(bound < 0, bound + height, bound)
+        bounds.append(np.clip(bound, 0, height))
+    start, stop = bounds
+    return start, np.maximum(stop, start)
+
+
+def get_stack_area(row_counts, start, stop, width):
+    """Root pixels of every frame between its start and stop rows, as get_area counts them."""
+    frames = np.arange(len(row_counts))
+    area = row_counts[frames, stop] - row_counts[frames, start]
+    # np.unique finds a second value only when the layer has roots and background
+    size = (stop - start) * width
+    return np.where((area > 0) & (area < size), area, 0)
+
+
+def get_stack_count(stack, start, stop, band_height):
+    """
+    Roots crossing a band of rows of every frame, as get_count counts them.
+    The bands are laid out one below the other, separated by empty rows, and
+    labelled at once. Like the external contours of cv2.findContours, a root is
+    counted when it touches the background outside the band, not when it lies
+    in a hole of another root.
+    # Arguments
+        stack: (N, H, W) masks
+        start, stop: first and last (excluded) rows of the band of every frame
+        band_height: maximum number of rows of a band
+
+    # Returns
+        The number of roots in the band of every frame.
+    """
+    n_frames, height, width = stack.shape
+    rows = start[:, None] + np.arange(band_height)
+    bands = stack[np.arange(n_frames)[:, None], np.clip(rows, 0, height - 1)] != 0
+    bands &= (rows < stop[:, None])[:, :, None]
+
+    block_height = band_height + 1
+    canvas = np.zeros((n_frames, block_height, width + 2), dtype=np.uint8)
+    canvas[:, 1:, 1:-1] = bands
+    canvas = np.vstack(
+        [canvas.reshape(-1, width + 2), np.zeros((1, width + 2), dtype=np.uint8)]
+    )
 
-        if group["root_area_ratio"].std() == 0:
-            outlier_mask_area = pd.Series([False] * len(group), index=group.index)
-        else:
-            z_scores_area = np.abs(stats.zscore(group["root_area_ratio"]))
-            outlier_mask_area = z_scores_area <= z_score_threshold
+    # roots are 8-connected, the background between them 4-connected
+    n_labels, roots = cv2.connectedComponents(canvas, connectivity=8)
+    _, background = cv2.connectedComponents(1 - canvas, connectivity=4)
+    outside = background == background[0, 0]
+    touches_outside = np.zeros_like(outside)
+    touches_outside[1:] |= outside[:-1]
+    touches_outside[:-1] |= outside[1:]
+    touches_outside[:, 1:] |= outside[:, :-1]
+    touches_outside[:, :-1] |= outside[:, 1:]
+    external = np.unique(roots[(canvas > 0) & touches_outside])
+
+    # frame of each root from the row of one of its pixels
+    label_rows = np.zeros(n_labels, dtype=int)
+    label_rows[roots.ravel()] = np.repeat(np.arange(canvas.shape[0]), width + 2)
+    return np.bincount(label_rows[external] // block_height, minlength=n_frames)
+
+
+def get_stack_traits(stack, layer_inds, threshold_area=50, threshold_count=5):
+    """
+    Traits of all frames of a plant at once, identical to get_frame_traits on
+    each frame.
+    # Arguments
+        stack: (N, H, W) binary masks, or (N, H, W, 3) colour coded masks
+        layer_inds: layer boundary of every frame
+        threshold_area: rows around the boundary left out of the areas
+        threshold_count: height of the bands the roots are counted in
+
+    # Returns
+        A DataFrame with the areas, root counts and their ratios of every frame.
+    """
+    if stack.ndim == 4:
+        stack = stack[:, :, :, 0]
+    n_frames, height, width = stack.shape
+    layer_inds = np.asarray(layer_inds, dtype=int)
+
+    row_counts = np.zeros((n_frames, height + 1), dtype=np.int64)
+    np.cumsum(np.count_nonzero(stack, axis=2), axis=1, out=row_counts[:, 1:])
+    upper_area = get_stack_area(
+        row_counts,
+        *get_band_bounds(
+            np.full(n_frames, 170), layer_inds - threshold_area, height
+        ),
+        width,
+    )
+    bottom_area = get_stack_area(
+        row_counts,
+        *get_band_bounds(
+            layer_inds + threshold_area, np.full(n_frames, -5), height
+        ),
+        width,
+    )
 
-        # Combine the masks with the zero masks using logical OR
-        final_mask_count = outlier_mask_count | zero_count_mask
-        final_mask_area = outlier_mask_area | zero_area_mask
+    upper_root_count = get_stack_count(
+        stack,
+        *get_band_bounds(
+            layer_inds - threshold_area - threshold_count,
+            layer_inds - threshold_area,
+            height,
+        ),
+        threshold_count,
+    )
+    bottom_root_count = get_stack_count(
+        stack,
+        *get_band_bounds(
+            layer_inds + threshold_area,
+            layer_inds + threshold_area + threshold_count,
+            height,
+        ),
+        threshold_count,
+    )
 
-        # Append filtered data
-        filtered_df_count = pd.concat([filtered_df_count, group[final_mask_count]])
-        filtered_df_area = pd.concat([filtered_df_area, group[final_mask_area]])
+    traits = pd.DataFrame(
+        {
+            "upper_area": upper_area,
+            "bottom_area": bottom_area,
+            "upper_root_count": upper_root_count,
+            "bottom_root_count": bottom_root_count,
+        },
+        dtype=float,
+    )
+    with np.errstate(divide="ignore", invalid="ignore"):
+        traits["root_area_ratio"] = traits["bottom_area"] / traits["upper_area"]
+        traits["root_count_ratio"] = (
+            traits["bottom_root_count"] / traits["upper_root_count"]
+        )
+    return traits
+
+
+def get_statistics_frames(
+    df_filtered,
+    save_path,
+    z_score_threshold=2,
+    frames_used=None,
+):
+    data = filtering.drop_invalid_rows(df_filtered)
+
+    # filter out outliers > z_score_threshold within each plant, keeping the
+    # frames with a ratio of 0; plants whose frames are all equal only keep zeros
+    filtered_df_count, filtered_df_area = filtering.filter_outliers(
+        data,
+        "plant",
+        ["root_count_ratio", "root_area_ratio"],
+        z_score_threshold,
+        zero_std="drop",
+    )
     filtered_df_summary_count = (
         filtered_df_count.groupby("plant")[
             ["root_count_ratio", "upper_root_count", "bottom_root_count"]
@@ -196,17 +509,29 @@ def get_statistics_frames(df_filtered, save_path):
         on="plant_path",
         how="outer",
     )
+    if frames_used is not None:
+        # frames segmented by segment.py --sample-tolerance, before the filtering
+        filtered_df_summary["frame_number_used"] = filtered_df_summary[
+            "plant_path"
+        ].map(frames_used)
 
-    filtered_df_summary.to_csv(
-        os.path.join(save_path, "traits_filteredframes_summary.csv"), index=False
-    )
+    save_csv(filtered_df_summary, save_path, "traits_filteredframes_summary.csv")
 
     return filtered_df_count, filtered_df_area, filtered_df_summary
 
 
-def get_statistics_plants(save_path, master_data, plant_group):
-    data_path = os.path.join(save_path, "traits_filteredframes_summary.csv")
-    data = pd.read_csv(data_path)
+def get_statistics_plants(
+    save_path,
+    master_data,
+    plant_group,
+    z_score_threshold=2,
+    data=None,
+):
+    if data is None:
+        data_path = os.path.join(save_path, "traits_filteredframes_summary.csv")
+        data = pd.read_csv(data_path)
+    else:
+        data = data.copy()
 
     # get plant name based on plant_path
     data["plant_name"] = data["plant_path"].apply(lambda x: x.split("/")[-1])
@@ -220,35 +545,15 @@ def get_statistics_plants(save_path, master_data, plant_group):
     )
     data = data.drop(columns="barcode")
 
-    z_score_threshold = 2
-    filtered_df_count = pd.DataFrame()
-    filtered_df_area = pd.DataFrame()
-    data_plant = data.groupby(plant_group)
-    for name, group in data_plant:
-        # Calculate the z-scores for 'root_count_ratio' and 'root_area_ratio' columns within each wave
-        group = group.dropna()  # drop nan values
-        # Calculate z-scores safely, avoiding errors if standard deviation is zero
-        if group["root_count_ratio"].std() == 0:
-            z_scores_count = pd.Series([0] * len(group), index=group.index)
-        else:
-            z_scores_count = np.abs(stats.zscore(group["root_count_ratio"]))
-
-        if group["root_area_ratio"].std() == 0:
-            z_scores_area = pd.Series([0] * len(group), index=group.index)
-        else:
-            z_scores_area = np.abs(stats.zscore(group["root_area_ratio"]))
-
-        # Create masks: keep values within threshold OR values equal to 0
-        outlier_mask_count = (z_scores_count <= z_score_threshold) | (
-            group["root_count_ratio"] == 0
-        )
-        outlier_mask_area = (z_scores_area <= z_score_threshold) | (
-            group["root_area_ratio"] == 0
-        )
-
-        # Filter and append to result DataFrames
-        filtered_df_count = pd.concat([filtered_df_count, group[outlier_mask_count]])
-        filtered_df_area = pd.concat([filtered_df_area, group[outlier_mask_area]])
+    # filter out outliers > z_score_threshold within each group, keeping the
+    # plants with a ratio of 0; groups whose plants are all equal are kept
+    filtered_df_count, filtered_df_area = filtering.filter_outliers(
+        data,
+        plant_group,
+        ["root_count_ratio", "root_area_ratio"],
+        z_score_threshold,
+        zero_std="keep",
+    )
     filtered_df_summary_count = (
         filtered_df_count.dropna(subset=["root_count_ratio"])
         .groupby(plant_group)[
@@ -326,9 +631,7 @@ def get_statistics_plants(save_path, master_data, plant_group):
     filtered_df = filtered_df[column_order]
     # row ordered by treatment
     filtered_df = filtered_df.sort_values(by="trt", ascending=True)
-    filtered_df.to_csv(
-        os.path.join(save_path, "traits_filteredplants.csv"), index=False
-    )
+    save_csv(filtered_df, save_path, "traits_filteredplants.csv")
 
     # combine the area and count
     filtered_df_summary = pd.merge(
@@ -337,50 +640,231 @@ def get_statistics_plants(save_path, master_data, plant_group):
         on=plant_group,
         how="outer",
     )
-    filtered_df_summary.to_csv(
-        os.path.join(save_path, "traits_filteredplants_summary.csv"), index=False
-    )
+    save_csv(filtered_df_summary, save_path, "traits_filteredplants_summary.csv")
 
     return filtered_df_summary_count, filtered_df_summary_area, filtered_df_summary
 
 
-def get_traits(seg_folder, ind_df, save_path):
-    traits_df = ind_df
-    for i in range(len(ind_df)):
-        # get layer index and image path
-        image_path = os.path.join(seg_folder, ind_df["image_name"][i])
-        seg_image = cv2.imread(image_path)
-        index_frame = int(ind_df["layer_ind"][i])
-
-        # get areas
-        threshold_area = 50
-        upper_area, bottom_area = get_area(seg_image, index_frame, threshold_area)
-        # get counts
-        threshold_count = 5
-        upper_root_count, bottom_root_count = get_count(
-            seg_image, index_frame, threshold_area, threshold_count
+def get_frame_traits(seg_image, index_frame, threshold_area=50, threshold_count=5):
+    # get areas
+    upper_area, bottom_area = get_area(seg_image, index_frame, threshold_area)
+    # get counts
+    upper_root_count, bottom_root_count = get_count(
+        seg_image, index_frame, threshold_area, threshold_count
+    )
+    return {
+        "upper_area": upper_area,
+        "bottom_area": bottom_area,
+        "upper_root_count": upper_root_count,
+        "bottom_root_count": bottom_root_count,
+        "root_area_ratio": np.divide(bottom_area, upper_area),
+        "root_count_ratio": np.divide(bottom_root_count, upper_root_count),
+    }
+
+
+def get_plant_traits(seg_folder, plant_df, layer_column="layer_ind"):
+    """Traits of the frames of a plant, indexed like plant_df."""
+    # read colour coded, single channel or bit-packed masks
+    mask_reader = masks.MaskReader(seg_folder)
+    # stack the frames, by size in case the crops differ
+    frames = {}
+    for i, image_name in zip(plant_df.index, plant_df["image_name"]):
+        seg_image = mask_reader.read(image_name)
+        frames.setdefault(seg_image.shape, []).append((i, seg_image))
+    mask_reader.close()
+
+    traits = []
+    for shape_frames in frames.values():
+        index, stack = zip(*shape_frames)
+        stack_traits = get_stack_traits(
+            np.stack(stack), plant_df.loc[list(index), layer_column].astype(int)
         )
-        traits_df.at[i, "upper_area"] = upper_area
-        traits_df.at[i, "bottom_area"] = bottom_area
-        traits_df.at[i, "upper_root_count"] = upper_root_count
-        traits_df.at[i, "bottom_root_count"] = bottom_root_count
-        traits_df.at[i, "root_area_ratio"] = np.divide(bottom_area, upper_area)
-        traits_df.at[i, "root_count_ratio"] = np.divide(
-            bottom_root_count, upper_root_count
+        stack_traits.index = list(index)
+        traits.append(stack_traits)
+    return pd.concat(traits)
+
+
+class FrameTraits:
+    """Traits of masks measured as they are predicted, without saving them.
+
+    Frames without a layer are kept bit-packed until the boundaries of all
+    frames give the layer index to fill in, see get_layer_index_table.
+
+    Args:
+        threshold_area (int): rows around the boundary left out of the areas
+        threshold_count (int): height of the bands the roots are counted in
+    """
+
+    def __init__(self, threshold_area=50, threshold_count=5):
+        self.threshold_area = threshold_area
+        self.threshold_count = threshold_count
+        self.traits = {}
+        self.pending = {}
+
+    def __contains__(self, image_name):
+        return image_name in self.traits or image_name in self.pending
+
+    def add(self, image_name, seg_image, layer_ind):
+        """Measure a mask whose roots are nonzero, e.g. the predicted class keys."""
+        if seg_image.ndim == 3:
+            seg_image = seg_image[:, :, 0]
+        if np.isnan(layer_ind):
+            self.pending[image_name] = (
+                np.packbits(seg_image != 0, axis=1),
+                seg_image.shape,
+            )
+        else:
+            self.traits[image_name] = get_stack_traits(
+                seg_image[np.newaxis],
+                [int(layer_ind)],
+                self.threshold_area,
+                self.threshold_count,
+            ).iloc[0].to_dict()
+
+    def get_traits(self, ind_df, save_path=None):
+        """Traits of the frames of a layer index table, written to traits.csv."""
+        traits = dict(self.traits)
+        layer_inds = ind_df.set_index("image_name")["layer_ind"]
+        for image_name, (bits, shape) in self.pending.items():
+            if np.isnan(layer_inds[image_name]):
+                # a shard without the median of the experiment, see merge_shards
+                continue
+            seg_image = np.unpackbits(bits, axis=1, count=shape[1])
+            traits[image_name] = get_stack_traits(
+                seg_image[np.newaxis],
+                [int(layer_inds[image_name])],
+                self.threshold_area,
+                self.threshold_count,
+            ).iloc[0].to_dict()
+
+        traits_df = ind_df.join(
+            pd.DataFrame(
+                [traits.get(image_name, {}) for image_name in ind_df["image_name"]],
+                index=ind_df.index,
+            )
         )
-    save_name = os.path.join(save_path, "traits.csv")
-    traits_df.to_csv(save_name, index=False)
+        save_csv(traits_df, save_path, "traits.csv")
+        return traits_df
+
+
+def read_traits(save_path):
+    """Read the traits saved by segment.py --traits."""
+    csv_name = os.path.join(save_path, "traits.csv")
+    # read the ratios back exactly as they were measured
+    return pd.read_csv(
+        csv_name,
+        dtype={"image_name": str, "plant": str, "frame": str},
+        float_precision="round_trip",
+    )
+
+
+def save_sampling(sampling_df, save_path):
+    """Save the frames used per plant by segment.py --sample-tolerance; None removes them."""
+    csv_name = os.path.join(save_path, "sampling.csv") if save_path else None
+    if sampling_df is not None:
+        save_csv(sampling_df, save_path, "sampling.csv")
+    elif csv_name is not None and os.path.exists(csv_name):
+        # left by a sampled run, the traits now cover every frame
+        os.remove(csv_name)
+
+
+def read_sampling(save_path):
+    """Read the frames used per plant, None when the traits cover every frame."""
+    csv_name = os.path.join(save_path, "sampling.csv")
+    if not os.path.exists(csv_name):
+        return None
+    return pd.read_csv(csv_name, dtype={"plant": str})
+
+
+def get_traits(
+    seg_folder, ind_df, save_path, layer_column="layer_ind", jobs=1, progress=None
+):
+    # frames of a shard can be left without a layer index, see merge_shards
+    measured_df = ind_df.dropna(subset=[layer_column])
+    plants = [plant_df for _, plant_df in measured_df.groupby("plant", sort=False)]
+    traits = map_plants(
+        partial(get_plant_traits, seg_folder, layer_column=layer_column),
+        plants,
+        jobs,
+        progress,
+    )
+
+    traits_df = ind_df.join(pd.concat(traits)) if traits else ind_df.copy()
+    save_csv(traits_df, save_path, "traits.csv")
     return traits_df
 
 
+def merge_shards(seg_folder, save_path, count, plant_boundary=False, jobs=1):
+    """Combine the layer index and traits of N shards into the tables of the experiment.
+
+    The boundaries are filled in as in a single run, and the frames of plants
+    without a layer are measured at the median of the experiment from their
+    masks, so the tables are the same as without shards.
+
+    Args:
+        seg_folder (str): folder of the masks of the frames without a layer
+        save_path (str): analysis folder holding the shards folder
+        count (int): number of shards
+        plant_boundary (bool): measure the traits at the median boundary of each plant
+
+    Returns:
+        tuple: the layer index and traits DataFrames, saved to save_path
+    """
+    folders = [get_shard_folder(save_path, (i, count)) for i in range(1, count + 1)]
+    missing = [
+        folder
+        for folder in folders
+        if not all(
+            os.path.exists(os.path.join(folder, name))
+            for name in ["layer_index.csv", "traits.csv"]
+        )
+    ]
+    if missing:
+        raise ValueError(f"Shards without a layer index or traits: {missing}")
+
+    # order the frames as list_images does for a single run
+    raw_df = pd.concat([read_layer_index(folder) for folder in folders])
+    raw_df = raw_df.sort_values("image_name", kind="mergesort")
+    ind_df = get_layer_index_table(
+        raw_df.to_dict("records"), save_path, plant_boundary
+    )
+    layer_column = "plant_layer_ind" if plant_boundary else "layer_ind"
+
+    shard_traits = pd.concat([read_traits(folder) for folder in folders])
+    trait_columns = [c for c in shard_traits.columns if c not in ind_df.columns]
+    traits = shard_traits.set_index("image_name")[trait_columns]
+    traits = traits.reindex(ind_df["image_name"])
+    traits.index = ind_df.index
+
+    # measure the frames the shards could not, at the boundary of the experiment
+    unmeasured = traits.isna().all(axis=1)
+    if unmeasured.any():
+        measured_df = get_traits(
+            seg_folder, ind_df[unmeasured], None, layer_column, jobs
+        )
+        trait_columns = [c for c in measured_df.columns if c not in ind_df.columns]
+        traits = traits.reindex(columns=trait_columns)
+        traits.loc[unmeasured] = measured_df[trait_columns]
+
+    traits_df = ind_df.join(traits)
+    save_csv(traits_df, save_path, "traits.csv")
+    sampling = [read_sampling(folder) for folder in folders]
+    save_sampling(
+        pd.concat(sampling, ignore_index=True)
+        if all(sampling_df is not None for sampling_df in sampling)
+        else None,
+        save_path,
+    )
+    return ind_df, traits_df
+
+
 def remove_frame_outlier_0_upper(data, write_csv, output_dir):
     """Remove frames with 0 upper_root_count."""
     filter = data["upper_root_count"] == 0
     removed = data[filter]
     new_data = data[~filter]
     if write_csv:
-        csv_path = os.path.join(output_dir, "removed_0upper.csv")
-        removed.to_csv(csv_path, index=False)
+        save_csv(removed, output_dir, "removed_0upper.csv")
     return new_data
 
 
@@ -405,15 +889,162 @@ def remove_frame_outlier_0_bottom(data, threshold, output_dir):
     ]
 
     # save the filtered data
-    filtered_path = os.path.join(output_dir, "filtered_72frames_0upper_0bottom.csv")
-    df_filtered.to_csv(filtered_path, index=False)
+    save_csv(df_filtered, output_dir, "filtered_72frames_0upper_0bottom.csv")
 
     # save the removed data
-    removed_path = os.path.join(output_dir, "removed_0bottom.csv")
-    df_removed.to_csv(removed_path, index=False)
+    save_csv(df_removed, output_dir, "removed_0bottom.csv")
     return df_filtered, df_removed
 
 
+def run_analysis(
+    seg_folder,
+    master_data,
+    image_folder=None,
+    ind_df=None,
+    save_path=None,
+    plant_group="trt",
+    plant_boundary=False,
+    jobs=1,
+    z_score_threshold=2,
+    zero_bottom_threshold=0.5,
+    traits_df=None,
+    report=None,
+    progress=False,
+    shard=None,
+    image_names=None,
+    sampling_df=None,
+):
+    """Extract the traits of an experiment and filter them by frame and by plant.
+
+    Args:
+        seg_folder (str): folder of the masks, in any mask format
+        master_data (pd.DataFrame): master data of the experiment
+        image_folder (str): folder of the cropped images to detect the layers on
+        ind_df (pd.DataFrame): layer index of the frames, e.g. from segment.py
+            --stream, used instead of image_folder
+        save_path (str): folder to write the CSV files to, None to only return them
+        plant_group (str): master data column the plants are grouped by
+        plant_boundary (bool): measure the traits at the median boundary of each plant
+        jobs (int): number of processes analysing plants in parallel
+        z_score_threshold (float): z-score above which frames and plants are outliers
+        zero_bottom_threshold (float): plants with less than this fraction of
+            frames with 0 bottom_root_count lose these frames
+        traits_df (pd.DataFrame): traits of the frames, e.g. from segment.py
+            --traits, used instead of the masks and layer index
+        report (instrument.RunReport): report the stages are timed in, saved to
+            run_report_analysis.json in save_path
+        progress (bool): print the number of plants done and the time left
+        shard (tuple): (i, N), only extract the traits of the plants of the i-th
+            of N shards to the shards folder of save_path, see merge_shards
+        image_names (list): cropped frames, relative to image_folder, e.g. from
+            catalog.list_crops; listed from image_folder when None
+        sampling_df (pd.DataFrame): frames used per plant by segment.py
+            --sample-tolerance, added to the frame summary as frame_number_used
+
+    Returns:
+        dict: DataFrames of the layer index, the traits, the filtered frames and
+        the frame and plant summaries, and the run report ("report"); for a
+        shard only the layer index, the traits and the report
+    """
+    if shard is not None:
+        save_path = get_shard_folder(save_path, shard)
+    if save_path is not None and not os.path.exists(save_path):
+        os.makedirs(save_path)
+    if report is None:
+        report = instrument.RunReport(
+            "analysis",
+            {
+                "plant_group": plant_group,
+                "plant_boundary": plant_boundary,
+                "jobs": jobs,
+                "z_score_threshold": z_score_threshold,
+                "zero_bottom_threshold": zero_bottom_threshold,
+                "shard": shard,
+            },
+        )
+
+    def get_progress(stage):
+        return instrument.Progress(stage, unit="plants") if progress else None
+
+    if traits_df is None:
+        # get the layer index of each cropped image
+        if ind_df is None:
+            with report.stage("boundary") as counter:
+                ind_df = get_layer_boundary_fodler(
+                    image_folder,
+                    save_path,
+                    plant_boundary=plant_boundary,
+                    jobs=jobs,
+                    progress=get_progress("boundary"),
+                    shard=shard,
+                    images=image_names,
+                )
+                counter["items"] = len(ind_df)
+        else:
+            if plant_boundary:
+                ind_df = add_plant_boundary(ind_df.copy())
+
+        # get traits
+        layer_column = "plant_layer_ind" if plant_boundary else "layer_ind"
+        with report.stage("traits", len(ind_df)):
+            traits_df = get_traits(
+                seg_folder,
+                ind_df,
+                save_path,
+                layer_column,
+                jobs,
+                progress=get_progress("traits"),
+            )
+    elif ind_df is None:
+        ind_df = traits_df[["image_name", "plant", "frame", "layer_ind"]]
+
+    if shard is not None:
+        # the filtering and statistics need every plant, they run after the merge
+        report.save(os.path.join(save_path, "run_report_analysis.json"))
+        return {"layer_index": ind_df, "traits": traits_df, "report": report.to_dict()}
+
+    with report.stage("stats", len(traits_df)):
+        # delete frames with 0 in upper layer
+        write_csv = save_path is not None  # save the filtered data
+        remove_0 = remove_frame_outlier_0_upper(traits_df, write_csv, save_path)
+
+        # remove outliers for less than a threshold with 0 bottom_root_count.
+        # the default threshold is 50% (0.5)
+        df_filtered, df_removed = remove_frame_outlier_0_bottom(
+            remove_0, zero_bottom_threshold, save_path
+        )
+
+        # remove frame outliers based on frames of each plant
+        filtered_df_count, filtered_df_area, frames_summary = get_statistics_frames(
+            df_filtered,
+            save_path,
+            z_score_threshold,
+            frames_used=None
+            if sampling_df is None
+            else sampling_df.set_index("plant")["frame_number_used"],
+        )
+
+        # remove plant outliers based on concentration or genotype
+        (
+            plants_summary_count,
+            plants_summary_area,
+            plants_summary,
+        ) = get_statistics_plants(
+            save_path, master_data, plant_group, z_score_threshold, data=frames_summary
+        )
+
+    if save_path is not None:
+        report.save(os.path.join(save_path, "run_report_analysis.json"))
+    return {
+        "layer_index": ind_df,
+        "traits": traits_df,
+        "filtered_frames": df_filtered,
+        "frames_summary": frames_summary,
+        "plants_summary": plants_summary,
+        "report": report.to_dict(),
+    }
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Traits extraction and analysis Pipeline"
@@ -421,9 +1052,60 @@ def main():
     parser.add_argument(
         "--experiment", required=True, help="Experimental design folder path"
     )
+    parser.add_argument(
+        "--plant-boundary",
+        action="store_true",
+        help="Measure the traits at the median layer boundary of each plant instead of the boundary of each frame",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes analysing plants in parallel",
+    )
+    parser.add_argument(
+        "--from-traits",
+        action="store_true",
+        help="Start from the traits.csv saved by segment.py --traits instead of the masks",
+    )
+    parser.add_argument(
+        "--z-score-threshold",
+        type=float,
+        default=2,
+        help="Frames and plants with a ratio further than this many standard deviations from their group mean are outliers",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show the number of plants analysed, the throughput and the time left",
+    )
+    shards = parser.add_mutually_exclusive_group()
+    shards.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="i/N",
+        help="Only extract the traits of the plants of the i-th of N shards, to analysis/shards",
+    )
+    shards.add_argument(
+        "--merge",
+        type=int,
+        metavar="N",
+        help="Merge the traits of N shards and filter them as a single run would",
+    )
+    parser.add_argument(
+        "--timing-startup",
+        action="store_true",
+        help="Only time the start of the script and print it",
+    )
 
     args = parser.parse_args()
 
+    if args.timing_startup:
+        report = instrument.RunReport("startup", vars(args))
+        instrument.add_startup(report, IMPORT_START, IMPORT_SECONDS)
+        report.print_summary()
+        return
+
     experiment = args.experiment
 
     image_folder = os.path.join("./Segmentation", experiment, "crop")
@@ -431,44 +1113,58 @@ def main():
     save_path = os.path.join("./Segmentation", experiment, "analysis")
 
     image_path = os.path.join("./images", experiment)
-    master_data_csv = [
-        file
-        for file in os.listdir(image_path)
-        if (file.endswith(".csv") and not file.startswith("."))
-    ]
-    master_data = pd.read_csv(os.path.join(image_path, master_data_csv[0]))
-    plant_group = "trt"
-
-    if not os.path.exists(save_path):
-        os.makedirs(save_path)
-
-    # get the layer index of each cropped image
-    ind_df = get_layer_boundary_fodler(image_folder, save_path)
-
-    # get traits
-    traits_df = get_traits(seg_folder, ind_df, save_path)
-
-    # delete frames with 0 in upper layer
-    write_csv = True  # save the filtered data
-    remove_0 = remove_frame_outlier_0_upper(traits_df, write_csv, save_path)
-
-    # remove outliers for less than a threshold with 0 bottom_root_count.
-    # the default threshold is 50% (0.5)
+    master_data = read_master_data(image_path)
+
+    traits_df = None
+    ind_df = None
+    sampling_df = None
+    if args.merge:
+        ind_df, traits_df = merge_shards(
+            seg_folder, save_path, args.merge, args.plant_boundary, args.jobs
+        )
+        sampling_df = read_sampling(save_path)
+    elif args.from_traits:
+        if args.shard:
+            print("The traits of the shard were saved by segment.py, merge them")
+            return
+        traits_df = read_traits(save_path)
+        sampling_df = read_sampling(save_path)
+    else:
+        layer_folder = get_shard_folder(save_path, args.shard) if args.shard else save_path
+        sampled_df = read_sampling(layer_folder)
+        if sampled_df is not None:
+            # segment.py --sample-tolerance only segmented the frames of its layer
+            # index, the other crops have no mask
+            print("Analysing the frames segmented by segment.py --sample-tolerance")
+        if sampled_df is not None or not os.path.exists(image_folder):
+            # segment.py --stream detected the layers without writing crops
+            ind_df = read_layer_index(layer_folder)
+            if not args.shard:
+                sampling_df = sampled_df
+
+    # the threshold of 0 bottom_root_count frames is 50% (0.5)
     # CHANGE the threshold if needed
-    threshold = 0.5
-    df_filtered, df_removed = remove_frame_outlier_0_bottom(
-        remove_0, threshold, save_path
-    )
-
-    # remove frame outliers based on frames of each plant
-    filtered_df_count, filtered_df_area, filtered_df_summary = get_statistics_frames(
-        df_filtered, save_path
-    )
-
-    # remove plant outliers based on concentration or genotype
-    filtered_df_summary_count, filtered_df_summary_area, filtered_df_summary = (
-        get_statistics_plants(save_path, master_data, plant_group)
+    report = instrument.RunReport("analysis", vars(args))
+    instrument.add_startup(report, IMPORT_START, IMPORT_SECONDS)
+    run_analysis(
+        seg_folder,
+        master_data,
+        image_folder=image_folder,
+        ind_df=ind_df,
+        save_path=save_path,
+        plant_boundary=args.plant_boundary,
+        jobs=args.jobs,
+        z_score_threshold=args.z_score_threshold,
+        zero_bottom_threshold=0.5,
+        traits_df=traits_df,
+        report=report,
+        progress=args.progress,
+        shard=args.shard,
+        # the catalog of segment.py saves listing the crop folder
+        image_names=catalog.list_crops(os.path.join("./Segmentation", experiment)),
+        sampling_df=sampling_df,
     )
+    report.print_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,406 @@
+"""Segment and analyse many experiments, loading each model checkpoint once.
+
+Experiments are given as folders under the image root, optionally with their
+species after a colon; by default the species is the name of the folder:
+
+    python src/batch.py --experiments genetic_diversity/Soybean genetic_diversity/Sorghum
+    python src/batch.py --glob "genetic_diversity/*" --batch-size 8
+
+Without experiments, every images/<experimental design>/<species> folder is run,
+like src/RootXplorer_pipeline.sh. The experiments are ordered by model, so
+species sharing a checkpoint are segmented back to back with the model loaded
+once. Each finished experiment is analysed in the background while the next one
+is segmented. The progress is saved to a state file, so an interrupted batch
+resumes with the experiments it had not finished.
+"""
+
+import os, json, glob, threading, time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import analysis
+import catalog
+import crops
+import masks
+import replicas
+
+
+def parse_experiment(experiment):
+    """Split "experiment[:species]"; the species defaults to the experiment folder name."""
+    experiment, _, species = experiment.partition(":")
+    experiment = experiment.strip("/")
+    return experiment, species or os.path.basename(experiment)
+
+
+def find_experiments(image_root, patterns):
+    """Experiment folders under image_root matching the glob patterns, in sorted order."""
+    experiments = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(image_root, pattern))):
+            experiment = os.path.relpath(path, image_root).replace(os.sep, "/")
+            if os.path.isdir(path) and experiment not in experiments:
+                experiments.append(experiment)
+    return experiments
+
+
+def get_jobs(experiments, model_folder="./model"):
+    """
+    Order the (experiment, species) pairs by model checkpoint.
+    # Returns
+        A list of (model name, [(experiment, species), ...]) in the order the
+        models are first needed.
+    """
+    import segment
+
+    groups = {}
+    for experiment, species in experiments:
+        try:
+            model_name = segment.get_model(species, model_folder)
+        except KeyError:
+            raise ValueError(
+                f"No model for species {species} of {experiment}, "
+                f"give it as {experiment}:<species>"
+            )
+        groups.setdefault(model_name, []).append((experiment, species))
+    return list(groups.items())
+
+
+class BatchState:
+    """Status of the experiments of a batch, saved to a JSON file after every change.
+
+    Args:
+        path (str): JSON file of the state
+        options (dict): options of the batch; experiments finished with other
+            options are run again
+    """
+
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        self.lock = threading.Lock()
+        self.experiments = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.experiments = json.load(f)["experiments"]
+
+    def get(self, experiment):
+        entry = self.experiments.get(experiment)
+        if entry is None or entry.get("options") != self.options:
+            return None
+        return entry["status"]
+
+    def set(self, experiment, status, **fields):
+        with self.lock:
+            self.experiments[experiment] = {
+                "status": status,
+                "options": self.options,
+                **fields,
+            }
+            self.save()
+
+    def save(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"experiments": self.experiments}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def analyse_experiment(
+    experiment,
+    image_root="./images",
+    save_root="./Segmentation",
+    ind_df=None,
+    traits_df=None,
+    from_traits=False,
+    analysis_options=None,
+    sampling_df=None,
+):
+    """Run the analysis of a segmented experiment, as analysis.py does."""
+    save_path = os.path.join(save_root, experiment)
+    image_folder = os.path.join(save_path, "crop")
+    analysis_folder = os.path.join(save_path, "analysis")
+    if traits_df is None and from_traits:
+        traits_df = analysis.read_traits(analysis_folder)
+        sampling_df = analysis.read_sampling(analysis_folder)
+    elif ind_df is None and not os.path.exists(image_folder):
+        # segmented with --stream, the layers were detected without writing crops
+        ind_df = analysis.read_layer_index(analysis_folder)
+
+    return analysis.run_analysis(
+        os.path.join(save_path, "Segmentation"),
+        analysis.read_master_data(os.path.join(image_root, experiment)),
+        image_folder=image_folder,
+        ind_df=ind_df,
+        save_path=analysis_folder,
+        traits_df=traits_df,
+        image_names=catalog.list_crops(save_path),
+        sampling_df=sampling_df,
+        **(analysis_options or {}),
+    )
+
+
+def run_batch(
+    experiments,
+    image_root="./images",
+    save_root="./Segmentation",
+    model_folder="./model",
+    state_path=None,
+    device=None,
+    segment_options=None,
+    analysis_options=None,
+):
+    """Segment and analyse experiments, loading the model of each species once.
+
+    Args:
+        experiments (list): (experiment, species) pairs, experiments are folders under image_root
+        image_root (str): folder of the raw images and master data of the experiments
+        save_root (str): folder the crops, masks and analysis of the experiments are saved to
+        model_folder (str): folder of the model checkpoints and class dictionary
+        state_path (str): JSON file the progress is saved to, by default batch_state.json in save_root
+        device (torch.device): device to run the models on
+        segment_options (dict): keyword arguments of segment.segment_experiment
+        analysis_options (dict): keyword arguments of analysis.run_analysis
+
+    Returns:
+        dict: status of every experiment, "analysed" or "failed"
+    """
+    import torch
+    import segment
+
+    segment_options = dict(segment_options or {})
+    analysis_options = dict(analysis_options or {})
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if segment_options.get("cpu_replicas"):
+            device = torch.device("cpu")
+    state = BatchState(
+        state_path or os.path.join(save_root, "batch_state.json"),
+        {"segment": segment_options, "analysis": analysis_options},
+    )
+    from_traits = segment_options.get("traits", False) or bool(
+        segment_options.get("sample_tolerance")
+    )
+
+    def analyse(experiment, ind_df=None, traits_df=None, sampling_df=None):
+        start = time.time()
+        try:
+            analyse_experiment(
+                experiment,
+                image_root,
+                save_root,
+                ind_df=ind_df,
+                traits_df=traits_df,
+                from_traits=from_traits,
+                analysis_options=analysis_options,
+                sampling_df=sampling_df,
+            )
+        except Exception as e:
+            print(f"Analysis of {experiment} failed: {e!r}")
+            state.set(experiment, "failed", error=repr(e))
+            return
+        state.set(experiment, "analysed", seconds=round(time.time() - start, 3))
+        print(f"Analysed {experiment}")
+
+    # one analysis at a time runs next to the segmentation; --jobs parallelizes it
+    with ThreadPoolExecutor(max_workers=1) as analysis_pool:
+        for model_name, model_experiments in get_jobs(experiments, model_folder):
+            todo = []
+            for experiment, species in model_experiments:
+                status = state.get(experiment)
+                if status == "analysed":
+                    print(f"Skipping {experiment}, already analysed")
+                elif status == "segmented":
+                    print(f"Resuming the analysis of {experiment}")
+                    analysis_pool.submit(analyse, experiment)
+                else:
+                    todo.append((experiment, species))
+            if not todo:
+                continue
+
+            # model replicas load the model in their own processes
+            best_model = None
+            if not segment_options.get("cpu_replicas"):
+                print(f"Loading {model_name} for {len(todo)} experiments")
+                try:
+                    best_model = segment.load_model(
+                        model_name,
+                        device,
+                        scripted=segment_options.get("scripted", False)
+                        and segment_options.get("inference_precision") != "int8",
+                    )
+                except ValueError as e:
+                    print(f"Loading {model_name} failed: {e}")
+                    for experiment, _ in todo:
+                        state.set(experiment, "failed", error=f"{model_name}: {e}")
+                    continue
+            for experiment, species in todo:
+                print(f"Segmenting {experiment} ({species})")
+                start = time.time()
+                try:
+                    result = segment.segment_experiment(
+                        experiment,
+                        species,
+                        best_model=best_model,
+                        device=device,
+                        image_root=image_root,
+                        save_root=save_root,
+                        model_folder=model_folder,
+                        **segment_options,
+                    )
+                except Exception as e:
+                    print(f"Segmentation of {experiment} failed: {e!r}")
+                    state.set(experiment, "failed", error=repr(e))
+                    continue
+                state.set(experiment, "segmented", seconds=round(time.time() - start, 3))
+                # hand the tables over in memory instead of reading the CSV files back
+                analysis_pool.submit(
+                    analyse,
+                    experiment,
+                    result.get("layer_index"),
+                    result.get("traits"),
+                    result.get("sampling"),
+                )
+            del best_model
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+    return {experiment: state.get(experiment) for experiment, _ in experiments}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Segment and analyse many experiments, loading each model once"
+    )
+    parser.add_argument(
+        "--experiments",
+        nargs="+",
+        default=[],
+        help="Experiment folders under --image-root, as experiment or experiment:species",
+    )
+    parser.add_argument(
+        "--glob",
+        nargs="+",
+        default=[],
+        help="Glob patterns of experiment folders under --image-root, e.g. 'genetic_diversity/*'",
+    )
+    parser.add_argument(
+        "--image-root", default="./images", help="Folder of the raw images"
+    )
+    parser.add_argument(
+        "--save-root", default="./Segmentation", help="Folder the results are saved to"
+    )
+    parser.add_argument(
+        "--model-folder", default="./model", help="Folder of the model checkpoints"
+    )
+    parser.add_argument(
+        "--state",
+        default=None,
+        help="JSON file the progress is saved to (default <save-root>/batch_state.json)",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore the saved progress and run every experiment again",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Number of frames per forward pass"
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes decoding and preprocessing frames",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Crop raw frames in memory and feed them straight into the model",
+    )
+    parser.add_argument(
+        "--crop-format",
+        default="png",
+        choices=crops.CROP_FORMATS,
+        help="Save the crops as one PNG per frame or as one memory-mapped stack per plant",
+    )
+    parser.add_argument(
+        "--mask-format",
+        default="rgb",
+        choices=masks.MASK_FORMATS,
+        help="Format of the masks, see segment.py --mask-format",
+    )
+    parser.add_argument(
+        "--cpu-replicas",
+        type=replicas.parse_replicas,
+        default=0,
+        metavar="N|auto",
+        help="Segment on the CPU in N processes with a replica of the model each, see segment.py --cpu-replicas",
+    )
+    parser.add_argument(
+        "--traits",
+        action="store_true",
+        help="Measure the traits right after inference, see segment.py --traits",
+    )
+    parser.add_argument(
+        "--sample-tolerance",
+        type=float,
+        default=0,
+        help="Segment the frames of each plant until its traits converge, see segment.py --sample-tolerance",
+    )
+    parser.add_argument(
+        "--scripted",
+        action="store_true",
+        help="Load a TorchScript copy of the models, see segment.py --scripted",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes analysing plants in parallel",
+    )
+    parser.add_argument(
+        "--plant-boundary",
+        action="store_true",
+        help="Measure the traits at the median layer boundary of each plant",
+    )
+
+    args = parser.parse_args()
+
+    experiments = list(args.experiments)
+    patterns = args.glob or ([] if experiments else ["*/*"])
+    experiments += find_experiments(args.image_root, patterns)
+    experiments = [parse_experiment(experiment) for experiment in experiments]
+    if not experiments:
+        raise ValueError(f"No experiments found in {args.image_root}")
+
+    state_path = args.state or os.path.join(args.save_root, "batch_state.json")
+    if args.restart and os.path.exists(state_path):
+        os.remove(state_path)
+
+    statuses = run_batch(
+        experiments,
+        image_root=args.image_root,
+        save_root=args.save_root,
+        model_folder=args.model_folder,
+        state_path=state_path,
+        segment_options={
+            "batch_size": args.batch_size,
+            "num_workers": args.num_workers,
+            "stream": args.stream,
+            "mask_format": args.mask_format,
+            "crop_format": args.crop_format,
+            "cpu_replicas": args.cpu_replicas,
+            "traits": args.traits,
+            "sample_tolerance": args.sample_tolerance,
+            "scripted": args.scripted,
+        },
+        analysis_options={"jobs": args.jobs, "plant_boundary": args.plant_boundary},
+    )
+    for experiment, status in statuses.items():
+        print(f"{experiment}: {status}")
+
+
+if __name__ == "__main__":
+    main()
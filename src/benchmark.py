@@ -0,0 +1,447 @@
+"""Benchmark every stage of the pipeline on a synthetic experiment.
+
+Generates raw cylinder frames at scanner resolution with a master data CSV, a
+randomly initialized UNet, and times cropping, inference, layer detection,
+trait extraction and the outlier statistics. The traits are also measured as
+segment.py --traits measures them, and the frames that differ from analysis.py
+are counted. Runs offline on the CPU:
+
+    python src/benchmark.py --plants 4 --frames 72 --label my-change
+
+Each run is appended to the results file and compared with the previous run
+of the same configuration, so regressions between versions are visible.
+"""
+
+import os, io, gc, json, time, shutil, platform, subprocess
+import argparse
+import contextlib
+from datetime import datetime
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+import segmentation_models_pytorch as smp
+
+import analysis
+import instrument
+import masks
+import precision
+import segment
+
+
+EXPERIMENT = "benchmark/Arabidopsis"
+SCANNERS = ["Fast", "Slow", "Main"]
+TREATMENTS = ["0.0", "1.0", "2.0"]
+
+
+def make_frame(rng, height, width, boundary, roots, angle):
+    """Raw frame of a cylinder: two gel layers and roots that move as it rotates."""
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[:boundary] = 60
+    frame[boundary:] = 160
+    frame += rng.integers(0, 40, frame.shape, dtype=np.uint8)
+    for x, slope in roots:
+        x = int(x + angle * width) % width
+        points = np.array(
+            [[x + int(slope * y), y] for y in range(100, height - 50, 50)], np.int32
+        )
+        cv2.polylines(frame, [points], False, (255, 255, 255), 3)
+    return frame
+
+
+def make_experiment(root, n_plants, n_frames, height, width, seed=0):
+    """
+    Write the raw frames and master data of a synthetic experiment.
+    # Returns
+        The image folder of the experiment.
+    """
+    image_path = os.path.join(root, "images", EXPERIMENT)
+    if os.path.exists(image_path):
+        shutil.rmtree(image_path)
+    os.makedirs(image_path)
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n_plants):
+        trt = TREATMENTS[i % len(TREATMENTS)]
+        # frames of concentration 0 have no layer
+        barcode = f"T0R_P{i:03d}" if trt == "0.0" else f"P{i:03d}"
+        scanner = SCANNERS[i % len(SCANNERS)]
+        rows.append({"barcode": barcode, "scanner": scanner, "trt": trt})
+
+        startY = segment.SCANNER_BBOX[scanner][1]
+        boundary = startY + int(rng.integers(380, 460))
+        roots = [
+            (rng.integers(0, width), rng.uniform(-0.2, 0.2))
+            for _ in range(rng.integers(5, 15))
+        ]
+        os.makedirs(os.path.join(image_path, barcode))
+        for frame in range(1, n_frames + 1):
+            image = make_frame(
+                rng,
+                height,
+                width,
+                boundary + int(rng.integers(-5, 6)),
+                roots,
+                frame / n_frames,
+            )
+            cv2.imwrite(os.path.join(image_path, barcode, f"{frame}.png"), image)
+
+    pd.DataFrame(rows).to_csv(os.path.join(image_path, "barcodes.csv"), index=False)
+    return image_path
+
+
+def make_model_folder(model_folder):
+    if not os.path.exists(model_folder):
+        os.makedirs(model_folder)
+    pd.DataFrame(
+        {"name": ["background", "root"], "r": [0, 128], "g": [0, 0], "b": [0, 0]}
+    ).to_csv(os.path.join(model_folder, "label_class_dict_lr.csv"), index=False)
+
+
+def run_stage(name, n_frames, function):
+    """
+    Time a stage of the pipeline.
+    # Returns
+        The result of the stage and its measurements.
+    """
+    gc.collect()
+    peak_reset = instrument.reset_peak_rss()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function()
+    seconds = time.perf_counter() - start
+    measurements = {
+        "seconds": round(seconds, 4),
+        "frames": n_frames,
+        "frames_per_sec": round(n_frames / seconds, 3),
+        # without a reset the peak covers the run so far
+        "peak_rss_mb": round(instrument.get_peak_rss(), 1),
+        "peak_rss_reset": peak_reset,
+        # worker processes can not be reset; the largest one so far
+        "children_peak_rss_mb": round(instrument.get_children_peak_rss(), 1),
+    }
+    print(
+        f"{name:<12} {n_frames:>6} frames {seconds:9.2f} s "
+        f"{measurements['frames_per_sec']:9.2f} frames/s "
+        f"peak RSS {measurements['peak_rss_mb']:8.0f} MB"
+    )
+    return result, measurements
+
+
+def measure_frame_traits(crop_folder, seg_folder, image_names):
+    """
+    Traits of the frames as segment.py --traits measures them: the boundary of
+    each colour crop and the mask measured by analysis.FrameTraits.
+    """
+    frame_traits = analysis.FrameTraits()
+    mask_reader = masks.MaskReader(seg_folder)
+    rows = []
+    for image_name in image_names:
+        layer_ind = np.nan
+        if analysis.has_layer(image_name):
+            layer_ind = analysis.get_layer_boundary(
+                cv2.imread(os.path.join(crop_folder, image_name))
+            )
+        frame_traits.add(image_name, mask_reader.read(image_name), layer_ind)
+        rows.append(analysis.get_layer_index_row(crop_folder, image_name, layer_ind))
+    mask_reader.close()
+    return frame_traits.get_traits(analysis.get_layer_index_table(rows, None))
+
+
+def count_mismatches(traits_df, other_df):
+    """Number of frames whose layer index or traits differ between two traits tables."""
+    columns = [c for c in traits_df.columns if c not in ["image_name", "plant", "frame"]]
+    expected = traits_df.set_index("image_name")[columns]
+    actual = other_df.set_index("image_name")[columns].reindex(expected.index)
+    differ = (expected != actual) & ~(expected.isna() & actual.isna())
+    return int(differ.any(axis=1).sum())
+
+
+def run_benchmark(
+    workdir,
+    n_plants=4,
+    n_frames=72,
+    height=1100,
+    width=1600,
+    encoder="resnet18",
+    batch_size=1,
+    num_workers=0,
+    inference_precision="fp32",
+    channels_last=False,
+    mask_format="rgb",
+    jobs=1,
+    seed=0,
+):
+    """Time every stage of the pipeline on a synthetic experiment.
+
+    The synthetic images are reused while their settings do not change; the
+    crops, masks and tables are made again by every run.
+
+    Returns:
+        dict: measurements of every stage
+    """
+    data_config = {
+        "plants": n_plants,
+        "frames": n_frames,
+        "height": height,
+        "width": width,
+        "seed": seed,
+    }
+    data_config_path = os.path.join(workdir, "data.json")
+    image_path = os.path.join(workdir, "images", EXPERIMENT)
+    generated_config = None
+    if os.path.exists(data_config_path):
+        with open(data_config_path) as f:
+            generated_config = json.load(f)
+    if generated_config != data_config:
+        print(f"Generating {n_plants} plants of {n_frames} frames in {workdir}")
+        make_experiment(workdir, n_plants, n_frames, height, width, seed)
+        with open(data_config_path, "w") as f:
+            json.dump(data_config, f)
+    model_folder = os.path.join(workdir, "model")
+    make_model_folder(model_folder)
+
+    save_path = os.path.join(workdir, "Segmentation", EXPERIMENT)
+    if os.path.exists(save_path):
+        shutil.rmtree(save_path)
+    crop_folder = os.path.join(save_path, "crop")
+    seg_folder = os.path.join(save_path, "Segmentation")
+    master_data = analysis.read_master_data(image_path)
+    total = n_plants * n_frames
+    stages = {}
+
+    _, stages["crop"] = run_stage(
+        "crop",
+        total,
+        lambda: segment.crop_images_folder(
+            segment.SCANNER_BBOX, master_data, image_path, crop_folder
+        ),
+    )
+
+    torch.manual_seed(seed)
+    model = smp.Unet(encoder, encoder_weights=None, classes=2).eval()
+    device = torch.device("cpu")
+    class_rgb_values = segment.get_class_rgb_values(model_folder)
+    dataset = segment.PredictionDataset(
+        segment.get_metadata(crop_folder, crop_folder),
+        augmentation=segment.get_validation_augmentation(),
+        preprocessing=segment.get_preprocessing(
+            smp.encoders.get_preprocessing_fn(segment.ENCODER, segment.ENCODER_WEIGHTS)
+        ),
+        class_rgb_values=class_rgb_values,
+    )
+    calibration_images = None
+    if inference_precision == "int8":
+        calibration_images = [
+            dataset[i][0] for i in segment.get_sample_indices(len(dataset), 8)
+        ]
+    inference_model = precision.get_inference_model(
+        model, device, inference_precision, channels_last, calibration_images
+    )
+    mask_store = masks.get_mask_store(seg_folder, mask_format, class_rgb_values)
+
+    def infer():
+        segment.predict_dataset(
+            inference_model,
+            dataset,
+            mask_store,
+            device,
+            batch_size=batch_size,
+            num_workers=num_workers,
+        )
+        mask_store.close()
+
+    _, stages["inference"] = run_stage("inference", len(dataset), infer)
+
+    ind_df, stages["layer"] = run_stage(
+        "layer",
+        total,
+        lambda: analysis.get_layer_boundary_fodler(crop_folder, None, jobs=jobs),
+    )
+    traits_df, stages["traits"] = run_stage(
+        "traits",
+        total,
+        lambda: analysis.get_traits(seg_folder, ind_df, None, jobs=jobs),
+    )
+
+    # the traits segment.py --traits measures must be those of analysis.py
+    frame_traits_df, stages["frame_traits"] = run_stage(
+        "frame_traits",
+        total,
+        lambda: measure_frame_traits(
+            crop_folder, seg_folder, traits_df["image_name"].tolist()
+        ),
+    )
+    mismatches = count_mismatches(traits_df, frame_traits_df)
+    stages["frame_traits"]["mismatches"] = mismatches
+    if mismatches:
+        print(f"{mismatches} frames measured after inference differ from analysis.py")
+
+    def statistics():
+        remove_0 = analysis.remove_frame_outlier_0_upper(traits_df, False, None)
+        df_filtered, _ = analysis.remove_frame_outlier_0_bottom(remove_0, 0.5, None)
+        _, _, frames_summary = analysis.get_statistics_frames(df_filtered, None)
+        analysis.get_statistics_plants(None, master_data, "trt", data=frames_summary)
+
+    _, stages["statistics"] = run_stage("statistics", total, statistics)
+    return stages
+
+
+def get_commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def read_results(results_path):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_results(previous, current):
+    """Print the change of frames/sec and peak RSS of every stage against a previous run."""
+    name = previous.get("label") or previous.get("commit") or "previous run"
+    print(f"Against {name} ({previous['date']}):")
+    for stage, measurements in current["stages"].items():
+        if stage not in previous["stages"]:
+            continue
+        before = previous["stages"][stage]
+        speed = measurements["frames_per_sec"] / before["frames_per_sec"] - 1
+        rss = measurements["peak_rss_mb"] - before["peak_rss_mb"]
+        print(f"{stage:<12} {speed:+8.1%} frames/s {rss:+9.0f} MB peak RSS")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages")
+    parser.add_argument(
+        "--workdir",
+        default="./benchmark",
+        help="Folder of the synthetic experiment and its outputs",
+    )
+    parser.add_argument(
+        "--results",
+        default="./benchmark/results.jsonl",
+        help="File the results of every run are appended to",
+    )
+    parser.add_argument("--label", default=None, help="Name of this run in the results")
+    parser.add_argument("--plants", type=int, default=4, help="Number of plants")
+    parser.add_argument(
+        "--frames", type=int, default=72, help="Number of frames per plant"
+    )
+    parser.add_argument(
+        "--height", type=int, default=1100, help="Height of the raw frames"
+    )
+    parser.add_argument(
+        "--width", type=int, default=1600, help="Width of the raw frames"
+    )
+    parser.add_argument(
+        "--encoder",
+        default="resnet18",
+        help="Encoder of the randomly initialized UNet, e.g. resnet101 as in production",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Number of frames per forward pass"
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes decoding and preprocessing frames",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=precision.PRECISIONS,
+        help="Inference precision",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="Run the model in the channels_last memory format",
+    )
+    parser.add_argument(
+        "--mask-format",
+        default="rgb",
+        choices=[f for f in masks.MASK_FORMATS if f != "none"],
+        help="Format of the masks the traits are read from",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes analysing plants in parallel",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+
+    args = parser.parse_args()
+
+    config = {
+        "plants": args.plants,
+        "frames": args.frames,
+        "height": args.height,
+        "width": args.width,
+        "encoder": args.encoder,
+        "batch_size": args.batch_size,
+        "num_workers": args.num_workers,
+        "precision": args.precision,
+        "channels_last": args.channels_last,
+        "mask_format": args.mask_format,
+        "jobs": args.jobs,
+        "seed": args.seed,
+    }
+    stages = run_benchmark(
+        args.workdir,
+        n_plants=args.plants,
+        n_frames=args.frames,
+        height=args.height,
+        width=args.width,
+        encoder=args.encoder,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        inference_precision=args.precision,
+        channels_last=args.channels_last,
+        mask_format=args.mask_format,
+        jobs=args.jobs,
+        seed=args.seed,
+    )
+
+    result = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "label": args.label,
+        "commit": get_commit(),
+        "config": config,
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "cpus": os.cpu_count(),
+            "torch_threads": torch.get_num_threads(),
+        },
+        "stages": stages,
+    }
+    previous = [r for r in read_results(args.results) if r["config"] == config]
+    if previous:
+        compare_results(previous[-1], result)
+
+    results_folder = os.path.dirname(args.results)
+    if results_folder and not os.path.exists(results_folder):
+        os.makedirs(results_folder)
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    print(f"Saved the results to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import os, json, hashlib
+
+import numpy as np
+
+
+MANIFEST_NAME = "manifest.json"
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_frame_key(source_hash, model_hash, bbox, config):
+    """
+    Cache key of a segmented frame.
+    # Arguments
+        source_hash: hash of the cropped image, or of the raw frame when cropped in memory
+        model_hash: hash of the model checkpoint
+        bbox: crop bounding box (startX, startY, width, height), None for cropped images
+        config: preprocessing and output settings that change the mask
+
+    # Returns
+        A hex digest identifying the mask of the frame
+    """
+    payload = json.dumps(
+        {
+            "source": source_hash,
+            "model": model_hash,
+            "bbox": None if bbox is None else [int(v) for v in bbox],
+            "config": config,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SegmentationCache:
+    """Manifest of the masks saved in a segmentation folder.
+
+    The manifest maps each mask path (relative to the folder) to the key of the
+    frame it was predicted from, so re-runs only segment new or changed frames.
+
+    Args:
+        folder (str): segmentation folder holding the masks and the manifest
+        mask_store (masks.MaskStore): store the masks are saved in
+        manifest_name (str): file name of the manifest, e.g. one per shard
+    """
+
+    def __init__(self, folder, mask_store, manifest_name=MANIFEST_NAME):
+        self.folder = folder
+        self.mask_store = mask_store
+        self.manifest_path = os.path.join(folder, manifest_name)
+        self.manifest = {"models": {}, "frames": {}}
+        self.sources = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def model_hash(self, model_path):
+        """Hash a checkpoint, reusing the stored hash while size and mtime match."""
+        st = os.stat(model_path)
+        entry = self.manifest["models"].get(model_path)
+        if entry is None or [entry["size"], entry["mtime_ns"]] != [
+            st.st_size,
+            st.st_mtime_ns,
+        ]:
+            entry = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "sha256": file_hash(model_path),
+            }
+            self.manifest["models"][model_path] = entry
+        return entry["sha256"]
+
+    def source_hash(self, mask_name, source_path):
+        """Hash the image of a frame, reusing the stored hash while size and mtime match."""
+        st = os.stat(source_path)
+        source = [source_path, st.st_size, st.st_mtime_ns]
+        entry = self.manifest["frames"].get(mask_name)
+        if entry is not None and entry.get("source") == source:
+            return entry["source_sha256"]
+        self.sources[mask_name] = (source, file_hash(source_path))
+        return self.sources[mask_name][1]
+
+    def is_cached(self, mask_name, key):
+        entry = self.manifest["frames"].get(mask_name)
+        return (
+            entry is not None
+            and entry["key"] == key
+            and self.mask_store.exists(mask_name)
+        )
+
+    def get_layer_ind(self, mask_name):
+        layer_ind = self.manifest["frames"][mask_name].get("layer_ind")
+        return np.nan if layer_ind is None else layer_ind
+
+    def update(self, mask_name, key, layer_ind=np.nan):
+        entry = {
+            "key": key,
+            "layer_ind": None if np.isnan(layer_ind) else int(layer_ind),
+        }
+        if mask_name in self.sources:
+            entry["source"], entry["source_sha256"] = self.sources.pop(mask_name)
+        else:
+            old_entry = self.manifest["frames"].get(mask_name, {})
+            for field in ["source", "source_sha256"]:
+                if field in old_entry:
+                    entry[field] = old_entry[field]
+        self.manifest["frames"][mask_name] = entry
+
+    def evict(self, mask_names):
+        """Remove the masks and entries of frames that are not in mask_names."""
+        evicted = [name for name in self.manifest["frames"] if name not in mask_names]
+        for name in evicted:
+            self.mask_store.delete(name)
+            del self.manifest["frames"][name]
+        return evicted
+
+    def clear(self):
+        self.manifest["frames"] = {}
+
+    def save(self):
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,259 @@
+"""Catalog of the raw frames of an experiment, kept between runs.
+
+Listing an image tree of many plants is slow on network file systems. The
+catalog stores every frame with its plant, file size, mtime and the barcode and
+scanner of its plant in Segmentation/<experiment>/catalog.sqlite. A refresh only
+lists the folders whose mtime changed since the last one, which are the folders
+where frames were added, removed or renamed.
+"""
+
+import os, sqlite3, time
+
+import numpy as np
+import pandas as pd
+
+
+CATALOG_NAME = "catalog.sqlite"
+FRAME_COLUMNS = ["image_name", "plant", "frame", "size", "mtime_ns", "barcode", "scanner"]
+
+# crop box (startX, startY, width, height) of the frames of each scanner
+SCANNER_BBOX = {
+    "Fast": (350, 56, 1024, 1024),
+    "Slow": (520, 56, 1024, 1024),
+    "Main": (540, 56, 1024, 1024),  # MainScanner 2025
+    # "Main": (590, 56, 1024, 1024),# MainScanner 2024
+}
+
+
+def is_image(file):
+    return (file.endswith(".PNG") or file.endswith(".png")) and not file.startswith(".")
+
+
+def build_scanner_index(master_data):
+    """
+    Index the scanner of every barcode of the master data once.
+    # Returns
+        dict mapping each barcode to (row, scanner) of its first row
+    """
+    scanner_index = {}
+    for row, (barcode, scanner) in enumerate(
+        zip(master_data["barcode"], master_data["scanner"])
+    ):
+        if pd.isna(barcode):
+            continue
+        scanner_index.setdefault(str(barcode), (row, scanner))
+    return scanner_index
+
+
+def get_barcode(image_name, scanner_index):
+    """Barcode and scanner of the first master data row whose barcode starts image_name."""
+    matches = [
+        (scanner_index[image_name[:n]], image_name[:n])
+        for n in range(len(image_name) + 1)
+        if image_name[:n] in scanner_index
+    ]
+    if not matches:
+        return None, np.nan
+    (_, scanner), barcode = min(matches)
+    return barcode, scanner
+
+
+def get_scanner(image_name, master_data, scanner_index=None):
+    """Scanner of the first master data row whose barcode starts image_name."""
+    if scanner_index is None:
+        scanner_index = build_scanner_index(master_data)
+    return get_barcode(image_name, scanner_index)[1]
+
+
+def get_plant(image_name):
+    return os.path.dirname(image_name) or image_name
+
+
+class FrameCatalog:
+    """SQLite catalog of the frames of an image folder.
+
+    Args:
+        path (str): SQLite file of the catalog, ":memory:" to list the folder once
+        image_folder (str): folder of the raw frames of the experiment
+    """
+
+    def __init__(self, path, image_folder):
+        self.image_folder = image_folder
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        # shards of an experiment may refresh the same catalog at the same time
+        self.connection = sqlite3.connect(path, timeout=60)
+        with self.connection:
+            self.connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS folders (
+                    path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS frames (
+                    image_name TEXT PRIMARY KEY, folder TEXT, size INTEGER,
+                    mtime_ns INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS plants (
+                    plant TEXT PRIMARY KEY, barcode TEXT, scanner TEXT
+                );
+                CREATE INDEX IF NOT EXISTS frames_folder ON frames (folder);
+                CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+                """
+            )
+
+    def close(self):
+        self.connection.close()
+
+    def scan_folder(self, folder, entries):
+        """List a folder; returns its subfolders."""
+        subfolders = []
+        frames = []
+        for entry in entries:
+            name = entry.name if not folder else f"{folder}/{entry.name}"
+            if entry.is_dir():
+                subfolders.append(name)
+            elif is_image(entry.name):
+                st = entry.stat()
+                frames.append((name, folder, st.st_size, st.st_mtime_ns))
+
+        known = {
+            path
+            for (path,) in self.connection.execute(
+                "SELECT path FROM folders WHERE parent = ?", (folder,)
+            )
+        }
+        for removed in known - set(subfolders):
+            self.remove_folder(removed)
+        self.connection.execute("DELETE FROM frames WHERE folder = ?", (folder,))
+        self.connection.executemany("INSERT INTO frames VALUES (?, ?, ?, ?)", frames)
+        return subfolders
+
+    def remove_folder(self, folder):
+        for (path,) in self.connection.execute(
+            "SELECT path FROM folders WHERE parent = ?", (folder,)
+        ).fetchall():
+            self.remove_folder(path)
+        self.connection.execute("DELETE FROM frames WHERE folder = ?", (folder,))
+        self.connection.execute("DELETE FROM folders WHERE path = ?", (folder,))
+
+    def refresh(self, full=False):
+        """
+        Update the catalog from the folders whose mtime changed.
+        # Arguments
+            full: list every folder again, e.g. after frames were overwritten in place
+
+        # Returns
+            The number of folders listed.
+        """
+        scanned = 0
+        now = time.time_ns()
+        with self.connection:
+            stack = [("", None)]
+            while stack:
+                folder, parent = stack.pop()
+                path = os.path.join(self.image_folder, folder)
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                except FileNotFoundError:
+                    self.remove_folder(folder)
+                    continue
+                row = self.connection.execute(
+                    "SELECT mtime_ns FROM folders WHERE path = ?", (folder,)
+                ).fetchone()
+                if not full and row is not None and row[0] == mtime_ns:
+                    subfolders = [
+                        path
+                        for (path,) in self.connection.execute(
+                            "SELECT path FROM folders WHERE parent = ?", (folder,)
+                        )
+                    ]
+                else:
+                    with os.scandir(path) as entries:
+                        subfolders = self.scan_folder(folder, entries)
+                    scanned += 1
+                    # a folder changed within the mtime resolution is listed again next time
+                    if now - mtime_ns < 2 * 10 ** 9:
+                        mtime_ns = -1
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO folders VALUES (?, ?, ?)",
+                        (folder, parent, mtime_ns),
+                    )
+                stack.extend((subfolder, folder) for subfolder in subfolders)
+        return scanned
+
+    def update_plants(self, master_data):
+        """Record the barcode and scanner of every plant of the master data."""
+        scanner_index = build_scanner_index(master_data)
+        plants = {
+            get_plant(image_name)
+            for (image_name,) in self.connection.execute("SELECT image_name FROM frames")
+        }
+        rows = []
+        for plant in plants:
+            barcode, scanner = get_barcode(plant, scanner_index)
+            rows.append((plant, barcode, None if pd.isna(scanner) else str(scanner)))
+        with self.connection:
+            self.connection.execute("DELETE FROM plants")
+            self.connection.executemany("INSERT INTO plants VALUES (?, ?, ?)", rows)
+
+    def get_frames(self):
+        """Frames sorted by name, with the barcode and scanner of their plant."""
+        # the binary collation of SQLite sorts the names as Python does
+        frames = pd.read_sql_query(
+            "SELECT image_name, size, mtime_ns FROM frames ORDER BY image_name",
+            self.connection,
+        )
+        plants = pd.read_sql_query("SELECT * FROM plants", self.connection)
+        frames["plant"] = [get_plant(image_name) for image_name in frames["image_name"]]
+        frames["frame"] = [
+            os.path.splitext(os.path.basename(image_name))[0]
+            for image_name in frames["image_name"]
+        ]
+        frames = frames.merge(plants, on="plant", how="left")
+        frames["scanner"] = frames["scanner"].where(frames["scanner"].notna(), np.nan)
+        return frames[FRAME_COLUMNS]
+
+
+def get_frames(image_folder, save_path, master_data, full=False):
+    """
+    Frames of an experiment from its catalog in save_path, refreshed first.
+    Without a save_path, the folder is listed without keeping a catalog.
+    # Returns
+        DataFrame with the image name (relative to image_folder), plant, frame,
+        file size, mtime, barcode and scanner of every frame, sorted by name.
+    """
+    path = ":memory:" if save_path is None else os.path.join(save_path, CATALOG_NAME)
+    frame_catalog = FrameCatalog(path, image_folder)
+    try:
+        frame_catalog.refresh(full)
+        frame_catalog.update_plants(master_data)
+        return frame_catalog.get_frames()
+    finally:
+        frame_catalog.close()
+
+
+def read_frames(save_path):
+    """
+    Frames of the catalog of an experiment as the last refresh left them, without
+    touching the image folder; None when there is no catalog.
+    """
+    path = os.path.join(save_path, CATALOG_NAME)
+    if not os.path.exists(path):
+        return None
+    frame_catalog = FrameCatalog(path, None)
+    try:
+        return frame_catalog.get_frames()
+    finally:
+        frame_catalog.close()
+
+
+def list_crops(save_path):
+    """
+    Names of the cropped frames of an experiment, from the catalog segment.py
+    left in save_path; None when there is no catalog.
+    """
+    frames = read_frames(save_path)
+    if frames is None:
+        return None
+    return frames.loc[frames["scanner"].isin(list(SCANNER_BBOX)), "image_name"].tolist()
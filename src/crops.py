@@ -0,0 +1,250 @@
+"""Cropped frames as one PNG per frame or one memory-mapped stack per plant.
+
+With the "stack" format, the crops of a plant are saved to crop/<plant>.npy, an
+(N, height, width, 3) uint8 array, with crop/<plant>.json listing the frame
+names, the size of each crop and the raw frame it was cropped from. A plant is
+then two files instead of one per frame, and the frames are read as views of
+the memory-mapped array, without decoding. With the "png" format, the hidden
+crop/<plant>/.crops.json lists the raw frame of every crop, so that unchanged
+frames are not cropped again. CropReader reads both formats:
+
+    python src/crops.py --experiment genetic_diversity/Arabidopsis
+
+exports the stacks back to PNGs in Segmentation/<experiment>/crop_png.
+"""
+
+import os, json, threading
+import argparse
+
+import cv2
+import numpy as np
+
+import catalog
+
+
+CROP_FORMATS = ["png", "stack"]
+PNG_INDEX_NAME = ".crops.json"
+
+
+def to_gray(image):
+    """
+    Grayscale of a BGR crop, exactly as cv2.imread decodes a colour PNG with
+    IMREAD_GRAYSCALE: libpng's 15-bit weights, truncated. cv2.cvtColor rounds
+    instead; the layer boundary is detected on this grayscale on every path.
+    """
+    blue, green, red = (image[..., c].astype(np.uint32) for c in range(3))
+    return ((9797 * red + 19234 * green + 3737 * blue) >> 15).astype(np.uint8)
+
+
+def get_stack_paths(folder, plant):
+    """Array and index files of the stack of a plant."""
+    stack = os.path.join(folder, plant or "frames")
+    return f"{stack}.npy", f"{stack}.json"
+
+
+def read_index(index_path):
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def write_stack(folder, plant, names, images, sources, shape):
+    """
+    Save the crops of a plant to its stack, written to a temporary file first so
+    that readers never see a partial stack.
+    # Arguments
+        names: frame file names, e.g. 1.png
+        images: the crops, in the order of names; consumed one at a time
+        sources: JSON description of the raw frame of every crop
+        shape: (height, width) of the largest crop
+    """
+    array_path, index_path = get_stack_paths(folder, plant)
+    os.makedirs(os.path.dirname(array_path), exist_ok=True)
+    stack = np.lib.format.open_memmap(
+        f"{array_path}.tmp", mode="w+", dtype=np.uint8, shape=(len(names), *shape, 3)
+    )
+    shapes = []
+    for i, image in enumerate(images):
+        height, width = image.shape[:2]
+        stack[i, :height, :width] = image
+        shapes.append([height, width])
+    stack.flush()
+    del stack
+    os.replace(f"{array_path}.tmp", array_path)
+
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump({"frames": list(names), "shapes": shapes, "sources": sources}, f)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def read_png_index(plant_folder):
+    """Raw frame and crop box of the PNG crops of a plant folder, by frame name."""
+    index = read_index(os.path.join(plant_folder, PNG_INDEX_NAME))
+    return {} if index is None else index["sources"]
+
+
+def write_png_index(plant_folder, sources):
+    index_path = os.path.join(plant_folder, PNG_INDEX_NAME)
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump({"sources": sources}, f)
+    os.replace(f"{index_path}.tmp", index_path)
+
+
+def remove_stack(folder, plant):
+    for path in get_stack_paths(folder, plant):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def remove_pngs(folder, plant, names):
+    """Remove the PNG crops of a plant, left by a run with the png format."""
+    plant_folder = os.path.join(folder, plant)
+    if not plant or not os.path.isdir(plant_folder):
+        return
+    for name in [*names, PNG_INDEX_NAME]:
+        path = os.path.join(plant_folder, name)
+        if os.path.exists(path):
+            os.remove(path)
+    if not os.listdir(plant_folder):
+        os.rmdir(plant_folder)
+
+
+def is_stack_current(folder, plant, names, sources):
+    """Whether the stack of a plant holds these frames, cropped from the same raw frames."""
+    index = read_index(get_stack_paths(folder, plant)[1])
+    return (
+        index is not None
+        and index["frames"] == list(names)
+        and index["sources"] == sources
+        and os.path.exists(get_stack_paths(folder, plant)[0])
+    )
+
+
+class CropReader:
+    """Read cropped frames of any format as the BGR arrays cv2.imread returns.
+
+    Frames of a stack are read-only views of the memory-mapped array. The
+    stacks are opened once per process, so a reader can be shared by threads
+    and copied to data loader workers.
+
+    Args:
+        folder (str): crop folder
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # worker processes map the stacks again instead of receiving copies
+        return {"folder": self.folder}
+
+    def __setstate__(self, state):
+        self.__init__(state["folder"])
+
+    def get_stack(self, plant):
+        """(frame positions, shapes, array) of the stack of a plant, None without one."""
+        if plant not in self.stacks:
+            array_path, index_path = get_stack_paths(self.folder, plant)
+            index = read_index(index_path)
+            stack = None
+            if index is not None:
+                stack = (
+                    {name: i for i, name in enumerate(index["frames"])},
+                    index["shapes"],
+                    np.load(array_path, mmap_mode="r"),
+                )
+            with self.lock:
+                self.stacks.setdefault(plant, stack)
+        return self.stacks[plant]
+
+    def read(self, image_name):
+        """A crop by its name relative to the crop folder, e.g. plant/1.png."""
+        plant, name = os.path.split(image_name)
+        stack = self.get_stack(plant)
+        if stack is None or name not in stack[0]:
+            return cv2.imread(os.path.join(self.folder, image_name))
+        positions, shapes, array = stack
+        i = positions[name]
+        height, width = shapes[i]
+        return np.asarray(array[i, :height, :width])
+
+    def read_gray(self, image_name):
+        """A crop in grayscale, as cv2.imread with IMREAD_GRAYSCALE returns it."""
+        plant, name = os.path.split(image_name)
+        stack = self.get_stack(plant)
+        if stack is None or name not in stack[0]:
+            return cv2.imread(os.path.join(self.folder, image_name), cv2.IMREAD_GRAYSCALE)
+        return to_gray(self.read(image_name))
+
+
+def list_frames(folder):
+    """Cropped frames of a folder in both formats, sorted as analysis.list_images sorts them."""
+    frames = set()
+    for root, _, files in os.walk(folder):
+        for file in files:
+            path = os.path.relpath(os.path.join(root, file), folder)
+            if catalog.is_image(file):
+                frames.add(path)
+            elif file.endswith(".json") and not file.startswith("."):
+                index = read_index(os.path.join(root, file))
+                plant = os.path.splitext(path)[0]
+                plant = "" if plant == "frames" else plant
+                frames.update(os.path.join(plant, name) for name in index["frames"])
+    return sorted(frames)
+
+
+def export_pngs(folder, output_folder, plants=None):
+    """
+    Write the frames of the stacks of a crop folder as PNGs.
+    # Arguments
+        plants: only export these plants, relative to the crop folder
+
+    # Returns
+        The number of PNGs written.
+    """
+    reader = CropReader(folder)
+    exported = 0
+    for image_name in list_frames(folder):
+        plant = os.path.dirname(image_name)
+        if plants is not None and plant not in plants:
+            continue
+        if reader.get_stack(plant) is None:
+            continue
+        path = os.path.join(output_folder, image_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cv2.imwrite(path, reader.read(image_name))
+        exported += 1
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the cropped frame stacks of an experiment to PNGs"
+    )
+    parser.add_argument(
+        "--experiment", required=True, help="Experimental design folder path"
+    )
+    parser.add_argument(
+        "--plants",
+        nargs="+",
+        default=None,
+        help="Only export these plant folders, relative to the crop folder",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Folder to write the PNGs to (default Segmentation/<experiment>/crop_png)",
+    )
+    args = parser.parse_args()
+
+    save_path = os.path.join("./Segmentation", args.experiment)
+    output_folder = args.output or os.path.join(save_path, "crop_png")
+    exported = export_pngs(os.path.join(save_path, "crop"), output_folder, args.plants)
+    print(f"Exported {exported} frames to {output_folder}")
+
+
+if __name__ == "__main__":
+    main()
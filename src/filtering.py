@@ -0,0 +1,61 @@
+import numpy as np
+
+
+ZERO_STD = ["drop", "keep"]
+
+
+def get_group_zscore(data, group, column):
+    """
+    Absolute z-score of a column within each group, as scipy.stats.zscore computes
+    it on the group (population standard deviation).
+    # Returns
+        The z-scores and a mask of the rows of groups whose values are all equal.
+    """
+    grouped = data.groupby(group)[column]
+    mean = grouped.transform("mean")
+    std = grouped.transform("std", ddof=0)
+    zero_std = grouped.transform("std") == 0
+    return (data[column] - mean).abs() / std, zero_std
+
+
+def filter_group_outliers(
+    data, group, column, z_score_threshold=2, zero_std="drop", keep_zeros=True
+):
+    """
+    Remove the outliers of a column within each group.
+    # Arguments
+        data: DataFrame, rows with missing values are left out
+        group: column to group the rows by
+        column: column the outliers are detected on
+        z_score_threshold: rows with an absolute z-score above it are outliers
+        zero_std: "drop" or "keep" the rows of groups whose values are all equal
+        keep_zeros: keep the rows where the column is 0 whatever their z-score
+
+    # Returns
+        The rows kept, ordered by group.
+    """
+    if zero_std not in ZERO_STD:
+        raise ValueError(f"Unknown zero_std {zero_std}, choose from {ZERO_STD}")
+    data = data.dropna()
+
+    z_scores, zero_std_mask = get_group_zscore(data, group, column)
+    if zero_std == "drop":
+        keep = (z_scores <= z_score_threshold) & ~zero_std_mask
+    else:
+        keep = (z_scores <= z_score_threshold) | zero_std_mask
+    if keep_zeros:
+        keep |= data[column] == 0
+    return data[keep].sort_values(group, kind="mergesort")
+
+
+def filter_outliers(data, group, columns, z_score_threshold=2, zero_std="drop"):
+    """Outliers of each column removed separately, see filter_group_outliers."""
+    return [
+        filter_group_outliers(data, group, column, z_score_threshold, zero_std)
+        for column in columns
+    ]
+
+
+def drop_invalid_rows(data):
+    """Rows without missing or infinite values."""
+    return data[~data.isin([np.nan, np.inf, -np.inf]).any(axis=1)]
@@ -0,0 +1,214 @@
+import os, sys, json, time, resource, threading
+import contextlib
+from datetime import datetime
+
+
+# stages running in the threads of this process, and stages started so far; the
+# peak memory is shared by the whole process, so a stage only resets and
+# records it when no other stage runs at the same time
+running_stages = {"count": 0, "started": 0}
+running_lock = threading.Lock()
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process; returns False if unsupported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss():
+    """Peak resident set size of this process in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_children_peak_rss():
+    """Peak resident set size of the largest finished worker process in MB."""
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+def get_process_age():
+    """Seconds since this process started, None where /proc is not available."""
+    try:
+        with open("/proc/self/stat") as f:
+            # the fields after the command name, which may contain spaces
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return max(uptime - start_ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+
+
+def add_startup(report, import_start, import_seconds):
+    """
+    Add the start of a script to a report: the interpreter until import_start,
+    a time.perf_counter() taken before the imports, and the imports.
+    """
+    age = get_process_age()
+    if age is not None:
+        report.add("interpreter", max(age - (time.perf_counter() - import_start), 0.0))
+    report.add("imports", import_seconds)
+
+
+@contextlib.contextmanager
+def timed(timings, stage):
+    """Add the wall time of a block to timings[stage]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class RunReport:
+    """Wall time, item count and peak memory of the stages of a run.
+
+    Coarse stages are measured with stage(), which also records the peak memory
+    of the process during the stage. Per-item steps, e.g. the decoding of each
+    frame in the data loader workers, are added with add_timings().
+
+    Args:
+        name (str): name of the run, e.g. "segment"
+        config (dict): settings of the run, saved with the report
+    """
+
+    def __init__(self, name, config=None):
+        self.name = name
+        self.config = config or {}
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.start = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage, seconds, items=0):
+        entry = self.stages.setdefault(stage, {"seconds": 0.0, "items": 0})
+        entry["seconds"] += seconds
+        entry["items"] += items
+        return entry
+
+    def add_timings(self, timings, items=1):
+        for stage, seconds in timings.items():
+            self.add(stage, seconds, items)
+
+    @contextlib.contextmanager
+    def stage(self, stage, items=0):
+        """
+        Measure a block as a stage; set counter["items"] inside the block when
+        the number of items is only known then. Stages overlapping another one,
+        e.g. the analysis of batch.py next to the segmentation, record no peak
+        memory.
+        """
+        with running_lock:
+            running_stages["count"] += 1
+            running_stages["started"] += 1
+            started = running_stages["started"]
+            peak_reset = running_stages["count"] == 1 and reset_peak_rss()
+        counter = {"items": items}
+        start = time.perf_counter()
+        try:
+            yield counter
+        finally:
+            with running_lock:
+                running_stages["count"] -= 1
+                alone = running_stages["started"] == started
+            entry = self.add(stage, time.perf_counter() - start, counter["items"])
+            if peak_reset and alone:
+                entry["peak_rss_mb"] = max(entry.get("peak_rss_mb", 0), get_peak_rss())
+
+    def to_dict(self):
+        stages = {}
+        for stage, entry in self.stages.items():
+            stages[stage] = {k: round(v, 4) for k, v in entry.items()}
+            if entry["items"] and entry["seconds"] > 0:
+                stages[stage]["items_per_sec"] = round(
+                    entry["items"] / entry["seconds"], 3
+                )
+        return {
+            "name": self.name,
+            "started": self.started,
+            "seconds": round(time.perf_counter() - self.start, 4),
+            # the peak is reset by every stage, so also take the peaks of the stages
+            "peak_rss_mb": round(
+                max(
+                    [get_peak_rss()]
+                    + [entry.get("peak_rss_mb", 0) for entry in self.stages.values()]
+                ),
+                1,
+            ),
+            "children_peak_rss_mb": round(get_children_peak_rss(), 1),
+            "config": self.config,
+            "stages": stages,
+        }
+
+    def save(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def print_summary(self):
+        report = self.to_dict()
+        print(f"{self.name} took {report['seconds']:.2f} s")
+        for stage, entry in report["stages"].items():
+            rate = entry.get("items_per_sec")
+            rate = f"{rate:10.2f}/s" if rate else " " * 12
+            peak = entry.get("peak_rss_mb")
+            peak = f" peak RSS {peak:8.0f} MB" if peak else ""
+            print(
+                f"  {stage:<12} {entry['seconds']:9.2f} s {entry['items']:>7} items"
+                f" {rate}{peak}"
+            )
+
+
+class Progress:
+    """Print the progress of a stage with its throughput and estimated time left.
+
+    Call it with (items done, total items), e.g. as the progress callback of
+    segment.segment_experiment.
+
+    Args:
+        stage (str): name shown in front of the progress
+        unit (str): name of the items
+        interval (float): minimum number of seconds between two updates
+    """
+
+    def __init__(self, stage, unit="frames", interval=1.0, stream=None):
+        self.stage = stage
+        self.unit = unit
+        self.interval = interval
+        self.stream = stream or sys.stderr
+        self.start = None
+        self.first = 0
+        self.last = 0
+
+    def __call__(self, done, total):
+        now = time.perf_counter()
+        if self.start is None:
+            # measure the rate from the first update, after any warm up
+            self.start = now
+            self.first = done
+        if done < total and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        rate = (done - self.first) / elapsed if elapsed > 0 else 0
+        eta = (total - done) / rate if rate > 0 else float("nan")
+        eta = "--:--" if eta != eta else f"{int(eta // 60):02d}:{int(eta % 60):02d}"
+        self.stream.write(
+            f"\r{self.stage}: {done}/{total} {self.unit} "
+            f"{rate:.2f} {self.unit}/s ETA {eta}"
+        )
+        if done >= total:
+            self.stream.write("\n")
+        self.stream.flush()
@@ -0,0 +1,285 @@
+import os
+
+import cv2
+import numpy as np
+
+
+MASK_FORMATS = ["rgb", "gray", "bits", "none"]
+
+
+def colour_code_segmentation(image, label_values):
+    """
+    Given a 1-channel array of class keys, colour code the segmentation results.
+    # Arguments
+        image: single channel array where each value represents the class key.
+        label_values
+
+    # Returns
+        Colour coded image for segmentation visualization
+    """
+    colour_codes = np.array(label_values)
+    x = colour_codes[image.astype(int)]
+
+    return x
+
+
+def remove_empty_folder(folder, root):
+    if folder != root and os.path.isdir(folder) and not os.listdir(folder):
+        os.rmdir(folder)
+
+
+class MaskStore:
+    """Save predicted masks of class keys under a segmentation folder.
+
+    Masks are addressed by their PNG path relative to the folder, e.g. plant/1.png,
+    whatever the format they are stored in.
+
+    Args:
+        folder (str): segmentation folder
+        class_rgb_values (np.ndarray): RGB values of the predicted classes
+        colour_folder (str): also export colour coded PNGs to this folder
+    """
+
+    # masks of different frames can be saved from several threads
+    thread_safe = True
+
+    def __init__(self, folder, class_rgb_values, colour_folder=None):
+        self.folder = folder
+        self.class_rgb_values = np.array(class_rgb_values)
+        self.colour_folder = colour_folder
+
+    def write(self, mask_name, pred_mask):
+        self.save(mask_name, pred_mask)
+        if self.colour_folder:
+            save_png(
+                os.path.join(self.colour_folder, mask_name),
+                colour_code_segmentation(pred_mask, self.class_rgb_values),
+            )
+
+    def close(self):
+        pass
+
+
+def save_png(path, image):
+    save_folder = os.path.dirname(path)
+    if not os.path.exists(save_folder):
+        # another thread may create it at the same time
+        os.makedirs(save_folder, exist_ok=True)
+    cv2.imwrite(path, image)
+
+
+class PngMaskStore(MaskStore):
+    """One PNG per frame: colour coded ("rgb") or single channel ("gray").
+
+    The single channel keeps the first channel that cv2.imread returns for the
+    colour coded mask, which is all that analysis.py uses. The bit-packed masks
+    a run with the "bits" format left for the saved or deleted frames are
+    removed when the store is closed.
+    """
+
+    def __init__(self, folder, class_rgb_values, colour_folder=None, gray=False):
+        super().__init__(folder, class_rgb_values, colour_folder)
+        self.gray = gray
+        self.replaced = set()
+
+    def save(self, mask_name, pred_mask):
+        mask = colour_code_segmentation(pred_mask, self.class_rgb_values)
+        if self.gray:
+            mask = mask[:, :, 0].astype("uint8")
+        save_png(os.path.join(self.folder, mask_name), mask)
+        self.replaced.add(mask_name)
+
+    def close(self):
+        replaced, self.replaced = self.replaced, set()
+        remove_bits_masks(self.folder, replaced)
+
+    def exists(self, mask_name):
+        return os.path.exists(os.path.join(self.folder, mask_name))
+
+    def delete(self, mask_name):
+        mask_path = os.path.join(self.folder, mask_name)
+        if os.path.exists(mask_path):
+            os.remove(mask_path)
+        remove_empty_folder(os.path.dirname(mask_path), self.folder)
+        self.replaced.add(mask_name)
+
+
+def get_frame_keys(keys):
+    return {key for key in keys if not key.endswith(":shape") and key != "value"}
+
+
+def get_container(folder, mask_name):
+    """Per-plant container of a mask and the key of the frame in it."""
+    plant, frame = os.path.split(mask_name)
+    frame = os.path.splitext(frame)[0]
+    return os.path.join(folder, f"{plant or 'frames'}.npz"), frame
+
+
+def remove_bits_masks(folder, mask_names):
+    """Remove frames from the per-plant containers of the bits format, if they have any."""
+    containers = {}
+    for mask_name in mask_names:
+        container, frame = get_container(folder, mask_name)
+        containers.setdefault(container, set()).add(frame)
+    for container, frames in containers.items():
+        if not os.path.exists(container):
+            continue
+        with np.load(container) as data:
+            arrays = {key: data[key] for key in data.files}
+        stale = {frame for frame in frames if frame in arrays}
+        if not stale:
+            continue
+        for frame in stale:
+            del arrays[frame], arrays[f"{frame}:shape"]
+        if get_frame_keys(arrays):
+            tmp_path = f"{container[:-4]}.tmp.npz"
+            np.savez_compressed(tmp_path, **arrays)
+            os.replace(tmp_path, container)
+        else:
+            os.remove(container)
+
+
+class BitsMaskStore(MaskStore):
+    """Bit-packed binary masks, one NPZ container per plant.
+
+    Masks of a plant are buffered and written together when the next plant
+    starts or the store is closed. The PNG masks a run with another format left
+    for these frames are removed then, as MaskReader would read them first.
+    """
+
+    thread_safe = False
+
+    def __init__(self, folder, class_rgb_values, colour_folder=None):
+        super().__init__(folder, class_rgb_values, colour_folder)
+        if len(self.class_rgb_values) != 2:
+            raise ValueError("Bit-packed masks need exactly two classes")
+        self.pending_container = None
+        self.pending = {}
+        self.pending_names = []
+        self.frames = {}
+
+    def get_frames(self, container):
+        if container not in self.frames:
+            self.frames[container] = set()
+            if os.path.exists(container):
+                with np.load(container) as data:
+                    self.frames[container] = get_frame_keys(data.files)
+        return self.frames[container]
+
+    def flush(self):
+        container = self.pending_container
+        if container is None:
+            return
+        arrays = {}
+        if os.path.exists(container):
+            with np.load(container) as data:
+                arrays = {key: data[key] for key in data.files}
+        for frame, pred_mask in self.pending.items():
+            for key in [frame, f"{frame}:shape"]:
+                arrays.pop(key, None)
+            if pred_mask is not None:
+                arrays[frame] = np.packbits(pred_mask != 0, axis=1)
+                arrays[f"{frame}:shape"] = np.array(pred_mask.shape)
+        self.frames[container] = get_frame_keys(arrays)
+
+        if self.frames[container]:
+            arrays["value"] = self.class_rgb_values[1, :1]
+            if not os.path.exists(os.path.dirname(container)):
+                os.makedirs(os.path.dirname(container))
+            tmp_path = f"{container[:-4]}.tmp.npz"
+            np.savez_compressed(tmp_path, **arrays)
+            os.replace(tmp_path, container)
+        elif os.path.exists(container):
+            os.remove(container)
+            remove_empty_folder(os.path.dirname(container), self.folder)
+        for mask_name in self.pending_names:
+            mask_path = os.path.join(self.folder, mask_name)
+            if os.path.exists(mask_path):
+                os.remove(mask_path)
+                remove_empty_folder(os.path.dirname(mask_path), self.folder)
+        self.pending_container = None
+        self.pending = {}
+        self.pending_names = []
+
+    def stage(self, mask_name, pred_mask):
+        container, frame = get_container(self.folder, mask_name)
+        if container != self.pending_container:
+            self.flush()
+            self.pending_container = container
+        self.pending[frame] = pred_mask
+        self.pending_names.append(mask_name)
+
+    def save(self, mask_name, pred_mask):
+        self.stage(mask_name, pred_mask)
+
+    def exists(self, mask_name):
+        container, frame = get_container(self.folder, mask_name)
+        if container == self.pending_container and frame in self.pending:
+            return self.pending[frame] is not None
+        return frame in self.get_frames(container)
+
+    def delete(self, mask_name):
+        if self.exists(mask_name) or os.path.exists(os.path.join(self.folder, mask_name)):
+            self.stage(mask_name, None)
+
+    def close(self):
+        self.flush()
+
+
+class NoMaskStore(MaskStore):
+    """Keep no masks, e.g. when only their traits are needed; nothing is cached."""
+
+    def save(self, mask_name, pred_mask):
+        pass
+
+    def exists(self, mask_name):
+        return False
+
+    def delete(self, mask_name):
+        pass
+
+
+def get_mask_store(folder, mask_format, class_rgb_values, colour_folder=None):
+    if mask_format == "rgb":
+        return PngMaskStore(folder, class_rgb_values)
+    if mask_format == "gray":
+        return PngMaskStore(folder, class_rgb_values, colour_folder, gray=True)
+    if mask_format == "bits":
+        return BitsMaskStore(folder, class_rgb_values, colour_folder)
+    if mask_format == "none":
+        return NoMaskStore(folder, class_rgb_values, colour_folder)
+    raise ValueError(f"Unknown mask format {mask_format}, choose from {MASK_FORMATS}")
+
+
+class MaskReader:
+    """Read masks of any format as the single channel analysis.py measures.
+
+    Args:
+        folder (str): segmentation folder
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.container = None
+        self.data = None
+
+    def read(self, mask_name):
+        mask_path = os.path.join(self.folder, mask_name)
+        if os.path.exists(mask_path):
+            mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
+            return mask if mask.ndim == 2 else mask[:, :, 0]
+
+        container, frame = get_container(self.folder, mask_name)
+        if container != self.container:
+            self.close()
+            self.data = np.load(container)
+            self.container = container
+        height, width = self.data[f"{frame}:shape"]
+        mask = np.unpackbits(self.data[frame], axis=1, count=width)
+        return mask * self.data["value"].astype("uint8")
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.container = None
+        self.data = None
@@ -0,0 +1,78 @@
+"""Run the whole pipeline on an experiment from Python, without a process per step.
+
+    import pipeline
+
+    results = pipeline.run_experiment("genetic_diversity/Arabidopsis", "Arabidopsis")
+    results["plants_summary"]
+
+Tables are passed between the segmentation and the analysis in memory; the CSV
+files are only written with write_csv=True.
+"""
+
+import os
+
+import analysis
+import catalog
+import segment
+
+
+def run_experiment(
+    experiment,
+    species,
+    image_root="./images",
+    save_root="./Segmentation",
+    model_folder="./model",
+    write_csv=True,
+    best_model=None,
+    device=None,
+    segment_options=None,
+    analysis_options=None,
+):
+    """Segment an experiment and extract its traits.
+
+    Args:
+        experiment (str): experiment folder under image_root, e.g. genetic_diversity/Arabidopsis
+        species (str): plant species, selects the model
+        image_root (str): folder of the raw images and master data of the experiments
+        save_root (str): folder the crops, masks and analysis of the experiments are saved to
+        model_folder (str): folder of the model checkpoints and class dictionary
+        write_csv (bool): also save the tables as CSV files under save_root
+        best_model (torch.nn.Module): model of the species, loaded when None
+        device (torch.device): device to run the model on
+        segment_options (dict): keyword arguments of segment.segment_experiment
+        analysis_options (dict): keyword arguments of analysis.run_analysis
+
+    Returns:
+        dict: the segmentation counts ("segmentation") and the DataFrames of analysis.run_analysis
+    """
+    segment_options = dict(segment_options or {})
+    analysis_options = dict(analysis_options or {})
+    save_path = os.path.join(save_root, experiment)
+
+    segmentation = segment.segment_experiment(
+        experiment,
+        species,
+        best_model=best_model,
+        device=device,
+        image_root=image_root,
+        save_root=save_root,
+        model_folder=model_folder,
+        write_csv=write_csv,
+        **segment_options,
+    )
+    ind_df = segmentation.pop("layer_index", None)
+    traits_df = segmentation.pop("traits", None)
+    sampling_df = segmentation.pop("sampling", None)
+
+    results = analysis.run_analysis(
+        os.path.join(save_path, "Segmentation"),
+        analysis.read_master_data(os.path.join(image_root, experiment)),
+        image_folder=os.path.join(save_path, "crop"),
+        ind_df=ind_df,
+        save_path=os.path.join(save_path, "analysis") if write_csv else None,
+        traits_df=traits_df,
+        image_names=catalog.list_crops(save_path),
+        sampling_df=sampling_df,
+        **analysis_options,
+    )
+    return {"segmentation": segmentation, **results}
@@ -0,0 +1,128 @@
+import copy
+
+import numpy as np
+import pandas as pd
+import torch
+
+import analysis
+
+
+PRECISIONS = ["fp32", "bf16", "int8"]
+
+
+class EncoderStages(torch.nn.Module):
+    """Encoder with its stages registered as submodules, so torch.fx can trace it."""
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.stages = torch.nn.ModuleList(encoder.get_stages())
+
+    def forward(self, x):
+        features = []
+        for stage in self.stages:
+            x = stage(x)
+            features.append(x)
+        return features
+
+
+class InferenceModel(torch.nn.Module):
+    """Run a segmentation model in reduced precision and return fp32 logits.
+
+    Args:
+        model (torch.nn.Module): trained segmentation model
+        precision (str): "fp32", "bf16" (autocast) or "int8" (quantized encoder)
+        channels_last (bool): feed the model in the channels_last memory format
+    """
+
+    def __init__(self, model, precision="fp32", channels_last=False):
+        super().__init__()
+        self.model = model
+        self.precision = precision
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.precision == "bf16":
+            with torch.autocast(x.device.type, dtype=torch.bfloat16):
+                return self.model(x).float()
+        return self.model(x)
+
+
+def quantize_encoder(model, calibration_images):
+    """
+    Replace the encoder of a model by its static int8 quantization.
+    # Arguments
+        model: segmentation model with an smp encoder, modified in place
+        calibration_images: preprocessed CHW images to calibrate the activations
+    """
+    from torch.ao.quantization import get_default_qconfig
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    encoder = model.encoder
+    example = torch.from_numpy(calibration_images[0]).unsqueeze(0)
+    qconfig = {"": get_default_qconfig("fbgemm")}
+    try:
+        prepared = prepare_fx(EncoderStages(encoder), qconfig, example_inputs=(example,))
+    except TypeError:
+        # torch < 1.13 takes no example inputs
+        prepared = prepare_fx(EncoderStages(encoder), qconfig)
+    with torch.no_grad():
+        for image in calibration_images:
+            prepared(torch.from_numpy(image).unsqueeze(0))
+    quantized = convert_fx(prepared)
+    # attributes the smp model reads from its encoder
+    for name in ["output_stride", "out_channels"]:
+        if hasattr(encoder, name):
+            setattr(quantized, name, getattr(encoder, name))
+    model.encoder = quantized
+
+
+def get_inference_model(
+    model, device, precision="fp32", channels_last=False, calibration_images=None
+):
+    """Wrap a copy of the model for the chosen precision; fp32 returns the model itself."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, choose from {PRECISIONS}")
+    if precision == "fp32" and not channels_last:
+        return model
+    if precision == "int8" and device.type != "cpu":
+        raise ValueError("int8 inference runs on the CPU only")
+
+    # keep the fp32 model untouched
+    model = copy.deepcopy(model).eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    if precision == "int8":
+        quantize_encoder(model, calibration_images)
+    return InferenceModel(model, precision, channels_last)
+
+
+def compare_frame(image_name, layer_ind, reference_image, seg_image):
+    """Pixel agreement and traits of a reduced precision mask against the fp32 mask."""
+    row = {
+        "image_name": image_name,
+        "pixel_agreement": np.mean(reference_image[:, :, 0] == seg_image[:, :, 0]),
+    }
+    reference_traits = analysis.get_frame_traits(reference_image, int(layer_ind))
+    traits = analysis.get_frame_traits(seg_image, int(layer_ind))
+    for trait in ["root_area_ratio", "root_count_ratio"]:
+        row[f"{trait}_fp32"] = reference_traits[trait]
+        row[trait] = traits[trait]
+    return row
+
+
+def summarize_comparison(comparison_df):
+    summary = {
+        "frames": len(comparison_df),
+        "pixel_agreement_mean": comparison_df["pixel_agreement"].mean(),
+        "pixel_agreement_min": comparison_df["pixel_agreement"].min(),
+    }
+    for trait in ["root_area_ratio", "root_count_ratio"]:
+        drift = (comparison_df[trait] - comparison_df[f"{trait}_fp32"]).abs()
+        relative_drift = drift / comparison_df[f"{trait}_fp32"].abs()
+        summary[f"{trait}_drift_mean"] = drift[np.isfinite(drift)].mean()
+        summary[f"{trait}_relative_drift_mean"] = relative_drift[
+            np.isfinite(relative_drift)
+        ].mean()
+    return pd.Series(summary)
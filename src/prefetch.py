@@ -0,0 +1,101 @@
+"""Overlap the decoding of the frames and the writing of the masks with inference.
+
+PrefetchLoader decodes and preprocesses the next batches in threads while the
+model runs on the current one, and MaskWriter saves the masks in threads. Both
+are bounded, so at most a fixed number of batches and masks are held in memory.
+OpenCV and numpy release the GIL while they decode, encode and compress.
+"""
+
+import threading, time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PrefetchLoader:
+    """Batches of the samples of a dataset, decoded ahead in threads.
+
+    Args:
+        dataset (torch.utils.data.Dataset): dataset of the frames
+        batch_size (int): number of samples per batch
+        threads (int): number of threads decoding samples
+        depth (int): number of batches decoded ahead of the one the model runs on
+    """
+
+    def __init__(self, dataset, batch_size=1, threads=1, depth=2):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.threads = max(threads, 1)
+        self.depth = max(depth, 1)
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        batches = (
+            range(start, min(start + self.batch_size, len(self.dataset)))
+            for start in range(0, len(self.dataset), self.batch_size)
+        )
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            queue = deque()
+
+            def submit():
+                batch = next(batches, None)
+                if batch is not None:
+                    queue.append([pool.submit(self.dataset.__getitem__, i) for i in batch])
+
+            for _ in range(self.depth):
+                submit()
+            while queue:
+                futures = queue.popleft()
+                submit()
+                yield [future.result() for future in futures]
+
+
+class MaskWriter:
+    """Save masks to a mask store in threads, in the order they are written.
+
+    write() returns as soon as the mask is queued, and waits when depth masks
+    are already waiting. Stores that buffer the masks of a plant, like
+    masks.BitsMaskStore, are written from a single thread.
+
+    Args:
+        mask_store (masks.MaskStore): store to save the masks in
+        threads (int): number of threads writing masks
+        depth (int): maximum number of masks waiting to be written
+    """
+
+    def __init__(self, mask_store, threads=1, depth=8):
+        self.mask_store = mask_store
+        if not getattr(mask_store, "thread_safe", True):
+            threads = 1
+        self.pool = ThreadPoolExecutor(max_workers=max(threads, 1))
+        self.slots = threading.BoundedSemaphore(max(depth, 1))
+        self.futures = deque()
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def save(self, mask_name, pred_mask):
+        start = time.perf_counter()
+        try:
+            self.mask_store.write(mask_name, pred_mask)
+        finally:
+            with self.lock:
+                self.timings["write"] = (
+                    self.timings.get("write", 0.0) + time.perf_counter() - start
+                )
+            self.slots.release()
+
+    def write(self, mask_name, pred_mask):
+        self.slots.acquire()
+        self.futures.append(self.pool.submit(self.save, mask_name, pred_mask))
+        # raise the errors of the masks written so far
+        while self.futures and self.futures[0].done():
+            self.futures.popleft().result()
+
+    def close(self):
+        """Wait until every mask is written; the mask store is left open."""
+        try:
+            while self.futures:
+                self.futures.popleft().result()
+        finally:
+            self.pool.shutdown()
@@ -0,0 +1,268 @@
+"""Segment frames on the CPU with several model replicas, one per process.
+
+A single process gets little out of more intra-op threads for the ResNet101
+UNet. ReplicaPool starts N processes, each pinned to its own cores with as many
+torch threads, loads the model in every one of them and hands them batches of
+frames. The replicas write the masks to the mask store of the experiment
+themselves and send back the layer index and traits of their frames.
+
+tune_replicas runs a short warmup of the first frames with several workers x
+threads splits of the cores and keeps the one with the most frames per second;
+the warmup frames are kept, not segmented again.
+"""
+
+import os, time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+# state of a replica process, set by init_replica
+replica = {}
+
+
+def parse_replicas(value):
+    """Number of replicas, or "auto" to tune it."""
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"Invalid number of replicas {value}, expected N or auto")
+
+
+def get_cores():
+    """Cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_core_slots(workers, threads, cores=None):
+    """
+    Split the cores into one slot per worker, threads cores each; workers share
+    the cores round robin when there are not enough.
+    """
+    cores = get_cores() if cores is None else cores
+    return [
+        [cores[(worker * threads + i) % len(cores)] for i in range(threads)]
+        for worker in range(workers)
+    ]
+
+
+def get_splits(cores):
+    """(workers, threads) candidates of the tuner: powers of two of workers using every core."""
+    splits = []
+    workers = 1
+    while workers <= cores:
+        splits.append((workers, cores // workers))
+        workers *= 2
+    if splits[-1][0] != cores:
+        splits.append((cores, 1))
+    return splits
+
+
+def init_replica(slots, threads, model_name, dataset, options):
+    import torch
+    import masks
+    import precision
+    import segment
+
+    cores = slots.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+
+    device = torch.device("cpu")
+    inference_precision = options["inference_precision"]
+    model = segment.load_model(
+        model_name,
+        device,
+        scripted=options["scripted"] and inference_precision != "int8",
+    )
+    calibration_images = None
+    if inference_precision == "int8":
+        calibration_images = [
+            dataset[i][0] for i in segment.get_sample_indices(len(dataset), 8)
+        ]
+    replica.update(
+        dataset=dataset,
+        device=device,
+        options=options,
+        model=precision.get_inference_model(
+            model,
+            device,
+            precision=inference_precision,
+            channels_last=options["channels_last"],
+            calibration_images=calibration_images,
+        ),
+        mask_store=masks.get_mask_store(
+            options["seg_folder"],
+            options["mask_format"],
+            options["class_rgb_values"],
+            options["colour_folder"],
+        ),
+    )
+
+
+def run_task(indices):
+    """Segment frames of the dataset in a replica and save their masks."""
+    import torch
+    import analysis
+    import instrument
+    import segment
+
+    options = replica["options"]
+    frame_traits = analysis.FrameTraits() if options["traits"] else None
+    report = instrument.RunReport("replica")
+    start = time.perf_counter()
+    frames = segment.predict_dataset(
+        replica["model"],
+        torch.utils.data.Subset(replica["dataset"], indices),
+        replica["mask_store"],
+        replica["device"],
+        batch_size=options["batch_size"],
+        tile_size=options["tile_size"],
+        tile_overlap=options["tile_overlap"],
+        tile_batch_size=options["tile_batch_size"],
+        frame_traits=frame_traits,
+        report=report,
+    )
+    # the masks of the task are complete when it returns
+    replica["mask_store"].close()
+    return {
+        "frames": frames,
+        "traits": None if frame_traits is None else frame_traits.traits,
+        "pending": None if frame_traits is None else frame_traits.pending,
+        "stages": report.stages,
+        "pid": os.getpid(),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+class ReplicaPool:
+    """Processes each running a replica of the model on its own cores.
+
+    Args:
+        model_name (str): model checkpoint, without .pth, see segment.get_model
+        dataset (segment.PredictionDataset): frames to segment, sent to every process once
+        options (dict): batch_size, tile_size, tile_overlap, tile_batch_size,
+            inference_precision, channels_last, mask_format, class_rgb_values,
+            seg_folder, colour_folder, traits and scripted, as in
+            segment.segment_experiment
+        workers (int): number of replicas
+        threads (int): torch threads of each replica, and cores it is pinned to
+        thread_safe (bool): whether replicas may write masks of the same plant,
+            False for stores that buffer the masks of a plant
+    """
+
+    def __init__(self, model_name, dataset, options, workers, threads, thread_safe=True):
+        self.dataset = dataset
+        self.options = options
+        self.workers = workers
+        self.threads = threads
+        self.thread_safe = thread_safe
+        context = multiprocessing.get_context("spawn")
+        slots = context.Queue()
+        for cores in get_core_slots(workers, threads):
+            slots.put(cores)
+        self.pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=context,
+            initializer=init_replica,
+            initargs=(slots, threads, model_name, dataset, options),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.shutdown()
+
+    def get_tasks(self, indices):
+        """Batches of frames; whole plants when the masks of a plant are stored together."""
+        import segment
+
+        if self.thread_safe:
+            batch_size = self.options["batch_size"]
+            return [
+                indices[start : start + batch_size]
+                for start in range(0, len(indices), batch_size)
+            ]
+        plants = {}
+        for i in indices:
+            plant = os.path.dirname(segment.get_subpath(self.dataset.image_paths[i]))
+            plants.setdefault(plant, []).append(i)
+        return list(plants.values())
+
+    def predict(self, indices, frame_traits=None, report=None, progress=None):
+        """
+        Segment frames of the dataset in the replicas, as segment.predict_dataset does.
+        # Returns
+            (path_name, layer_ind) of every frame, and the frames per second
+            of the replicas while they were busy.
+        """
+        results = []
+        busy = {}
+        futures = [self.pool.submit(run_task, task) for task in self.get_tasks(indices)]
+        done = 0
+        for future in futures:
+            result = future.result()
+            results += result["frames"]
+            busy[result["pid"]] = busy.get(result["pid"], 0.0) + result["seconds"]
+            if frame_traits is not None:
+                frame_traits.traits.update(result["traits"])
+                frame_traits.pending.update(result["pending"])
+            if report is not None:
+                for stage, entry in result["stages"].items():
+                    report.add(stage, entry["seconds"], entry["items"])
+            done += len(result["frames"])
+            if progress:
+                progress(done, len(indices))
+        # the replica that was busy longest sets the pace
+        throughput = len(results) / max(busy.values()) if busy else 0.0
+        return results, throughput
+
+
+def tune_replicas(
+    model_name,
+    dataset,
+    options,
+    indices,
+    frame_traits=None,
+    report=None,
+    warmup=2,
+    thread_safe=True,
+):
+    """
+    Time the splits of the cores into workers x threads on the first frames.
+    # Arguments
+        indices: frames to segment; every split takes warmup batches per worker
+            of them, whose masks are saved as usual
+
+    # Returns
+        (workers, threads) with the most frames per second, and the
+        (path_name, layer_ind) of the frames segmented while tuning.
+    """
+    splits = get_splits(len(get_cores()))
+    frames = []
+    if len(splits) == 1:
+        return splits[0], frames
+    best = None
+    for workers, threads in splits:
+        count = warmup * workers * options["batch_size"]
+        warmup_indices = indices[len(frames) : len(frames) + count]
+        if not warmup_indices:
+            break
+        with ReplicaPool(
+            model_name, dataset, options, workers, threads, thread_safe
+        ) as pool:
+            split_frames, throughput = pool.predict(warmup_indices, frame_traits, report)
+        frames += split_frames
+        print(f"{workers} workers x {threads} threads: {throughput:.2f} frames/s")
+        if best is None or throughput > best[0]:
+            best = (throughput, (workers, threads))
+    return (best[1] if best else splits[0]), frames
@@ -0,0 +1,148 @@
+"""Segment a subset of the frames of each plant, until its traits converge.
+
+The frames of a plant are taken in rounds spread over the rotation: every 8th
+frame first, then the frames halfway between them, and so on. After each round
+a plant stops once the 95% confidence interval of the mean of its ratios is
+within a tolerance of the mean. Plants without a layer are measured on every
+frame, their boundary is only known once the whole experiment is segmented.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+SAMPLING_COLUMNS = ["root_count_ratio", "root_area_ratio"]
+
+# two-sided 95% quantiles of the t distribution for 1 to 30 degrees of freedom
+T_QUANTILES = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]  # fmt: skip
+
+
+def get_spread_rounds(n, stride=8):
+    """
+    Split the positions 0..n-1 of the frames of a plant into rounds: every
+    stride-th position, then the positions halfway between the previous ones.
+    # Returns
+        A list of lists of positions, every position in exactly one round.
+    """
+    rounds = []
+    seen = set()
+    while True:
+        positions = [i for i in range(0, n, max(stride, 1)) if i not in seen]
+        if positions:
+            rounds.append(positions)
+            seen.update(positions)
+        if stride <= 1:
+            return rounds
+        stride //= 2
+
+
+def get_half_width(values):
+    """Half-width of the 95% confidence interval of the mean of values."""
+    n = len(values)
+    if n < 2:
+        return np.inf
+    t = T_QUANTILES[n - 2] if n - 1 <= len(T_QUANTILES) else 1.96
+    return t * np.std(values, ddof=1) / np.sqrt(n)
+
+
+def is_converged(traits, tolerance, columns=SAMPLING_COLUMNS):
+    """Whether the mean of every column is known within tolerance (relative to it)."""
+    for column in columns:
+        values = np.array([frame[column] for frame in traits], dtype=float)
+        values = values[np.isfinite(values)]
+        half_width = get_half_width(values)
+        if half_width != 0 and not half_width <= tolerance * abs(values.mean()):
+            return False
+    return True
+
+
+def get_frame_order(image_name):
+    # frames are numbered by their rotation, 1.png to 72.png
+    frame = os.path.splitext(os.path.basename(image_name))[0]
+    return (0, int(frame), frame) if frame.isdigit() else (1, 0, frame)
+
+
+class FrameSampler:
+    """Rounds of frames to segment, until the traits of every plant converge.
+
+    Iterate over it to get the dataset indices of each round, and call update()
+    with the traits measured so far before asking for the next round.
+
+    Args:
+        image_names (list): frames of the dataset, relative to the experiment
+        plants (list): plant of each frame, as in the layer index table
+        tolerance (float): maximum half-width of the confidence interval of the
+            mean ratios, relative to the mean
+        stride (int): the first round takes every stride-th frame of a plant
+        measure_all (callable): whether all frames of a frame's plant are needed
+            at once, e.g. analysis.has_layer is False
+    """
+
+    def __init__(self, image_names, plants, tolerance, stride=8, measure_all=None):
+        self.image_names = list(image_names)
+        self.tolerance = tolerance
+        self.rounds = {}
+        frames = {}
+        for i, (image_name, plant) in enumerate(zip(image_names, plants)):
+            frames.setdefault(plant, []).append(i)
+        for plant, indices in frames.items():
+            indices = sorted(indices, key=lambda i: get_frame_order(image_names[i]))
+            if measure_all is not None and measure_all(image_names[indices[0]]):
+                self.rounds[plant] = [indices]
+            else:
+                self.rounds[plant] = [
+                    [indices[i] for i in positions]
+                    for positions in get_spread_rounds(len(indices), stride)
+                ]
+        self.totals = {plant: len(indices) for plant, indices in frames.items()}
+        self.used = {plant: [] for plant in frames}
+        self.converged = {plant: False for plant in frames}
+
+    def __iter__(self):
+        while True:
+            indices = []
+            for plant, rounds in self.rounds.items():
+                if rounds and not self.converged[plant]:
+                    self.used[plant] += rounds[0]
+                    indices += rounds.pop(0)
+            if not indices:
+                return
+            yield sorted(indices)
+
+    def update(self, traits):
+        """Stop the plants whose traits converged; traits maps image names to their traits."""
+        for plant, used in self.used.items():
+            if self.converged[plant] or not self.rounds[plant]:
+                continue
+            measured = [
+                traits[self.image_names[i]]
+                for i in used
+                if self.image_names[i] in traits
+            ]
+            self.converged[plant] = len(measured) == len(used) and is_converged(
+                measured, self.tolerance
+            )
+
+    @property
+    def selected(self):
+        """Dataset indices of the frames taken so far, in dataset order."""
+        return sorted(i for used in self.used.values() for i in used)
+
+    def get_summary(self):
+        return pd.DataFrame(
+            [
+                {
+                    "plant": plant,
+                    "frame_number_total": self.totals[plant],
+                    "frame_number_used": len(used),
+                    "converged": self.converged[plant],
+                }
+                for plant, used in self.used.items()
+            ]
+        )
@@ -1,8 +1,10 @@
-import os, cv2, math, csv
+import os, time
+
+# the imports are reported by --timing-startup
+IMPORT_START = time.perf_counter()
+import cv2, math, csv, json, threading
 import numpy as np
 import pandas as pd
-
-os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
 import warnings
 
 warnings.filterwarnings("ignore")
@@ -11,79 +13,197 @@ import torch
 import albumentations as album
 import argparse
 
-import segmentation_models_pytorch as smp
+import analysis
+import cache
+import catalog
+import crops
+import instrument
+import masks
+import prefetch
+import precision
+import replicas
+import sampling
+import tiling
+from catalog import SCANNER_BBOX
+from masks import colour_code_segmentation
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_START
+
+
+# model parameters
+ENCODER = "resnet101"
+ENCODER_WEIGHTS = "imagenet"
+# input normalization of the imagenet weights of the encoder, as
+# smp.encoders.get_preprocessing_params(ENCODER, ENCODER_WEIGHTS) gives it
+ENCODER_MEAN = [0.485, 0.456, 0.406]
+ENCODER_STD = [0.229, 0.224, 0.225]
+# number of frames segmented between two saves of the cache manifest
+CACHE_SAVE_FRAMES = 256
+
+
+def get_crop_metadata(bbox, master_data, image_folder, save_path, frames=None):
+    """
+    List the raw frames of an experiment with the scanner bounding box to crop.
+    # Arguments
+        frames: frames of the experiment from catalog.get_frames, listed from
+            image_folder when None
 
-import segmentation_models_pytorch.utils
+    # Returns
+        DataFrame with the cropped image path under save_path, the raw image
+        path, size and mtime and the bounding box of each frame with a known
+        scanner.
+    """
+    if frames is None:
+        frames = catalog.get_frames(image_folder, None, master_data)
 
+    matched = frames["scanner"].isin(list(bbox))
+    unmatched = frames.loc[~matched, "plant"]
+    if len(unmatched):
+        print(
+            f"Skipped {len(unmatched)} frames of {unmatched.nunique()} plants "
+            f"without a barcode or scanner in the master data: {sorted(unmatched.unique())}"
+        )
 
-def get_scanner(image_name, master_data):
-    match = master_data[
-        master_data["barcode"].apply(lambda x: image_name.startswith(x))
+    metadata_row = []
+    for image_name, scanner, size, mtime_ns in frames.loc[
+        matched, ["image_name", "scanner", "size", "mtime_ns"]
+    ].itertuples(index=False):
+        startX, startY, width, height = bbox[scanner]
+        metadata_row.append(
+            [
+                os.path.join(save_path, image_name),
+                os.path.join(image_folder, image_name),
+                int(size),
+                int(mtime_ns),
+                startX,
+                startY,
+                width,
+                height,
+            ]
+        )
+
+    header = [
+        "image_path",
+        "raw_path",
+        "size",
+        "mtime_ns",
+        "startX",
+        "startY",
+        "width",
+        "height",
     ]
-    return match["scanner"].values[0] if not match.empty else np.nan
+    return pd.DataFrame(metadata_row, columns=header)
 
 
-def crop_images_folder(bbox, master_data, image_folder, save_path):
-    images = sorted(
-        [
-            os.path.relpath(os.path.join(root, file), image_folder)
-            for root, _, files in os.walk(image_folder)
-            for file in files
-            if (file.endswith(".PNG") or file.endswith(".png"))
-            and not file.startswith(".")
-        ]
-    )
+def select_shard(df, folder, shard):
+    """Rows of the frames of the plants of a shard; frames are image_path under folder."""
+    if shard is None:
+        return df
+    keep = [
+        analysis.in_shard(os.path.relpath(path, folder), shard)
+        for path in df["image_path"]
+    ]
+    return df[np.array(keep, dtype=bool)].reset_index(drop=True)
 
-    for image_name in images:
-        image_path = os.path.join(image_folder, image_name)
-        image = cv2.imread(image_path)
-        # get scanner
-        scanner = get_scanner(image_name, master_data)
-        if scanner == "Fast":
-            bbox2 = bbox["Fast"]
-            startX, startY, width, height = bbox2
-        elif scanner == "Slow":
-            bbox2 = bbox["Slow"]
-            startX, startY, width, height = bbox2
-        elif scanner == "Main":
-            bbox2 = bbox["Main"]
-            startX, startY, width, height = bbox2
-        else:
-            startX, startY, width, height = [np.nan, np.nan, np.nan, np.nan]
 
-        if np.isnan(height) or np.isnan(width):
-            continue
+def crop_frame(image, startX, startY, width, height):
+    return image[startY : startY + height, startX : startX + width, :]
 
-        new_image = image[startY : startY + height, startX : startX + width, :]
 
-        # save new_image
-        save_folder = os.path.join(save_path, "/".join(image_name.split("/")[:-1]))
-        if not os.path.exists(save_folder):
-            os.makedirs(save_folder)
-        new_name = os.path.join(save_path, image_name)
-        cv2.imwrite(new_name, new_image)
+def save_crop(new_image, new_name):
+    save_folder = os.path.dirname(new_name)
+    if not os.path.exists(save_folder):
+        # another thread may create it at the same time
+        os.makedirs(save_folder, exist_ok=True)
+    cv2.imwrite(new_name, new_image)
 
 
-def crop_image(image, true_dimensions):
-    return album.CenterCrop(p=1, height=true_dimensions[0], width=true_dimensions[1])(
-        image=image
-    )
+def crop_images_folder(bbox, master_data, image_folder, save_path):
+    crop_df = get_crop_metadata(bbox, master_data, image_folder, save_path)
+    crop_frames(crop_df)
 
 
-def colour_code_segmentation(image, label_values):
+def crop_frames(crop_df, folder=None, crop_format="png"):
     """
-    Given a 1-channel array of class keys, colour code the segmentation results.
+    Crop the raw frames listed by get_crop_metadata and save the crops.
     # Arguments
-        image: single channel array where each value represents the class key.
-        label_values
+        folder: crop folder the image paths are under, needed by the stack format
+        crop_format: "png" for one PNG per frame, "stack" for one memory-mapped
+            stack per plant, see crops.CROP_FORMATS
 
     # Returns
-        Colour coded image for segmentation visualization
+        The number of frames cropped; crops and stacks whose raw frames and
+        crop boxes did not change are kept as they are, so the segmentation
+        cache finds them unchanged.
     """
-    colour_codes = np.array(label_values)
-    x = colour_codes[image.astype(int)]
+    if crop_format not in crops.CROP_FORMATS:
+        raise ValueError(
+            f"Unknown crop format {crop_format}, choose from {crops.CROP_FORMATS}"
+        )
+    if crop_format == "png":
+        cropped = 0
+        plant_folders = crop_df.groupby(
+            [os.path.dirname(path) for path in crop_df["image_path"]], sort=False
+        )
+        for plant_folder, plant_df in plant_folders:
+            sources = crops.read_png_index(plant_folder)
+            changed = False
+            for row in plant_df.itertuples(index=False):
+                name = os.path.basename(row.image_path)
+                source = [
+                    int(getattr(row, column))
+                    for column in ["size", "mtime_ns", "startX", "startY", "width", "height"]
+                ]
+                if sources.get(name) == source and os.path.exists(row.image_path):
+                    continue
+                image = cv2.imread(row.raw_path)
+                new_image = crop_frame(image, row.startX, row.startY, row.width, row.height)
+                # save new_image
+                save_crop(new_image, row.image_path)
+                sources[name] = source
+                changed = True
+                cropped += 1
+            if changed:
+                crops.write_png_index(plant_folder, sources)
+            if folder is not None:
+                # a stack left by the stack format would be read before the PNGs
+                plant = os.path.dirname(os.path.relpath(row.image_path, folder))
+                crops.remove_stack(folder, plant)
+        return cropped
+
+    cropped = 0
+    image_names = [os.path.relpath(path, folder) for path in crop_df["image_path"]]
+    plants = crop_df.groupby(
+        [os.path.dirname(image_name) for image_name in image_names], sort=False
+    )
+    for plant, plant_df in plants:
+        names = [os.path.basename(path) for path in plant_df["image_path"]]
+        sources = plant_df[
+            ["size", "mtime_ns", "startX", "startY", "width", "height"]
+        ].values.tolist()
+        if crops.is_stack_current(folder, plant, names, sources):
+            continue
+        images = (
+            crop_frame(cv2.imread(row.raw_path), row.startX, row.startY, row.width, row.height)
+            for row in plant_df.itertuples(index=False)
+        )
+        crops.write_stack(
+            folder,
+            plant,
+            names,
+            images,
+            sources,
+            (int(plant_df["height"].max()), int(plant_df["width"].max())),
+        )
+        crops.remove_pngs(folder, plant, names)
+        cropped += len(plant_df)
+    return cropped
 
-    return x
+
+def crop_image(image, true_dimensions):
+    return album.CenterCrop(p=1, height=true_dimensions[0], width=true_dimensions[1])(
+        image=image
+    )
 
 
 def reverse_one_hot(image):
@@ -113,6 +233,7 @@ class PredictionDataset(torch.utils.data.Dataset):
             (e.g. flip, scale, etc.)
         preprocessing (albumentations.Compose): data preprocessing
             (e.g. noralization, shape manipulation, etc.)
+        layer_boundary (bool): also detect the layer boundary of each cropped image
 
     """
 
@@ -122,34 +243,99 @@ class PredictionDataset(torch.utils.data.Dataset):
         class_rgb_values=None,
         augmentation=None,
         preprocessing=None,
+        layer_boundary=False,
     ):
         self.image_paths = df["image_path"].tolist()
 
         self.class_rgb_values = class_rgb_values
         self.augmentation = augmentation
         self.preprocessing = preprocessing
+        self.layer_boundary = layer_boundary
+
+    def read_image(self, i):
+        return cv2.imread(self.image_paths[i])
+
+    def get_source(self, i):
+        """Image file of a frame and the bounding box cropped from it."""
+        return self.image_paths[i], None
 
     def __getitem__(self, i):
-        image = cv2.cvtColor(cv2.imread(self.image_paths[i]), cv2.COLOR_BGR2RGB)
+        # timings travel with the sample, out of the data loader workers
+        timings = {}
+        with instrument.timed(timings, "decode"):
+            image = self.read_image(i)
         names = self.image_paths[i].rsplit("/", 1)[-1].split(".")[0]
         path_name = self.image_paths[i]
+        layer_ind = np.nan
+        if self.layer_boundary and analysis.has_layer(get_subpath(path_name)):
+            with instrument.timed(timings, "boundary"):
+                layer_ind = analysis.get_layer_boundary(image)
 
-        # apply augmentations
-        if self.augmentation:
-            sample = self.augmentation(image=image)
-            image = sample["image"]
+        with instrument.timed(timings, "preprocess"):
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            true_dimensions = image.shape
 
-        # apply preprocessing
-        if self.preprocessing:
-            sample = self.preprocessing(image=image)
-            image = sample["image"]
+            # apply augmentations
+            if self.augmentation:
+                sample = self.augmentation(image=image)
+                image = sample["image"]
 
-        return image, names, path_name
+            # apply preprocessing
+            if self.preprocessing:
+                sample = self.preprocessing(image=image)
+                image = sample["image"]
+
+        return image, names, path_name, true_dimensions, layer_ind, timings
 
     def __len__(self):
         return len(self.image_paths)
 
 
+class CropDataset(PredictionDataset):
+    """Crop raw frames in memory instead of reading cropped images from disk.
+
+    Args:
+        df (DataFrame): crop metadata from get_crop_metadata
+        save_crops (bool): also write the cropped images to their image_path
+        **kwargs: arguments of PredictionDataset
+    """
+
+    def __init__(self, df, save_crops=False, **kwargs):
+        super().__init__(df, **kwargs)
+        self.raw_paths = df["raw_path"].tolist()
+        self.bboxes = df[["startX", "startY", "width", "height"]].values.tolist()
+        self.save_crops = save_crops
+
+    def read_image(self, i):
+        image = crop_frame(cv2.imread(self.raw_paths[i]), *self.bboxes[i])
+        if self.save_crops:
+            save_crop(image, self.image_paths[i])
+        return image
+
+    def get_source(self, i):
+        return self.raw_paths[i], self.bboxes[i]
+
+
+class StackDataset(CropDataset):
+    """Read the crops from the per-plant stacks of the crop folder, see crops.py.
+
+    The frames are cached by their raw frame and crop box, as with CropDataset.
+
+    Args:
+        df (DataFrame): crop metadata from get_crop_metadata
+        folder (str): crop folder
+        **kwargs: arguments of PredictionDataset
+    """
+
+    def __init__(self, df, folder, **kwargs):
+        super().__init__(df, **kwargs)
+        self.reader = crops.CropReader(folder)
+        self.image_names = [os.path.relpath(path, folder) for path in self.image_paths]
+
+    def read_image(self, i):
+        return self.reader.read(self.image_names[i])
+
+
 def get_training_augmentation():
     train_transform = [
         album.OneOf(
@@ -188,6 +374,17 @@ def get_test_augmentation():
     return album.Compose(test_transform)
 
 
+def preprocess_input(x, **kwargs):
+    """
+    Normalize an RGB image for the encoder, the same computation as the function
+    of smp.encoders.get_preprocessing_fn, without importing smp.
+    """
+    if x.max() > 1:
+        x = x / 255.0
+    x = x - np.array(ENCODER_MEAN)
+    return x / np.array(ENCODER_STD)
+
+
 def to_tensor(x, **kwargs):
     return x.transpose(2, 0, 1).astype("float32")
 
@@ -208,28 +405,11 @@ def get_preprocessing(preprocessing_fn=None):
     return album.Compose(_transform)
 
 
-def create_clear_folder(folder):
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-    files_temp = [
-        os.path.relpath(os.path.join(root, file), folder)
-        for root, _, files in os.walk(folder)
-        for file in files
-        if (file.endswith(".PNG") or file.endswith(".png")) and not file.startswith(".")
-    ]
-    if len(files_temp) > 0:
-        for items in files_temp:
-            os.remove(os.path.join(folder, items))
-
-
-def generate_metafile(image_path_crop, label_path_crop):
-    subimage_list = [
-        os.path.relpath(os.path.join(root, file), image_path_crop)
-        for root, _, files in os.walk(image_path_crop)
-        for file in files
-        if (file.endswith(".PNG") or file.endswith(".png")) and not file.startswith(".")
-    ]
+def get_metadata(image_path_crop, label_path_crop, image_names=None):
+    # the cropped frames, listed from the crop folder when not given
+    subimage_list = image_names
+    if subimage_list is None:
+        subimage_list = analysis.list_images(image_path_crop)
 
     metadata_row = []
     for i in range(len(subimage_list)):
@@ -237,135 +417,1047 @@ def generate_metafile(image_path_crop, label_path_crop):
         label_path_i = os.path.join(label_path_crop, subimage_list[i])
         metadata_row.append([str(i + 1), image_path_i, label_path_i])
 
-    metadata_file = "./model/metadata_tem.csv"
-
     header = ["image_id", "image_path", "label_colored_path"]
-    with open(metadata_file, "w") as csvfile:
-        writer = csv.writer(csvfile, lineterminator="\n")
-        writer.writerow([g for g in header])
-        for x in range(len(metadata_row)):
-            writer.writerow(metadata_row[x])
-    return metadata_file
+    return pd.DataFrame(metadata_row, columns=header)
 
 
-def get_model(species):
+def get_class_rgb_values(model_folder="./model"):
+    """RGB values of the background and root classes, in the order of the class keys."""
+    class_dict = pd.read_csv(os.path.join(model_folder, "label_class_dict_lr.csv"))
+    class_names = class_dict["name"].tolist()
+    class_rgb_values = class_dict[["r", "g", "b"]].values.tolist()
+
+    select_classes = ["background", "root"]
+    select_class_indices = [class_names.index(cls.lower()) for cls in select_classes]
+    return np.array(class_rgb_values)[select_class_indices]
+
+
+def get_model(species, model_folder="./model"):
     model_dict = {
-        "Arabidopsis": "./model/arabidopsis_model",
-        "Rice": "./model/rice_seminal_model",
-        "Soybean": "./model/soybean_sorghum_model",
-        "Sorghum": "./model/soybean_sorghum_model",
+        "Arabidopsis": "arabidopsis_model",
+        "Rice": "rice_seminal_model",
+        "Soybean": "soybean_sorghum_model",
+        "Sorghum": "soybean_sorghum_model",
     }
-    model = model_dict[species]
+    model = os.path.join(model_folder, model_dict[species])
     return model
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Segmentation Model Training Pipeline")
-    parser.add_argument(
-        "--experiment", required=True, help="Experimental design folder path"
-    )
-    parser.add_argument("--species", required=True, help="Plant species")
+def collate_predictions(samples):
+    """Keep a batch as a list of samples; frames are stacked by shape later."""
+    return samples
 
-    args = parser.parse_args()
 
-    experiment = args.experiment
-    species = args.species
+def synchronize(device):
+    """Wait for the kernels queued on a GPU, so that they are timed where they run."""
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
 
-    # get the model based on species
-    model_name = get_model(species)
-    print(f"model_name: {model_name}")
 
-    # get paths and master data
-    image_path = os.path.join("./images", experiment)
-    save_path = os.path.join("./Segmentation", experiment)
+def predict_batch(model, images, device, timings=None):
+    """
+    Run the model on a list of preprocessed CHW images.
+    Images with the same shape are stacked into a single forward pass.
+    # Returns
+        A list of 2D arrays of class keys, in the order of the input images.
+    """
+    timings = {} if timings is None else timings
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(image.shape, []).append(i)
+
+    pred_masks = [None] * len(images)
+    for indices in groups.values():
+        with instrument.timed(timings, "forward"):
+            x_tensor = torch.from_numpy(np.stack([images[i] for i in indices])).to(
+                device
+            )
+            logits = model(x_tensor)
+            synchronize(device)
+        with instrument.timed(timings, "argmax"):
+            pred = logits.argmax(dim=1).cpu().numpy()
+        for i, pred_mask in zip(indices, pred):
+            pred_masks[i] = pred_mask
+    return pred_masks
+
+
+def get_subpath(path_name):
+    """Path of a cropped image relative to the crop folder."""
+    path_parts = path_name.split("/")
+    index = path_parts.index("crop")
+    return "/".join(path_parts[index + 1 :])
+
+
+def get_mask_name(path_name):
+    """Path of the mask of a cropped image relative to the segmentation folder."""
+    names = path_name.rsplit("/", 1)[-1].split(".")[0]
+    return os.path.join(os.path.dirname(get_subpath(path_name)), f"{names}.png")
+
+
+def get_cache_config(
+    augmentation,
+    class_rgb_values,
+    layer_boundary,
+    tile_size=0,
+    tile_overlap=64,
+    inference_precision="fp32",
+    channels_last=False,
+    mask_format="rgb",
+):
+    """Settings of a run that change the masks, part of the cache key of every frame."""
+    return {
+        "encoder": ENCODER,
+        "encoder_weights": ENCODER_WEIGHTS,
+        "augmentation": album.to_dict(augmentation),
+        "tiles": [tile_size, tile_overlap] if tile_size else None,
+        "class_rgb_values": class_rgb_values.tolist(),
+        "layer_boundary": layer_boundary,
+        "precision": inference_precision,
+        "channels_last": channels_last,
+        "mask_format": mask_format,
+    }
 
-    master_data_csv = [
-        file
-        for file in os.listdir(image_path)
-        if (file.endswith(".csv") and not file.startswith("."))
-    ]
-    master_data = pd.read_csv(os.path.join(image_path, master_data_csv[0]))
 
-    DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def get_uncached_frames(seg_cache, dataset, model_hash, config):
+    """
+    Look up every frame of a dataset in the segmentation cache.
+    # Returns
+        The indices of the frames to segment and the cache key of every mask
+    """
+    keys = {}
+    indices = []
+    for i, path_name in enumerate(dataset.image_paths):
+        source_path, bbox = dataset.get_source(i)
+        mask_name = get_mask_name(path_name)
+        source_hash = seg_cache.source_hash(mask_name, source_path)
+        keys[mask_name] = cache.get_frame_key(source_hash, model_hash, bbox, config)
+        if not seg_cache.is_cached(mask_name, keys[mask_name]):
+            indices.append(i)
+    return indices, keys
+
+
+def predict_dataset(
+    model,
+    dataset,
+    mask_store,
+    device,
+    batch_size=1,
+    num_workers=0,
+    progress=None,
+    tile_size=0,
+    tile_overlap=64,
+    tile_batch_size=4,
+    frame_traits=None,
+    report=None,
+    io_threads=0,
+    queue_depth=2,
+):
+    """Segment every image of a PredictionDataset and save the masks.
 
-    # load best saved model checkpoint from the current run
-    if os.path.exists(f"{model_name}.pth"):
-        best_model = torch.load(f"{model_name}.pth", map_location=DEVICE)
-        print("Loaded UNet model from this run.")
+    Args:
+        model (torch.nn.Module): trained segmentation model
+        dataset (PredictionDataset): dataset with validation augmentation and preprocessing
+        mask_store (masks.MaskStore): store to save the predicted masks in
+        device (torch.device): device to run the model on
+        batch_size (int): number of frames per forward pass
+        num_workers (int): number of worker processes decoding and preprocessing frames
+        progress (callable): called with (frames done, total frames) after each batch
+        tile_size (int): run the model on tiles of this size instead of whole frames, 0 to disable
+        tile_overlap (int): number of pixels shared by neighbouring tiles
+        tile_batch_size (int): number of tiles per forward pass
+        frame_traits (analysis.FrameTraits): also measure the traits of the masks,
+            at the layer boundary the dataset detects
+        report (instrument.RunReport): report to add the time of every step to
+        io_threads (int): threads decoding frames ahead (without num_workers) and
+            writing masks while the model runs, 0 to do both in turn with inference
+        queue_depth (int): batches decoded ahead, and batches of masks waiting to
+            be written, with io_threads
+
+    Returns:
+        list: (path_name, layer_ind) of every segmented image
+    """
+    if io_threads and not num_workers:
+        loader = prefetch.PrefetchLoader(dataset, batch_size, io_threads, queue_depth)
     else:
+        loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=False,
+            num_workers=num_workers,
+            collate_fn=collate_predictions,
+        )
+    writer = mask_store
+    if io_threads:
+        writer = prefetch.MaskWriter(mask_store, io_threads, queue_depth * batch_size)
+    report = report or instrument.RunReport("predict")
+    frames = []
+    model.eval()
+    with torch.inference_mode():
+        batches = iter(loader)
+        while True:
+            # the time the model waits for the next batch to be decoded
+            timings = {}
+            with instrument.timed(timings, "input_wait"):
+                batch = next(batches, None)
+            if batch is None:
+                break
+            images = [sample[0] for sample in batch]
+            if tile_size:
+                pred_masks = tiling.predict_tiled_batch(
+                    model,
+                    images,
+                    device,
+                    tile_size,
+                    tile_overlap,
+                    tile_batch_size,
+                    timings=timings,
+                )
+            else:
+                pred_masks = predict_batch(model, images, device, timings)
+            for (
+                _,
+                names,
+                path_name,
+                true_dimensions,
+                layer_ind,
+                sample_timings,
+            ), pred_mask in zip(batch, pred_masks):
+                report.add_timings(sample_timings)
+                with instrument.timed(timings, "argmax"):
+                    pred_mask = crop_image(pred_mask, true_dimensions)["image"]
+                with instrument.timed(timings, "write_wait" if io_threads else "write"):
+                    writer.write(get_mask_name(path_name), pred_mask)
+                if frame_traits is not None:
+                    with instrument.timed(timings, "traits"):
+                        frame_traits.add(get_subpath(path_name), pred_mask, layer_ind)
+                frames.append((path_name, layer_ind))
+            report.add_timings(timings, items=len(batch))
+            if progress:
+                progress(len(frames), len(dataset))
+    if io_threads:
+        timings = {}
+        with instrument.timed(timings, "write_wait"):
+            writer.close()
+        report.add_timings(timings, items=0)
+        report.add_timings(writer.timings, items=len(frames))
+    return frames
+
+
+def get_sample_indices(n_frames, n_samples):
+    """Indices of n_samples frames spread evenly over a dataset."""
+    return np.unique(np.linspace(0, n_frames - 1, n_samples).astype(int)).tolist()
+
+
+def compare_precision(
+    reference, model, dataset, indices, device, select_class_rgb_values
+):
+    """Segment sample frames with the fp32 and reduced precision models and compare them."""
+    dataset.layer_boundary = True
+    samples = [dataset[i] for i in indices]
+    layer_inds = pd.Series([sample[4] for sample in samples])
+    layer_inds = layer_inds.fillna(layer_inds.median())
+
+    rows = []
+    with torch.inference_mode():
+        for (image, names, path_name, true_dimensions, _, _), layer_ind in zip(
+            samples, layer_inds
+        ):
+            reference_image, seg_image = [
+                colour_code_segmentation(
+                    crop_image(predict_batch(m, [image], device)[0], true_dimensions)[
+                        "image"
+                    ],
+                    select_class_rgb_values,
+                ).astype("uint8")
+                for m in (reference, model)
+            ]
+            rows.append(
+                precision.compare_frame(
+                    get_mask_name(path_name), layer_ind, reference_image, seg_image
+                )
+            )
+    return pd.DataFrame(rows)
+
+
+def get_checkpoint_source(checkpoint):
+    """What a TorchScript copy of a checkpoint was made from."""
+    st = os.stat(checkpoint)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "torch": torch.__version__}
+
+
+def get_script_source(script_path):
+    """What a TorchScript copy looks like on disk, to tell it was not replaced since."""
+    st = os.stat(script_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def save_scripted_model(model, script_path, source):
+    """Trace a model and save it with the checkpoint it was traced from."""
+    device = next(model.parameters()).device
+    model.eval()
+    with torch.no_grad():
+        # the traced convolutions and upsamplings run on frames of any size
+        traced = torch.jit.trace(model, torch.zeros(1, 3, 64, 64, device=device))
+    # shards, batch runs and the service may trace the same checkpoint at once
+    suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        torch.jit.save(traced, f"{script_path}.{suffix}")
+        os.replace(f"{script_path}.{suffix}", script_path)
+    finally:
+        if os.path.exists(f"{script_path}.{suffix}"):
+            os.remove(f"{script_path}.{suffix}")
+    # the sidecar is only written once the copy is complete
+    source = dict(source, script=get_script_source(script_path))
+    with open(f"{script_path}.json.{suffix}", "w") as f:
+        json.dump(source, f)
+    os.replace(f"{script_path}.json.{suffix}", f"{script_path}.json")
+
+
+def load_model(model_name, device, scripted=False):
+    """
+    Load the model checkpoint of a species.
+    # Arguments
+        scripted: load the TorchScript copy of the checkpoint, <model>.ts, which
+            does not need segmentation_models_pytorch to be imported. It is
+            traced and saved on first use, and again when the checkpoint or
+            torch changes. A TorchScript model cannot be quantized to int8.
+
+    # Returns
+        The model, a torch.nn.Module, or a torch.jit.ScriptModule with scripted.
+    """
+    checkpoint = f"{model_name}.pth"
+    if not os.path.exists(checkpoint):
         raise ValueError("Model not available!")
 
-    # crop images
-    bbox = {
-        "Fast": (350, 56, 1024, 1024),
-        "Slow": (520, 56, 1024, 1024),
-        "Main": (540, 56, 1024, 1024),  # MainScanner 2025
-        # "Main": (590, 56, 1024, 1024),# MainScanner 2024
-    }
-    image_path_crop = os.path.join(save_path, "crop")
-    crop_images_folder(bbox, master_data, image_path, image_path_crop)
+    script_path = f"{model_name}.ts"
+    if scripted:
+        source = get_checkpoint_source(checkpoint)
+        saved_source = None
+        if os.path.exists(f"{script_path}.json") and os.path.exists(script_path):
+            with open(f"{script_path}.json") as f:
+                saved_source = json.load(f)
+            # a copy replaced after its sidecar was written is traced again
+            source["script"] = get_script_source(script_path)
+        if saved_source == source:
+            try:
+                best_model = torch.jit.load(script_path, map_location=device)
+                print("Loaded TorchScript UNet model.")
+                return best_model
+            except RuntimeError as e:
+                print(f"Could not load the TorchScript model, tracing it again: {e}")
+        source.pop("script", None)
 
-    # generate metedata file
-    metadata_file = generate_metafile(image_path_crop, image_path_crop)
+    # load best saved model checkpoint from the current run
+    best_model = torch.load(checkpoint, map_location=device)
+    print("Loaded UNet model from this run.")
+    if scripted:
+        try:
+            save_scripted_model(best_model, script_path, source)
+        except (OSError, RuntimeError) as e:
+            # e.g. a read-only model folder; the checkpoint is loaded next time too
+            print(f"Could not save the TorchScript model: {e}")
+    return best_model
+
+
+def time_startup(
+    species, device=None, model_folder="./model", report=None, scripted=False
+):
+    """
+    Time what runs before the first frame: the imports, loading the model as
+    segment_experiment does and a first forward pass on a blank frame.
+    # Returns
+        The run report of the startup.
+    """
+    if report is None:
+        report = instrument.RunReport("startup", {"species": species})
+    instrument.add_startup(report, IMPORT_START, IMPORT_SECONDS)
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    with report.stage("load_model"):
+        model = load_model(get_model(species, model_folder), device, scripted=scripted)
+    with report.stage("first_forward", 1):
+        model.eval()
+        with torch.inference_mode():
+            predict_batch(model, [np.zeros((3, 1024, 1024), "float32")], device)
+    return report
+
+
+def add_cached_traits(frame_traits, seg_cache, seg_folder, path_names):
+    """Measure the frames not measured yet from their saved masks."""
+    mask_reader = masks.MaskReader(seg_folder)
+    for path_name in path_names:
+        if get_subpath(path_name) not in frame_traits:
+            mask_name = get_mask_name(path_name)
+            frame_traits.add(
+                get_subpath(path_name),
+                mask_reader.read(mask_name),
+                seg_cache.get_layer_ind(mask_name),
+            )
+    mask_reader.close()
+
+
+def segment_experiment(
+    experiment,
+    species,
+    best_model=None,
+    device=None,
+    batch_size=1,
+    num_workers=0,
+    stream=False,
+    save_crops=False,
+    force=False,
+    progress=None,
+    inference_precision="fp32",
+    channels_last=False,
+    compare_frames=0,
+    tile_size=0,
+    tile_overlap=64,
+    tile_batch_size=4,
+    mask_format="rgb",
+    export_colour=False,
+    image_root="./images",
+    save_root="./Segmentation",
+    model_folder="./model",
+    write_csv=True,
+    traits=False,
+    report=None,
+    shard=None,
+    io_threads=0,
+    queue_depth=2,
+    sample_tolerance=0,
+    sample_stride=8,
+    crop_format="png",
+    cpu_replicas=0,
+    replica_threads=0,
+    scripted=False,
+):
+    """Crop and segment the images of an experiment.
 
-    # set up segmentation patch folder
-    sample_preds_folder = os.path.join(save_path, "Segmentation")
-    create_clear_folder(sample_preds_folder)
+    Args:
+        experiment (str): experiment folder under image_root, e.g. genetic_diversity/Arabidopsis
+        species (str): plant species, selects the model
+        best_model (torch.nn.Module): model of the species, loaded when None
+        device (torch.device): device to run the model on
+        batch_size (int): number of frames per forward pass
+        num_workers (int): number of worker processes decoding and preprocessing frames
+        stream (bool): crop the raw frames in memory instead of writing crop images
+        save_crops (bool): with stream, also write the crop images
+        force (bool): clear the segmentation cache and segment every frame
+        progress (callable): called with (frames done, total frames) after each batch
+        inference_precision (str): "fp32", "bf16" or "int8", see precision.PRECISIONS
+        channels_last (bool): run the model in the channels_last memory format
+        compare_frames (int): only compare the precision against fp32 on this many frames
+        tile_size (int): run the model on tiles of this size instead of whole frames, 0 to disable
+        tile_overlap (int): number of pixels shared by neighbouring tiles
+        tile_batch_size (int): number of tiles, from one or several frames, per forward pass
+        mask_format (str): "rgb", "gray" or "bits", see masks.MASK_FORMATS
+        export_colour (bool): also save colour coded PNGs to Segmentation_colour
+        image_root (str): folder of the raw images and master data of the experiments
+        save_root (str): folder the crops, masks and analysis of the experiments are saved to
+        model_folder (str): folder of the model checkpoints and class dictionary
+        write_csv (bool): save the layer index, traits and precision comparison as CSV files
+        traits (bool): measure the traits of the masks right after inference
+        report (instrument.RunReport): report the stages are timed in, saved to
+            run_report_segment.json with write_csv
+        shard (tuple): (i, N), only segment the plants of the i-th of N shards,
+            with a cache manifest of its own and the layer index and traits
+            saved to analysis/shards for analysis.merge_shards
+        io_threads (int): threads decoding frames and writing masks while the
+            model runs, see predict_dataset
+        queue_depth (int): batches decoded ahead and batches of masks waiting
+            to be written with io_threads
+        sample_tolerance (float): segment the frames of each plant in rounds,
+            until the confidence interval of its mean ratios is within this
+            fraction of the mean, see sampling.FrameSampler; implies traits
+        sample_stride (int): the first round takes every sample_stride-th frame
+        crop_format (str): without stream, save the crops as "png" files or as
+            one memory-mapped "stack" per plant, see crops.py
+        cpu_replicas (int): segment on the CPU in this many processes, each
+            with a replica of the model, see replicas.ReplicaPool; "auto" tunes
+            it on the first frames; 0 segments in this process
+        replica_threads (int): torch threads and cores of each replica, by
+            default the cores divided by the replicas
+        scripted (bool): load the TorchScript copy of the model, see load_model;
+            int8 always loads the checkpoint
+
+    Returns:
+        dict: number of frames, of segmented (not cached) frames and of evicted
+        masks, the run report ("report"), with stream or traits the layer index
+        DataFrame ("layer_index"), with traits the traits DataFrame ("traits")
+        and with sample_tolerance the frames used per plant ("sampling")
+    """
+    # the rounds of frames are chosen from the traits measured so far
+    traits = traits or bool(sample_tolerance)
+    if shard is not None and mask_format == "none":
+        # merge_shards measures the frames without a layer from their masks
+        raise ValueError("Shards need the masks, choose another mask format")
+
+    # get the model based on species
+    model_name = get_model(species, model_folder)
+    print(f"model_name: {model_name}")
+
+    # get paths and master data
+    image_path = os.path.join(image_root, experiment)
+    save_path = os.path.join(save_root, experiment)
+    master_data = analysis.read_master_data(image_path)
+
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        if cpu_replicas:
+            device = torch.device("cpu")
+    if cpu_replicas and device.type != "cpu":
+        raise ValueError("Model replicas run on the CPU, not on " + str(device))
+    if report is None:
+        report = instrument.RunReport(
+            "segment",
+            {
+                "experiment": experiment,
+                "species": species,
+                "device": str(device),
+                "batch_size": batch_size,
+                "num_workers": num_workers,
+                "stream": stream,
+                "precision": inference_precision,
+                "channels_last": channels_last,
+                "tile_size": tile_size,
+                "mask_format": mask_format,
+                "traits": traits,
+                "shard": shard,
+                "io_threads": io_threads,
+                "queue_depth": queue_depth,
+                "sample_tolerance": sample_tolerance,
+                "crop_format": crop_format,
+                "cpu_replicas": cpu_replicas,
+                "scripted": scripted,
+            },
+        )
+    # model replicas load the model in their own processes
+    load = not cpu_replicas or compare_frames > 0
+    if best_model is None and not load and not os.path.exists(f"{model_name}.pth"):
+        raise ValueError("Model not available!")
+    if best_model is None and load:
+        with report.stage("load_model"):
+            # int8 quantizes the modules of the checkpoint
+            best_model = load_model(
+                model_name, device, scripted=scripted and inference_precision != "int8"
+            )
+
+    # list and crop images
+    bbox = SCANNER_BBOX
+    image_path_crop = os.path.join(save_path, "crop")
+    with report.stage("scan") as counter:
+        # only the folders that changed since the last run are listed
+        frames = catalog.get_frames(image_path, save_path, master_data, full=force)
+        crop_df = get_crop_metadata(
+            bbox, master_data, image_path, image_path_crop, frames
+        )
+        crop_df = select_shard(crop_df, image_path_crop, shard)
+        counter["items"] = len(crop_df)
+    if not stream:
+        with report.stage("crop") as counter:
+            counter["items"] = crop_frames(crop_df, image_path_crop, crop_format)
 
     # setup model parameters
-    ENCODER = "resnet101"
-    ENCODER_WEIGHTS = "imagenet"
-    preprocessing_fn = smp.encoders.get_preprocessing_fn(ENCODER, ENCODER_WEIGHTS)
+    preprocessing_fn = preprocess_input
 
     # check the color
-    class_dict = pd.read_csv("./model/label_class_dict_lr.csv")
-    class_names = class_dict["name"].tolist()
-    class_rgb_values = class_dict[["r", "g", "b"]].values.tolist()
+    select_class_rgb_values = get_class_rgb_values(model_folder)
 
-    select_classes = ["background", "root"]
-    select_class_indices = [class_names.index(cls.lower()) for cls in select_classes]
-    select_class_rgb_values = np.array(class_rgb_values)[select_class_indices]
+    # set up segmentation patch folder
+    sample_preds_folder = os.path.join(save_path, "Segmentation")
+    colour_folder = None
+    if export_colour:
+        colour_folder = os.path.join(save_path, "Segmentation_colour")
+    mask_store = masks.get_mask_store(
+        sample_preds_folder, mask_format, select_class_rgb_values, colour_folder
+    )
+    manifest_name = cache.MANIFEST_NAME
+    if shard is not None:
+        manifest_name = "manifest_{}of{}.json".format(*shard)
+    seg_cache = cache.SegmentationCache(sample_preds_folder, mask_store, manifest_name)
+    if force:
+        # remove the masks of the manifest, those of other shards are kept
+        seg_cache.evict(set())
+        mask_store.close()
+    if not os.path.exists(sample_preds_folder):
+        os.makedirs(sample_preds_folder)
+
+    if tile_size:
+        if tile_size % 32 or not 0 <= tile_overlap < tile_size:
+            raise ValueError(
+                "The tile size must be divisible by 32 and larger than the overlap"
+            )
+        augmentation = tiling.get_tiled_augmentation(tile_size)
+    else:
+        augmentation = get_validation_augmentation()
 
     # setup dataset
-    metadata_df = pd.read_csv(metadata_file)
-    test_dataset = PredictionDataset(
-        metadata_df,
-        augmentation=get_validation_augmentation(),
-        preprocessing=get_preprocessing(preprocessing_fn),
-        class_rgb_values=select_class_rgb_values,
+    if stream:
+        # crop in memory and detect the layer boundary from the same crop
+        test_dataset = CropDataset(
+            crop_df,
+            save_crops=save_crops,
+            augmentation=augmentation,
+            preprocessing=get_preprocessing(preprocessing_fn),
+            class_rgb_values=select_class_rgb_values,
+            layer_boundary=True,
+        )
+    elif crop_format == "stack":
+        # the crops are views of the memory-mapped stacks, nothing is decoded
+        test_dataset = StackDataset(
+            crop_df,
+            image_path_crop,
+            augmentation=augmentation,
+            preprocessing=get_preprocessing(preprocessing_fn),
+            class_rgb_values=select_class_rgb_values,
+            layer_boundary=traits,
+        )
+    else:
+        image_names = [
+            os.path.relpath(path, image_path_crop) for path in crop_df["image_path"]
+        ]
+        metadata_df = get_metadata(image_path_crop, image_path_crop, image_names)
+        test_dataset = PredictionDataset(
+            metadata_df,
+            augmentation=augmentation,
+            preprocessing=get_preprocessing(preprocessing_fn),
+            class_rgb_values=select_class_rgb_values,
+            layer_boundary=traits,
+        )
+
+    # set up the inference precision, calibrating int8 on frames across the experiment
+    inference_model = None
+    if load:
+        calibration_images = None
+        if inference_precision == "int8":
+            calibration_images = [
+                test_dataset[i][0] for i in get_sample_indices(len(test_dataset), 8)
+            ]
+        inference_model = precision.get_inference_model(
+            best_model,
+            device,
+            precision=inference_precision,
+            channels_last=channels_last,
+            calibration_images=calibration_images,
+        )
+
+    if compare_frames > 0:
+        comparison_df = compare_precision(
+            best_model,
+            inference_model,
+            test_dataset,
+            get_sample_indices(len(test_dataset), compare_frames),
+            device,
+            select_class_rgb_values,
+        )
+        if write_csv:
+            analysis.save_csv(
+                comparison_df, save_path, f"precision_{inference_precision}.csv"
+            )
+        summary = precision.summarize_comparison(comparison_df)
+        print(f"{inference_precision} against fp32:\n{summary}")
+        return summary.to_dict()
+
+    # only segment the frames without a cached mask
+    cache_config = get_cache_config(
+        augmentation,
+        select_class_rgb_values,
+        test_dataset.layer_boundary,
+        tile_size,
+        tile_overlap,
+        inference_precision,
+        channels_last,
+        mask_format,
     )
-    test_dataset_vis = PredictionDataset(
-        metadata_df,
-        class_rgb_values=select_class_rgb_values,
+    with report.stage("cache", len(test_dataset)):
+        model_hash = seg_cache.model_hash(f"{model_name}.pth")
+        indices, keys = get_uncached_frames(
+            seg_cache, test_dataset, model_hash, cache_config
+        )
+        evicted = seg_cache.evict(keys)
+    print(
+        f"Segmenting {len(indices)} of {len(test_dataset)} frames "
+        f"({len(test_dataset) - len(indices)} cached, {len(evicted)} evicted)"
     )
 
     # predict patch segmentation
-    for idx in range(len(test_dataset)):
-        image, names, path_name = test_dataset[idx]
-        image_vis = test_dataset_vis[idx][0].astype("uint8")
-        true_dimensions = image_vis.shape
-        x_tensor = torch.from_numpy(image).to(DEVICE).unsqueeze(0)
-        # Predict test image
-        pred_mask = best_model(x_tensor)
-        pred_mask = pred_mask.detach().squeeze().cpu().numpy()
-        # Convert pred_mask from `CHW` format to `HWC` format
-        pred_mask = np.transpose(pred_mask, (1, 2, 0))
-        # Get prediction channel corresponding to foreground
-        pred_mask = crop_image(
-            colour_code_segmentation(
-                reverse_one_hot(pred_mask), select_class_rgb_values
-            ),
-            true_dimensions,
-        )["image"]
-        # get the subfolder name
-        path_parts = path_name.split("/")
-        index = path_parts.index("crop")
-        subfolder = "/".join(path_parts[index + 1 : -1])
-
-        save_path = os.path.join(sample_preds_folder, subfolder)
-        if not os.path.exists(save_path):
-            os.makedirs(save_path)
-        cv2.imwrite(os.path.join(save_path, f"{names}.png"), pred_mask)
+    frame_traits = analysis.FrameTraits() if traits else None
+    sampler = None
+    rounds = [list(range(len(test_dataset)))]
+    if sample_tolerance:
+        frame_names = [get_subpath(path_name) for path_name in test_dataset.image_paths]
+        rounds = sampler = sampling.FrameSampler(
+            frame_names,
+            [
+                analysis.get_layer_index_row(image_path_crop, frame_name, np.nan)["plant"]
+                for frame_name in frame_names
+            ],
+            sample_tolerance,
+            sample_stride,
+            measure_all=lambda image_name: not analysis.has_layer(image_name),
+        )
+    uncached = set(indices)
+    segmented = 0
+    with report.stage("inference", len(indices)) as counter:
+        replica_pool = None
+        if cpu_replicas and indices:
+            replica_options = {
+                "batch_size": batch_size,
+                "tile_size": tile_size,
+                "tile_overlap": tile_overlap,
+                "tile_batch_size": tile_batch_size,
+                "inference_precision": inference_precision,
+                "channels_last": channels_last,
+                "mask_format": mask_format,
+                "class_rgb_values": select_class_rgb_values,
+                "seg_folder": sample_preds_folder,
+                "colour_folder": colour_folder,
+                "traits": traits,
+                "scripted": scripted,
+            }
+            # replicas may write the same plant unless its masks are buffered
+            thread_safe = getattr(mask_store, "thread_safe", True)
+            workers, threads = cpu_replicas, replica_threads
+            if cpu_replicas == "auto":
+                (workers, threads), frames = replicas.tune_replicas(
+                    model_name,
+                    test_dataset,
+                    replica_options,
+                    indices,
+                    frame_traits,
+                    report,
+                    thread_safe=thread_safe,
+                )
+                # the warmup frames are segmented already
+                positions = {path: i for i, path in enumerate(test_dataset.image_paths)}
+                for path_name, layer_ind in frames:
+                    mask_name = get_mask_name(path_name)
+                    seg_cache.update(mask_name, keys[mask_name], layer_ind)
+                    uncached.discard(positions[path_name])
+                segmented += len(frames)
+            threads = threads or max(len(replicas.get_cores()) // workers, 1)
+            print(f"Segmenting with {workers} replicas of {threads} threads")
+            replica_pool = replicas.ReplicaPool(
+                model_name,
+                test_dataset,
+                replica_options,
+                workers,
+                threads,
+                thread_safe,
+            )
+        try:
+            for round_indices in rounds:
+                round_uncached = [i for i in round_indices if i in uncached]
+                # save the manifest every few frames, so an interrupted run
+                # keeps the masks segmented so far
+                for start in range(0, len(round_uncached), CACHE_SAVE_FRAMES):
+                    chunk = round_uncached[start : start + CACHE_SAVE_FRAMES]
+                    chunk_progress = progress and (
+                        lambda done, total, start=start: progress(
+                            start + done, len(round_uncached)
+                        )
+                    )
+                    if replica_pool is not None:
+                        frames, _ = replica_pool.predict(
+                            chunk, frame_traits, report, chunk_progress
+                        )
+                    else:
+                        frames = predict_dataset(
+                            inference_model,
+                            torch.utils.data.Subset(test_dataset, chunk),
+                            mask_store,
+                            device,
+                            batch_size=batch_size,
+                            num_workers=num_workers,
+                            progress=chunk_progress,
+                            tile_size=tile_size,
+                            tile_overlap=tile_overlap,
+                            tile_batch_size=tile_batch_size,
+                            frame_traits=frame_traits,
+                            report=report,
+                            io_threads=io_threads,
+                            queue_depth=queue_depth,
+                        )
+                    for path_name, layer_ind in frames:
+                        mask_name = get_mask_name(path_name)
+                        seg_cache.update(mask_name, keys[mask_name], layer_ind)
+                    # the manifest only lists masks that are on disk
+                    mask_store.close()
+                    seg_cache.save()
+                segmented += len(round_uncached)
+                if sampler is not None:
+                    # measure the cached frames of the round before choosing the next
+                    mask_store.close()
+                    add_cached_traits(
+                        frame_traits,
+                        seg_cache,
+                        sample_preds_folder,
+                        [test_dataset.image_paths[i] for i in round_indices],
+                    )
+                    sampler.update(frame_traits.traits)
+        finally:
+            if replica_pool is not None:
+                replica_pool.close()
+        mask_store.close()
+        seg_cache.save()
+        counter["items"] = segmented
+    # the frames that make up the tables
+    selected = sampler.selected if sampler is not None else range(len(test_dataset))
+
+    result = {
+        "frames": len(test_dataset),
+        "segmented": segmented,
+        "evicted": len(evicted),
+    }
+    analysis_folder = None
+    if write_csv:
+        analysis_folder = os.path.join(save_path, "analysis")
+        if shard is not None:
+            analysis_folder = analysis.get_shard_folder(analysis_folder, shard)
+        if (stream or traits) and not os.path.exists(analysis_folder):
+            os.makedirs(analysis_folder)
+    if stream or traits:
+        # save the layer index for analysis.py, which has no crops to read
+        rows = [
+            analysis.get_layer_index_row(
+                image_path_crop,
+                get_subpath(path_name),
+                seg_cache.get_layer_ind(get_mask_name(path_name)),
+            )
+            for path_name in [test_dataset.image_paths[i] for i in selected]
+        ]
+        if shard is not None:
+            result["layer_index"] = analysis.get_shard_layer_index(rows, analysis_folder)
+        else:
+            result["layer_index"] = analysis.get_layer_index_table(
+                rows, analysis_folder
+            )
+
+    if traits:
+        with report.stage("traits_table", len(selected)):
+            # measure the cached frames from their saved masks
+            add_cached_traits(
+                frame_traits,
+                seg_cache,
+                sample_preds_folder,
+                [test_dataset.image_paths[i] for i in selected],
+            )
+            result["traits"] = frame_traits.get_traits(
+                result["layer_index"], analysis_folder
+            )
+        if sampler is not None:
+            result["sampling"] = sampler.get_summary()
+            print(
+                f"Used {len(selected)} of {len(test_dataset)} frames, "
+                f"{int(result['sampling']['converged'].sum())} of "
+                f"{len(result['sampling'])} plants converged"
+            )
+    # without sampling, drop the frames used by an earlier sampled run: analysis.py
+    # would only analyse the frames of its layer index
+    analysis.save_sampling(result.get("sampling"), analysis_folder)
+
+    result["report"] = report.to_dict()
+    if write_csv:
+        report_name = "run_report_segment.json"
+        if shard is not None:
+            report_name = "run_report_segment_{}of{}.json".format(*shard)
+        report.save(os.path.join(save_path, report_name))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segmentation Model Training Pipeline")
+    parser.add_argument(
+        "--experiment", required=True, help="Experimental design folder path"
+    )
+    parser.add_argument("--species", required=True, help="Plant species")
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Number of frames per forward pass"
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes decoding and preprocessing frames",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Crop raw frames in memory and feed them straight into the model",
+    )
+    parser.add_argument(
+        "--cpu-replicas",
+        type=replicas.parse_replicas,
+        default=0,
+        metavar="N|auto",
+        help="Segment on the CPU in N processes, each with a replica of the model pinned to its own cores; auto times a few splits of the cores on the first frames",
+    )
+    parser.add_argument(
+        "--replica-threads",
+        type=int,
+        default=0,
+        help="With --cpu-replicas N, torch threads and cores of each replica (default the cores divided by N)",
+    )
+    parser.add_argument(
+        "--scripted",
+        action="store_true",
+        help="Load a TorchScript copy of the model, traced and saved next to the checkpoint on first use (faster start, not with --precision int8)",
+    )
+    parser.add_argument(
+        "--timing-startup",
+        action="store_true",
+        help="Only time the imports, the model loading and a first forward pass, and save them to run_report_startup.json",
+    )
+    parser.add_argument(
+        "--crop-format",
+        default="png",
+        choices=crops.CROP_FORMATS,
+        help="Save the crops as one PNG per frame or as one memory-mapped stack per plant",
+    )
+    parser.add_argument(
+        "--save-crops",
+        action="store_true",
+        help="With --stream, also write the cropped images to Segmentation/<experiment>/crop",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Clear the segmentation cache and segment every frame again",
+    )
+    parser.add_argument(
+        "--precision",
+        default="fp32",
+        choices=precision.PRECISIONS,
+        help="Inference precision: fp32, bf16 autocast or int8 quantized encoder (CPU)",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="Run the model in the channels_last memory format",
+    )
+    parser.add_argument(
+        "--compare-precision",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Only compare --precision against fp32 on N frames and report the drift",
+    )
+    parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=0,
+        help="Segment tiles of this size (divisible by 32) instead of whole frames",
+    )
+    parser.add_argument(
+        "--tile-overlap",
+        type=int,
+        default=64,
+        help="Number of pixels shared by neighbouring tiles",
+    )
+    parser.add_argument(
+        "--tile-batch-size",
+        type=int,
+        default=4,
+        help="Number of tiles, from one or several frames, per forward pass",
+    )
+    parser.add_argument(
+        "--mask-format",
+        default="rgb",
+        choices=masks.MASK_FORMATS,
+        help="Colour coded PNG, single channel PNG, bit-packed per-plant NPZ masks or no masks",
+    )
+    parser.add_argument(
+        "--export-colour",
+        action="store_true",
+        help="Also save colour coded PNGs to Segmentation/<experiment>/Segmentation_colour",
+    )
+    parser.add_argument(
+        "--traits",
+        action="store_true",
+        help="Measure the traits right after inference and save Segmentation/<experiment>/analysis/traits.csv",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Show the number of frames segmented, the throughput and the time left",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=0,
+        help="Threads decoding frames (without --num-workers) and writing masks while the model runs",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=2,
+        help="With --io-threads, number of batches decoded ahead and of batches of masks waiting to be written",
+    )
+    parser.add_argument(
+        "--sample-tolerance",
+        type=float,
+        default=0,
+        help="Stop segmenting a plant once the 95%% confidence interval of its mean ratios is within this fraction of the mean (implies --traits)",
+    )
+    parser.add_argument(
+        "--sample-stride",
+        type=int,
+        default=8,
+        help="With --sample-tolerance, segment every N-th frame of each plant first",
+    )
+    parser.add_argument(
+        "--shard",
+        type=analysis.parse_shard,
+        metavar="i/N",
+        help="Only segment the plants of the i-th of N shards, see analysis.py --merge",
+    )
+
+    args = parser.parse_args()
+
+    if args.timing_startup:
+        report = time_startup(
+            args.species,
+            report=instrument.RunReport("startup", vars(args)),
+            scripted=args.scripted,
+        )
+        save_path = os.path.join("./Segmentation", args.experiment)
+        os.makedirs(save_path, exist_ok=True)
+        report.save(os.path.join(save_path, "run_report_startup.json"))
+        report.print_summary()
+        return
+
+    report = instrument.RunReport("segment", vars(args))
+    instrument.add_startup(report, IMPORT_START, IMPORT_SECONDS)
+    segment_experiment(
+        args.experiment,
+        args.species,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        stream=args.stream,
+        save_crops=args.save_crops,
+        force=args.force,
+        inference_precision=args.precision,
+        channels_last=args.channels_last,
+        compare_frames=args.compare_precision,
+        tile_size=args.tile_size,
+        tile_overlap=args.tile_overlap,
+        tile_batch_size=args.tile_batch_size,
+        mask_format=args.mask_format,
+        export_colour=args.export_colour,
+        traits=args.traits,
+        progress=instrument.Progress("segment") if args.progress else None,
+        report=report,
+        shard=args.shard,
+        io_threads=args.io_threads,
+        queue_depth=args.queue_depth,
+        sample_tolerance=args.sample_tolerance,
+        sample_stride=args.sample_stride,
+        crop_format=args.crop_format,
+        cpu_replicas=args.cpu_replicas,
+        replica_threads=args.replica_threads,
+        scripted=args.scripted,
+    )
+    report.print_summary()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,378 @@
+"""Resident segmentation service that keeps the species models loaded between jobs.
+
+Start the service from the repository root, then submit experiments to it:
+
+    python src/segment_service.py serve --port 8765 --max-models 2
+    python src/segment_service.py submit --experiment genetic_diversity/Arabidopsis --species Arabidopsis
+
+Jobs run one at a time; each job streams its progress back as JSON lines.
+"""
+
+import os, json, sys, threading, time
+import argparse
+from collections import OrderedDict
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import crops
+import masks
+
+
+JOB_OPTIONS = [
+    "batch_size",
+    "num_workers",
+    "stream",
+    "save_crops",
+    "force",
+    "inference_precision",
+    "channels_last",
+    "tile_size",
+    "tile_overlap",
+    "tile_batch_size",
+    "mask_format",
+    "export_colour",
+    "traits",
+    "shard",
+    "io_threads",
+    "queue_depth",
+    "sample_tolerance",
+    "sample_stride",
+    "crop_format",
+    "cpu_replicas",
+    "replica_threads",
+]
+
+
+class ModelCache:
+    """Least recently used cache of loaded models.
+
+    Args:
+        max_models (int): maximum number of models kept in memory
+        device (torch.device): device to load the models on
+    """
+
+    def __init__(self, max_models, device):
+        self.max_models = max_models
+        self.device = device
+        self.models = OrderedDict()
+
+    def get(self, species):
+        import segment
+
+        model_name = segment.get_model(species)
+        # reload the model when its checkpoint changes
+        checkpoint = f"{model_name}.pth"
+        mtime = os.stat(checkpoint).st_mtime_ns if os.path.exists(checkpoint) else None
+        key = (model_name, mtime)
+        if key in self.models:
+            self.models.move_to_end(key)
+        else:
+            for cached_key in [k for k in self.models if k[0] == model_name]:
+                del self.models[cached_key]
+            self.models[key] = segment.load_model(model_name, self.device)
+            while len(self.models) > self.max_models:
+                self.models.popitem(last=False)
+        return self.models[key]
+
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+    """POST /segment runs a job, GET /status lists the loaded models."""
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_event(self, event, **fields):
+        line = json.dumps({"event": event, **fields}) + "\n"
+        try:
+            self.wfile.write(line.encode())
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # keep the job running when the client goes away
+            pass
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        self.send_json(
+            200,
+            {
+                "models": [model_name for model_name, _ in self.server.models.models],
+                "busy": self.server.job_lock.locked(),
+            },
+        )
+
+    def do_POST(self):
+        import segment
+
+        if self.path != "/segment":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length))
+            if not isinstance(job, dict):
+                raise TypeError(
+                    f"the job must be a JSON object, not {type(job).__name__}"
+                )
+            experiment = job["experiment"]
+            species = job["species"]
+            options = {k: job[k] for k in JOB_OPTIONS if k in job}
+            for option, choices in [
+                ("inference_precision", segment.precision.PRECISIONS),
+                ("mask_format", masks.MASK_FORMATS),
+                ("crop_format", crops.CROP_FORMATS),
+            ]:
+                if option in options and options[option] not in choices:
+                    raise ValueError(f"{option} must be one of {choices}")
+            if options.get("shard"):
+                options["shard"] = segment.analysis.parse_shard(options["shard"])
+            if options.get("cpu_replicas"):
+                options["cpu_replicas"] = segment.replicas.parse_replicas(
+                    options["cpu_replicas"]
+                )
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {"error": f"invalid job: {e!r}"})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        self.send_event("queued", experiment=experiment, species=species)
+        with self.server.job_lock:
+            start = time.time()
+            self.send_event("start")
+            try:
+                # model replicas run on the CPU and load the model themselves
+                best_model = device = None
+                if not options.get("cpu_replicas"):
+                    best_model = self.server.models.get(species)
+                    device = self.server.models.device
+                result = segment.segment_experiment(
+                    experiment,
+                    species,
+                    best_model=best_model,
+                    device=device,
+                    progress=lambda done, total: self.send_event(
+                        "progress", done=done, total=total
+                    ),
+                    **options,
+                )
+            except Exception as e:
+                self.send_event("error", message=repr(e))
+                return
+            # the tables of --stream and --traits jobs are saved next to the analysis
+            result.pop("layer_index", None)
+            result.pop("traits", None)
+            result.pop("sampling", None)
+            self.send_event("done", seconds=round(time.time() - start, 3), **result)
+
+
+def serve(host, port, max_models):
+    # only the service needs torch; submitting a job stays lightweight
+    import torch
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    server = ThreadingHTTPServer((host, port), SegmentationHandler)
+    server.models = ModelCache(max_models, device)
+    server.job_lock = threading.Lock()
+    print(f"Segmentation service listening on http://{host}:{port}")
+    server.serve_forever()
+
+
+def submit(host, port, job):
+    """Send a job to the service and print its progress; returns False on error."""
+    connection = HTTPConnection(host, port)
+    connection.request(
+        "POST",
+        "/segment",
+        body=json.dumps(job),
+        headers={"Content-Type": "application/json"},
+    )
+    response = connection.getresponse()
+    if response.status != 200:
+        print(response.read().decode())
+        return False
+    ok = False
+    for line in response:
+        event = json.loads(line)
+        print(json.dumps(event), flush=True)
+        ok = event["event"] == "done"
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident segmentation service")
+    parser.add_argument("--host", default="127.0.0.1", help="Address of the service")
+    parser.add_argument("--port", type=int, default=8765, help="Port of the service")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Start the service")
+    serve_parser.add_argument(
+        "--max-models",
+        type=int,
+        default=2,
+        help="Maximum number of species models kept in memory",
+    )
+
+    submit_parser = subparsers.add_parser("submit", help="Segment an experiment")
+    submit_parser.add_argument(
+        "--experiment", required=True, help="Experimental design folder path"
+    )
+    submit_parser.add_argument("--species", required=True, help="Plant species")
+    submit_parser.add_argument(
+        "--batch-size", type=int, default=1, help="Number of frames per forward pass"
+    )
+    submit_parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes decoding and preprocessing frames",
+    )
+    submit_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Crop raw frames in memory and feed them straight into the model",
+    )
+    submit_parser.add_argument(
+        "--save-crops",
+        action="store_true",
+        help="With --stream, also write the cropped images",
+    )
+    submit_parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Clear the segmentation cache and segment every frame again",
+    )
+    submit_parser.add_argument(
+        "--precision",
+        default="fp32",
+        help="Inference precision: fp32, bf16 autocast or int8 quantized encoder (CPU); checked by the service, which imports torch",
+    )
+    submit_parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        help="Run the model in the channels_last memory format",
+    )
+    submit_parser.add_argument(
+        "--tile-size",
+        type=int,
+        default=0,
+        help="Segment tiles of this size (divisible by 32) instead of whole frames",
+    )
+    submit_parser.add_argument(
+        "--tile-overlap",
+        type=int,
+        default=64,
+        help="Number of pixels shared by neighbouring tiles",
+    )
+    submit_parser.add_argument(
+        "--tile-batch-size",
+        type=int,
+        default=4,
+        help="Number of tiles, from one or several frames, per forward pass",
+    )
+    submit_parser.add_argument(
+        "--crop-format",
+        default="png",
+        choices=crops.CROP_FORMATS,
+        help="Save the crops as one PNG per frame or as one memory-mapped stack per plant",
+    )
+    submit_parser.add_argument(
+        "--mask-format",
+        default="rgb",
+        choices=masks.MASK_FORMATS,
+        help="Colour coded PNG, single channel PNG, bit-packed per-plant NPZ masks or no masks",
+    )
+    submit_parser.add_argument(
+        "--export-colour",
+        action="store_true",
+        help="Also save colour coded PNGs to Segmentation/<experiment>/Segmentation_colour",
+    )
+    submit_parser.add_argument(
+        "--traits",
+        action="store_true",
+        help="Measure the traits right after inference and save Segmentation/<experiment>/analysis/traits.csv",
+    )
+    submit_parser.add_argument(
+        "--shard",
+        metavar="i/N",
+        help="Only segment the plants of the i-th of N shards",
+    )
+    submit_parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=0,
+        help="Threads decoding frames and writing masks while the model runs",
+    )
+    submit_parser.add_argument(
+        "--queue-depth",
+        type=int,
+        default=2,
+        help="With --io-threads, number of batches decoded ahead and of batches of masks waiting to be written",
+    )
+    submit_parser.add_argument(
+        "--cpu-replicas",
+        default=0,
+        metavar="N|auto",
+        help="Segment on the CPU in N processes with a replica of the model each",
+    )
+    submit_parser.add_argument(
+        "--replica-threads",
+        type=int,
+        default=0,
+        help="With --cpu-replicas N, torch threads and cores of each replica",
+    )
+    submit_parser.add_argument(
+        "--sample-tolerance",
+        type=float,
+        default=0,
+        help="Stop segmenting a plant once the 95%% confidence interval of its mean ratios is within this fraction of the mean",
+    )
+    submit_parser.add_argument(
+        "--sample-stride",
+        type=int,
+        default=8,
+        help="With --sample-tolerance, segment every N-th frame of each plant first",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.host, args.port, args.max_models)
+    else:
+        job = {
+            "experiment": args.experiment,
+            "species": args.species,
+            "batch_size": args.batch_size,
+            "num_workers": args.num_workers,
+            "stream": args.stream,
+            "save_crops": args.save_crops,
+            "force": args.force,
+            "inference_precision": args.precision,
+            "channels_last": args.channels_last,
+            "tile_size": args.tile_size,
+            "tile_overlap": args.tile_overlap,
+            "tile_batch_size": args.tile_batch_size,
+            "mask_format": args.mask_format,
+            "crop_format": args.crop_format,
+            "cpu_replicas": args.cpu_replicas,
+            "replica_threads": args.replica_threads,
+            "export_colour": args.export_colour,
+            "traits": args.traits,
+            "shard": args.shard,
+            "io_threads": args.io_threads,
+            "queue_depth": args.queue_depth,
+            "sample_tolerance": args.sample_tolerance,
+            "sample_stride": args.sample_stride,
+        }
+        sys.exit(0 if submit(args.host, args.port, job) else 1)
+
+
+if __name__ == "__main__":
+    main()
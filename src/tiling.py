@@ -0,0 +1,130 @@
+import numpy as np
+import torch
+import albumentations as album
+
+import instrument
+
+
+def get_tiled_augmentation(tile_size):
+    # pad small crops to at least one tile, the tile size is divisible by 32
+    test_transform = [
+        album.PadIfNeeded(
+            min_height=tile_size,
+            min_width=tile_size,
+            always_apply=True,
+            border_mode=0,
+            value=(0, 0, 0),
+        ),
+    ]
+    return album.Compose(test_transform)
+
+
+def get_tile_starts(length, tile_size, overlap):
+    """Start of every tile along one axis; the last tile ends at the border."""
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
+
+
+def get_tile_weight(tile_size, overlap):
+    """
+    Blending weight of the logits of a tile.
+    # Returns
+        A (tile_size, tile_size) tensor that is 1 in the centre and ramps down
+        linearly across the overlap, so seams between tiles blend smoothly.
+    """
+    ramp = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 1) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+    return torch.from_numpy(np.outer(ramp, ramp))
+
+
+def predict_tiled_batch(
+    model, images, device, tile_size=512, overlap=64, tile_batch_size=4, timings=None
+):
+    """
+    Run the model on a list of preprocessed CHW images tile by tile.
+    Tiles of all images share the forward passes. The logits of an image are
+    blended in a band one tile high, and each band of rows is reduced to class
+    keys as soon as its last tile is in, so peak memory depends on the tile
+    size, the tile batch size and the image width instead of the image size.
+    # Arguments
+        model: segmentation model
+        images: preprocessed CHW images, at least tile_size in both dimensions
+        device: device to run the model on
+        tile_size: height and width of a tile, divisible by 32
+        overlap: number of pixels shared by neighbouring tiles
+        tile_batch_size: number of tiles per forward pass
+        timings: dict the "forward" and "argmax" times are added to
+
+    # Returns
+        A list of 2D arrays of class keys, in the order of the input images.
+    """
+    row_starts = [
+        get_tile_starts(image.shape[1], tile_size, overlap) for image in images
+    ]
+    col_starts = [
+        get_tile_starts(image.shape[2], tile_size, overlap) for image in images
+    ]
+    # tiles of an image are in row order, so a band is final once its row is done
+    tiles = [
+        (i, r, x)
+        for i in range(len(images))
+        for r in range(len(row_starts[i]))
+        for x in col_starts[i]
+    ]
+    weight = get_tile_weight(tile_size, overlap).to(device)
+
+    timings = {} if timings is None else timings
+    bands = {}
+    row_remaining = [len(starts) for starts in col_starts]
+    pred_masks = [None] * len(images)
+    for k in range(0, len(tiles), tile_batch_size):
+        chunk = tiles[k : k + tile_batch_size]
+        with instrument.timed(timings, "forward"):
+            x_tensor = torch.from_numpy(
+                np.stack(
+                    [
+                        images[i][
+                            :,
+                            row_starts[i][r] : row_starts[i][r] + tile_size,
+                            x : x + tile_size,
+                        ]
+                        for i, r, x in chunk
+                    ]
+                )
+            ).to(device)
+            logits = model(x_tensor) * weight
+        for (i, r, x), tile_logits in zip(chunk, logits):
+            if i not in bands:
+                bands[i] = torch.zeros(
+                    (tile_logits.shape[0], tile_size, images[i].shape[2]),
+                    device=device,
+                )
+                pred_masks[i] = np.empty(images[i].shape[1:], dtype=np.int64)
+            bands[i][:, :, x : x + tile_size] += tile_logits
+            row_remaining[i] -= 1
+            if row_remaining[i] > 0:
+                continue
+            # the rows above the next tile row get no more logits; the weights
+            # are positive, so the argmax of the weighted sum is the argmax of
+            # the blended logits
+            y = row_starts[i][r]
+            last = r + 1 == len(row_starts[i])
+            height = tile_size if last else row_starts[i][r + 1] - y
+            with instrument.timed(timings, "argmax"):
+                pred_masks[i][y : y + height] = (
+                    bands[i][:, :height].argmax(dim=0).cpu().numpy()
+                )
+            if last:
+                del bands[i]
+            else:
+                bands[i] = torch.cat(
+                    [bands[i][:, height:], torch.zeros_like(bands[i][:, :height])],
+                    dim=1,
+                )
+                row_remaining[i] = len(col_starts[i])
+    return pred_masks
@@ -0,0 +1,575 @@
+"""Segment and analyse an experiment while it is being scanned.
+
+    python src/watch.py --experiment genetic_diversity/Arabidopsis --species Arabidopsis
+
+polls images/<experiment> every --interval seconds. The frames added since the
+last poll, once their files have not changed for --settle seconds, are cropped
+in memory, segmented and measured as segment.py --stream --traits does; frames
+seen before are never read again. Every --refresh-interval seconds the layer
+index, the traits and the frame and plant summaries of analysis.py are saved to
+Segmentation/<experiment>/analysis.
+
+The frame filters of analysis.py (0 upper roots, 0 bottom roots and the z-score
+of the ratios) only look at the frames of one plant, so a refresh filters the
+plants with new frames again and keeps the summary rows of the others. The
+plant filter then runs on the summary, one row per plant. The running count,
+mean and standard deviation of the ratios of every plant and treatment are
+kept as the frames come in and saved to traits_running_summary.csv.
+
+Frames without a layer are measured at the median boundary of the experiment
+so far, and measured again from their masks when the median moves, so the
+tables match what analysis.py --from-traits gives for the frames scanned.
+"""
+
+import os, math, time
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+
+import analysis
+import cache
+import catalog
+import instrument
+import masks
+import segment
+from catalog import SCANNER_BBOX
+
+
+RUNNING_COLUMNS = ["root_count_ratio", "root_area_ratio"]
+
+
+class RunningStats:
+    """Count, mean and variance of a stream of values (Welford's algorithm).
+
+    Values can be taken out again, e.g. when a frame is measured again.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        if self.count <= 1:
+            self.__init__()
+            return
+        delta = value - self.mean
+        self.mean -= delta / (self.count - 1)
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+        self.count -= 1
+
+    def get_std(self, ddof=0):
+        """Standard deviation, by default of the population as the z-score filters use it."""
+        if self.count <= ddof:
+            return np.nan
+        return math.sqrt(self.m2 / (self.count - ddof))
+
+
+class ExperimentWatch:
+    """Frames of an experiment segmented and measured as they are scanned.
+
+    Args:
+        experiment (str): experiment folder under image_root, e.g. genetic_diversity/Arabidopsis
+        species (str): plant species, selects the model
+        best_model (torch.nn.Module): model of the species, loaded when None
+        device (torch.device): device to run the model on
+        batch_size (int): number of frames per forward pass
+        num_workers (int): number of worker processes decoding and preprocessing frames
+        mask_format (str): "rgb", "gray" or "bits", see masks.MASK_FORMATS; the
+            masks are needed to measure the frames without a layer again
+        settle (float): seconds a frame file must be left unchanged before it is read
+        plant_group (str): master data column the plants are grouped by
+        z_score_threshold (float): z-score above which frames and plants are outliers
+        zero_bottom_threshold (float): plants with less than this fraction of
+            frames with 0 bottom_root_count lose these frames
+        restart (bool): ignore the traits saved by a previous run and measure
+            every frame again, from its mask when it is cached
+        image_root (str): folder of the raw images and master data of the experiments
+        save_root (str): folder the masks and analysis of the experiments are saved to
+        model_folder (str): folder of the model checkpoints and class dictionary
+        scripted (bool): load the TorchScript copy of the model, see segment.load_model
+    """
+
+    def __init__(
+        self,
+        experiment,
+        species,
+        best_model=None,
+        device=None,
+        batch_size=1,
+        num_workers=0,
+        mask_format="rgb",
+        settle=10,
+        plant_group="trt",
+        z_score_threshold=2,
+        zero_bottom_threshold=0.5,
+        restart=False,
+        image_root="./images",
+        save_root="./Segmentation",
+        model_folder="./model",
+        scripted=False,
+    ):
+        if mask_format == "none":
+            raise ValueError("Watching needs the masks, choose another mask format")
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.settle = settle
+        self.plant_group = plant_group
+        self.z_score_threshold = z_score_threshold
+        self.zero_bottom_threshold = zero_bottom_threshold
+
+        self.image_path = os.path.join(image_root, experiment)
+        self.save_path = os.path.join(save_root, experiment)
+        self.image_path_crop = os.path.join(self.save_path, "crop")
+        self.seg_folder = os.path.join(self.save_path, "Segmentation")
+        self.analysis_folder = os.path.join(self.save_path, "analysis")
+        for folder in [self.seg_folder, self.analysis_folder]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+        self.device = device or torch.device(
+            "cuda" if torch.cuda.is_available() else "cpu"
+        )
+        self.report = instrument.RunReport(
+            "watch",
+            {
+                "experiment": experiment,
+                "species": species,
+                "device": str(self.device),
+                "batch_size": batch_size,
+                "mask_format": mask_format,
+                "settle": settle,
+            },
+        )
+        model_name = segment.get_model(species, model_folder)
+        if best_model is None:
+            with self.report.stage("load_model"):
+                best_model = segment.load_model(
+                    model_name, self.device, scripted=scripted
+                )
+        self.model = best_model
+
+        # the masks are cached as segment.py --stream caches them, so either
+        # can pick up the frames of the other
+        self.class_rgb_values = segment.get_class_rgb_values(model_folder)
+        self.augmentation = segment.get_validation_augmentation()
+        self.mask_store = masks.get_mask_store(
+            self.seg_folder, mask_format, self.class_rgb_values
+        )
+        self.seg_cache = cache.SegmentationCache(self.seg_folder, self.mask_store)
+        self.model_hash = self.seg_cache.model_hash(f"{model_name}.pth")
+        self.cache_config = segment.get_cache_config(
+            self.augmentation, self.class_rgb_values, True, mask_format=mask_format
+        )
+
+        # image name -> layer index row, traits and the layer they were measured at
+        self.frames = {}
+        self.skipped = set()
+        self.waiting = 0
+        self.read_master_data()
+        self.plant_stats = {}
+        self.group_stats = {}
+        self.summaries = {}
+        self.changed = set()
+        if not restart:
+            self.load_traits()
+
+    def load_traits(self):
+        """Take up the frames of the traits.csv left by a previous run."""
+        if not os.path.exists(os.path.join(self.analysis_folder, "traits.csv")):
+            return
+        traits_df = analysis.read_traits(self.analysis_folder)
+        trait_columns = [
+            column
+            for column in traits_df.columns
+            if column not in ["image_name", "plant", "frame", "layer_ind", "plant_layer_ind"]
+        ]
+        for row in traits_df.to_dict("records"):
+            layer_ind = row["layer_ind"]
+            traits = {column: row[column] for column in trait_columns}
+            if all(pd.isna(value) for value in traits.values()):
+                traits = None
+            self.add_frame(
+                row["image_name"],
+                layer_ind if analysis.has_layer(row["image_name"]) else np.nan,
+                traits,
+                layer_ind,
+            )
+        print(f"Took up {len(self.frames)} frames measured before")
+
+    def read_master_data(self):
+        master_data = analysis.read_master_data(self.image_path)
+        self.groups = {}
+        for barcode, group in zip(master_data["barcode"], master_data[self.plant_group]):
+            self.groups.setdefault(barcode, group)
+        return master_data
+
+    def get_group(self, plant):
+        # plants are linked to the master data by name, as get_statistics_plants does
+        return self.groups.get(os.path.basename(plant))
+
+    def update_stats(self, plant, traits, sign):
+        if traits is None:
+            return
+        stats = [self.plant_stats.setdefault(plant, {})]
+        group = self.get_group(plant)
+        if group is not None and not pd.isna(group):
+            stats.append(self.group_stats.setdefault(group, {}))
+        for column in RUNNING_COLUMNS:
+            value = traits.get(column, np.nan)
+            if not np.isfinite(value):
+                continue
+            for column_stats in stats:
+                running = column_stats.setdefault(column, RunningStats())
+                if sign > 0:
+                    running.add(value)
+                else:
+                    running.remove(value)
+
+    def set_traits(self, image_name, traits, layer_ind):
+        frame = self.frames[image_name]
+        plant = frame["row"]["plant"]
+        self.update_stats(plant, frame["traits"], -1)
+        frame["traits"] = traits
+        frame["measured_at"] = layer_ind
+        self.update_stats(plant, traits, 1)
+        self.changed.add(plant)
+
+    def add_frame(self, image_name, layer_ind, traits, measured_at=np.nan):
+        row = analysis.get_layer_index_row(self.image_path_crop, image_name, layer_ind)
+        self.frames[image_name] = {"row": row, "traits": None, "measured_at": np.nan}
+        self.set_traits(image_name, traits, measured_at if traits is not None else np.nan)
+
+    def remove_frame(self, image_name):
+        frame = self.frames[image_name]
+        self.update_stats(frame["row"]["plant"], frame["traits"], -1)
+        self.changed.add(frame["row"]["plant"])
+        del self.frames[image_name]
+
+    def is_settled(self, raw_path):
+        try:
+            mtime = os.stat(raw_path).st_mtime
+        except FileNotFoundError:
+            return False
+        return time.time() - mtime >= self.settle
+
+    def poll(self):
+        """
+        Segment and measure the frames added since the last poll.
+        # Returns
+            The number of frames added or removed.
+        """
+        with self.report.stage("scan") as counter:
+            # plants may be added to the master data during the experiment
+            master_data = self.read_master_data()
+            frames = catalog.get_frames(self.image_path, self.save_path, master_data)
+            removed = set(self.frames) - set(frames["image_name"])
+            for image_name in removed:
+                self.remove_frame(image_name)
+
+            frames = frames[~frames["image_name"].isin(self.frames)]
+            # frames without a scanner are reported once and segmented as soon
+            # as their plant is added to the master data
+            unmatched = frames.loc[
+                ~frames["scanner"].isin(list(SCANNER_BBOX)), "image_name"
+            ]
+            frames = frames[~frames["image_name"].isin(self.skipped & set(unmatched))]
+            self.skipped = set(unmatched)
+            crop_df = segment.get_crop_metadata(
+                SCANNER_BBOX, master_data, self.image_path, self.image_path_crop, frames
+            )
+            settled = np.array(
+                [self.is_settled(raw_path) for raw_path in crop_df["raw_path"]],
+                dtype=bool,
+            )
+            self.waiting = int((~settled).sum())
+            crop_df = crop_df[settled].reset_index(drop=True)
+            counter["items"] = len(crop_df)
+        if len(crop_df):
+            self.segment_frames(crop_df)
+        return len(crop_df) + len(removed)
+
+    def segment_frames(self, crop_df):
+        dataset = segment.CropDataset(
+            crop_df,
+            augmentation=self.augmentation,
+            preprocessing=segment.get_preprocessing(segment.preprocess_input),
+            class_rgb_values=self.class_rgb_values,
+            layer_boundary=True,
+        )
+        with self.report.stage("cache", len(dataset)):
+            indices, keys = segment.get_uncached_frames(
+                self.seg_cache, dataset, self.model_hash, self.cache_config
+            )
+        print(f"Segmenting {len(indices)} new frames ({len(dataset) - len(indices)} cached)")
+
+        frame_traits = analysis.FrameTraits()
+        with self.report.stage("inference", len(indices)):
+            frames = segment.predict_dataset(
+                self.model,
+                torch.utils.data.Subset(dataset, indices),
+                self.mask_store,
+                self.device,
+                batch_size=self.batch_size,
+                num_workers=self.num_workers,
+                frame_traits=frame_traits,
+                report=self.report,
+            )
+            for path_name, layer_ind in frames:
+                mask_name = segment.get_mask_name(path_name)
+                self.seg_cache.update(mask_name, keys[mask_name], layer_ind)
+            self.mask_store.close()
+            self.seg_cache.save()
+
+        with self.report.stage("measure", len(dataset)):
+            segment.add_cached_traits(
+                frame_traits, self.seg_cache, self.seg_folder, dataset.image_paths
+            )
+            for path_name in dataset.image_paths:
+                image_name = segment.get_subpath(path_name)
+                layer_ind = self.seg_cache.get_layer_ind(segment.get_mask_name(path_name))
+                # the frames without a layer wait for the median of the experiment
+                self.add_frame(
+                    image_name, layer_ind, frame_traits.traits.get(image_name), layer_ind
+                )
+
+    def measure_layerless(self, ind_df):
+        """Measure the frames without a layer whose filled in layer index moved."""
+        mask_reader = None
+        frame_traits = analysis.FrameTraits()
+        for image_name, layer_ind in zip(ind_df["image_name"], ind_df["layer_ind"]):
+            frame = self.frames[image_name]
+            if (
+                not np.isnan(frame["row"]["layer_ind"])
+                or np.isnan(layer_ind)
+                or layer_ind == frame["measured_at"]
+            ):
+                continue
+            if mask_reader is None:
+                mask_reader = masks.MaskReader(self.seg_folder)
+            mask_name = segment.get_mask_name(os.path.join(self.image_path_crop, image_name))
+            frame_traits.add(image_name, mask_reader.read(mask_name), layer_ind)
+            self.set_traits(image_name, frame_traits.traits.pop(image_name), layer_ind)
+        if mask_reader is not None:
+            mask_reader.close()
+
+    def get_plant_summary(self, plant_df):
+        """Frame summary row of a plant, filtered as run_analysis filters the frames."""
+        remove_0 = analysis.remove_frame_outlier_0_upper(plant_df, False, None)
+        df_filtered, _ = analysis.remove_frame_outlier_0_bottom(
+            remove_0, self.zero_bottom_threshold, None
+        )
+        return analysis.get_statistics_frames(
+            df_filtered, None, self.z_score_threshold
+        )[2]
+
+    def get_running_summary(self):
+        """Count, mean and standard deviation of the ratios of every plant and group."""
+        rows = []
+        for group, all_stats in [
+            ("plant", self.plant_stats),
+            (self.plant_group, self.group_stats),
+        ]:
+            for name in sorted(all_stats, key=str):
+                row = {"group": group, "name": name}
+                for column in RUNNING_COLUMNS:
+                    running = all_stats[name].get(column, RunningStats())
+                    row[f"{column}_frames"] = running.count
+                    row[f"{column}_mean"] = running.mean if running.count else np.nan
+                    row[f"{column}_std"] = running.get_std()
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    def refresh(self):
+        """Save the layer index, traits and summaries of the frames measured so far."""
+        names = sorted(self.frames)
+        with self.report.stage("tables", len(names)):
+            ind_df = analysis.get_layer_index_table(
+                [self.frames[image_name]["row"] for image_name in names],
+                self.analysis_folder,
+            )
+            self.measure_layerless(ind_df)
+            traits_df = ind_df.join(
+                pd.DataFrame(
+                    [self.frames[image_name]["traits"] or {} for image_name in names],
+                    index=ind_df.index,
+                )
+            )
+            analysis.save_csv(traits_df, self.analysis_folder, "traits.csv")
+            # the traits cover every frame scanned, see segment.py --sample-tolerance
+            analysis.save_sampling(None, self.analysis_folder)
+
+        with self.report.stage("stats", len(self.changed)):
+            for plant in self.changed:
+                self.summaries.pop(plant, None)
+            changed_df = traits_df[traits_df["plant"].isin(self.changed)]
+            for plant, plant_df in changed_df.groupby("plant"):
+                summary = self.get_plant_summary(plant_df)
+                if len(summary):
+                    self.summaries[plant] = summary
+            self.changed = set()
+
+            # summary rows in the order of the plants, as get_statistics_frames sorts them
+            frames_summary = pd.DataFrame()
+            if self.summaries:
+                frames_summary = pd.concat(
+                    [self.summaries[plant] for plant in sorted(self.summaries)],
+                    ignore_index=True,
+                )
+                analysis.save_csv(
+                    frames_summary,
+                    self.analysis_folder,
+                    "traits_filteredframes_summary.csv",
+                )
+                analysis.get_statistics_plants(
+                    self.analysis_folder,
+                    self.read_master_data(),
+                    self.plant_group,
+                    self.z_score_threshold,
+                    data=frames_summary,
+                )
+            analysis.save_csv(
+                self.get_running_summary(),
+                self.analysis_folder,
+                "traits_running_summary.csv",
+            )
+        self.report.save(os.path.join(self.save_path, "run_report_watch.json"))
+        print(
+            f"Saved the summaries of {len(frames_summary)} plants, "
+            f"{len(names)} frames measured"
+        )
+
+    def run(self, interval=30, refresh_interval=60, idle_exit=0, once=False):
+        """
+        Poll the image folder until interrupted.
+        # Arguments
+            interval: seconds between polls
+            refresh_interval: seconds between the saves of the tables, when
+                frames were added or removed
+            idle_exit: stop after this many seconds without new frames, 0 to
+                keep watching
+            once: poll once, waiting for the frames that are still being
+                written, save the tables and stop
+        """
+        last_change = last_refresh = time.time()
+        pending = bool(self.changed)
+        try:
+            while True:
+                if self.poll():
+                    last_change = time.time()
+                    pending = True
+                now = time.time()
+                if pending and now - last_refresh >= refresh_interval:
+                    self.refresh()
+                    last_refresh = now
+                    pending = False
+                if self.waiting:
+                    # frames still being written count as activity
+                    last_change = now
+                    print(f"Waiting for {self.waiting} frames being written")
+                elif once or (idle_exit and now - last_change >= idle_exit):
+                    break
+                time.sleep(min(interval, self.settle) if self.waiting else interval)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        if pending:
+            self.refresh()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Segment and analyse the frames of an experiment as they are scanned"
+    )
+    parser.add_argument(
+        "--experiment", required=True, help="Experimental design folder path"
+    )
+    parser.add_argument("--species", required=True, help="Plant species")
+    parser.add_argument(
+        "--interval", type=float, default=30, help="Seconds between two polls of the image folder"
+    )
+    parser.add_argument(
+        "--refresh-interval",
+        type=float,
+        default=60,
+        help="Seconds between two saves of the traits and summaries",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=10,
+        help="Seconds a frame file must be left unchanged before it is read",
+    )
+    parser.add_argument(
+        "--idle-exit",
+        type=float,
+        default=0,
+        help="Stop after this many seconds without new frames (default: keep watching)",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Process the frames scanned so far, save the summaries and stop",
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1, help="Number of frames per forward pass"
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes decoding and preprocessing frames",
+    )
+    parser.add_argument(
+        "--mask-format",
+        default="rgb",
+        choices=[mask_format for mask_format in masks.MASK_FORMATS if mask_format != "none"],
+        help="Format of the masks, see segment.py --mask-format",
+    )
+    parser.add_argument(
+        "--z-score-threshold",
+        type=float,
+        default=2,
+        help="Frames and plants with a ratio further than this many standard deviations from their group mean are outliers",
+    )
+    parser.add_argument(
+        "--scripted",
+        action="store_true",
+        help="Load a TorchScript copy of the model, see segment.py --scripted",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Measure every frame again instead of taking up the traits.csv of the last run",
+    )
+    args = parser.parse_args()
+
+    watch = ExperimentWatch(
+        args.experiment,
+        args.species,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        mask_format=args.mask_format,
+        settle=args.settle,
+        z_score_threshold=args.z_score_threshold,
+        restart=args.restart,
+        scripted=args.scripted,
+    )
+    watch.run(
+        interval=args.interval,
+        refresh_interval=0 if args.once else args.refresh_interval,
+        idle_exit=args.idle_exit,
+        once=args.once,
+    )
+    watch.report.print_summary()
+
+
+if __name__ == "__main__":
+    main()
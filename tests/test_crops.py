@@ -0,0 +1,111 @@
+import os
+
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+import cache
+import crops
+import masks
+import segment
+
+
+@pytest.fixture
+def crop_df(tmp_path):
+    rng = np.random.default_rng(0)
+    rows = []
+    for plant in ["PLANTA", "PLANTB"]:
+        os.makedirs(tmp_path / "images" / plant)
+        for frame in range(1, 4):
+            raw_path = str(tmp_path / "images" / plant / f"{frame}.png")
+            cv2.imwrite(raw_path, rng.integers(0, 256, (40, 60, 3), dtype=np.uint8))
+            st = os.stat(raw_path)
+            rows.append(
+                [
+                    str(tmp_path / "crop" / plant / f"{frame}.png"),
+                    raw_path,
+                    st.st_size,
+                    st.st_mtime_ns,
+                    5,
+                    10,
+                    30,
+                    20,
+                ]
+            )
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "image_path",
+            "raw_path",
+            "size",
+            "mtime_ns",
+            "startX",
+            "startY",
+            "width",
+            "height",
+        ],
+    )
+
+
+def get_crop_mtimes(crop_df):
+    return [os.stat(path).st_mtime_ns for path in crop_df["image_path"]]
+
+
+def test_unchanged_frames_are_not_cropped_again(tmp_path, crop_df):
+    folder = str(tmp_path / "crop")
+    assert segment.crop_frames(crop_df, folder) == 6
+    image = cv2.imread(crop_df["image_path"][0])
+    raw = cv2.imread(crop_df["raw_path"][0])
+    assert np.array_equal(image, raw[10:30, 5:35])
+    assert crops.list_frames(folder) == [
+        f"{plant}/{frame}.png" for plant in ["PLANTA", "PLANTB"] for frame in range(1, 4)
+    ]
+    mtimes = get_crop_mtimes(crop_df)
+
+    assert segment.crop_frames(crop_df, folder) == 0
+    assert get_crop_mtimes(crop_df) == mtimes
+
+    # a changed raw frame or crop box is cropped again
+    crop_df.loc[1, "mtime_ns"] += 1
+    crop_df.loc[4, "startX"] = 6
+    assert segment.crop_frames(crop_df, folder) == 2
+    assert segment.crop_frames(crop_df, folder) == 0
+
+    # a deleted crop is written again
+    os.remove(crop_df["image_path"][2])
+    assert segment.crop_frames(crop_df, folder) == 1
+
+
+def test_second_run_does_not_rehash_the_crops(tmp_path, crop_df, monkeypatch):
+    folder = str(tmp_path / "crop")
+    seg_folder = str(tmp_path / "Segmentation")
+    mask_store = masks.get_mask_store(seg_folder, "gray", [[0, 0, 0]])
+    segment.crop_frames(crop_df, folder)
+    seg_cache = cache.SegmentationCache(seg_folder, mask_store)
+    hashes = {}
+    for path in crop_df["image_path"]:
+        mask_name = os.path.relpath(path, folder)
+        hashes[mask_name] = seg_cache.source_hash(mask_name, path)
+        seg_cache.update(mask_name, "key")
+    seg_cache.save()
+
+    def file_hash(path):
+        raise AssertionError(f"{path} was hashed again")
+
+    monkeypatch.setattr(cache, "file_hash", file_hash)
+    assert segment.crop_frames(crop_df, folder) == 0
+    seg_cache = cache.SegmentationCache(seg_folder, mask_store)
+    for path in crop_df["image_path"]:
+        mask_name = os.path.relpath(path, folder)
+        assert seg_cache.source_hash(mask_name, path) == hashes[mask_name]
+
+
+def test_switching_to_stacks_removes_the_png_index(tmp_path, crop_df):
+    folder = str(tmp_path / "crop")
+    segment.crop_frames(crop_df, folder)
+    segment.crop_frames(crop_df, folder, crop_format="stack")
+    assert not os.path.exists(tmp_path / "crop" / "PLANTA")
+    # back to PNGs, every frame is cropped again
+    assert segment.crop_frames(crop_df, folder) == 6
+    assert not os.path.exists(tmp_path / "crop" / "PLANTA.npy")
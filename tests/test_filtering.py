@@ -0,0 +1,347 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+stats = pytest.importorskip("scipy.stats")
+
+import analysis
+import filtering
+
+CSV_NAMES = [
+    "removed_0upper.csv",
+    "filtered_72frames_0upper_0bottom.csv",
+    "removed_0bottom.csv",
+    "traits_filteredframes_summary.csv",
+    "traits_filteredplants.csv",
+    "traits_filteredplants_summary.csv",
+]
+
+
+# the outlier filters of analysis.py before the group-wise rewrite
+
+
+def baseline_statistics_frames(df_filtered, save_path):
+    data = df_filtered
+    data = data[~data.isin([np.nan, np.inf, -np.inf]).any(axis=1)]
+
+    z_score_threshold = 2
+    filtered_df_count = pd.DataFrame()
+    filtered_df_area = pd.DataFrame()
+    for name, group in data.groupby("plant"):
+        group = group.dropna()
+        zero_count_mask = group["root_count_ratio"] == 0
+        zero_area_mask = group["root_area_ratio"] == 0
+        if group["root_count_ratio"].std() == 0:
+            outlier_mask_count = pd.Series([False] * len(group), index=group.index)
+        else:
+            z_scores_count = np.abs(stats.zscore(group["root_count_ratio"]))
+            outlier_mask_count = z_scores_count <= z_score_threshold
+        if group["root_area_ratio"].std() == 0:
+            outlier_mask_area = pd.Series([False] * len(group), index=group.index)
+        else:
+            z_scores_area = np.abs(stats.zscore(group["root_area_ratio"]))
+            outlier_mask_area = z_scores_area <= z_score_threshold
+        final_mask_count = outlier_mask_count | zero_count_mask
+        final_mask_area = outlier_mask_area | zero_area_mask
+        filtered_df_count = pd.concat([filtered_df_count, group[final_mask_count]])
+        filtered_df_area = pd.concat([filtered_df_area, group[final_mask_area]])
+    filtered_df_summary_count = (
+        filtered_df_count.groupby("plant")[
+            ["root_count_ratio", "upper_root_count", "bottom_root_count"]
+        ]
+        .agg(
+            root_count_ratio=("root_count_ratio", "mean"),
+            upper_root_count=("upper_root_count", "mean"),
+            bottom_root_count=("bottom_root_count", "mean"),
+            frame_number_count=("root_count_ratio", "size"),
+        )
+        .reset_index()
+    )
+    filtered_df_summary_count = filtered_df_summary_count.rename(
+        columns={"plant": "plant_path"}
+    )
+    filtered_df_summary_area = (
+        filtered_df_area.groupby("plant")[
+            ["root_area_ratio", "upper_area", "bottom_area"]
+        ]
+        .agg(
+            root_area_ratio=("root_area_ratio", "mean"),
+            upper_area=("upper_area", "mean"),
+            bottom_area=("bottom_area", "mean"),
+            frame_number_area=("root_area_ratio", "size"),
+        )
+        .reset_index()
+    )
+    filtered_df_summary_area = filtered_df_summary_area.rename(
+        columns={"plant": "plant_path"}
+    )
+    filtered_df_summary = pd.merge(
+        filtered_df_summary_count,
+        filtered_df_summary_area,
+        on="plant_path",
+        how="outer",
+    )
+    filtered_df_summary.to_csv(
+        os.path.join(save_path, "traits_filteredframes_summary.csv"), index=False
+    )
+    return filtered_df_count, filtered_df_area, filtered_df_summary
+
+
+def baseline_statistics_plants(save_path, master_data, plant_group):
+    data = pd.read_csv(os.path.join(save_path, "traits_filteredframes_summary.csv"))
+    data["plant_name"] = data["plant_path"].apply(lambda x: x.split("/")[-1])
+    data = data.merge(
+        master_data[["barcode", plant_group]],
+        left_on="plant_name",
+        right_on="barcode",
+        how="left",
+    )
+    data = data.drop(columns="barcode")
+
+    z_score_threshold = 2
+    filtered_df_count = pd.DataFrame()
+    filtered_df_area = pd.DataFrame()
+    for name, group in data.groupby(plant_group):
+        group = group.dropna()
+        if group["root_count_ratio"].std() == 0:
+            z_scores_count = pd.Series([0] * len(group), index=group.index)
+        else:
+            z_scores_count = np.abs(stats.zscore(group["root_count_ratio"]))
+        if group["root_area_ratio"].std() == 0:
+            z_scores_area = pd.Series([0] * len(group), index=group.index)
+        else:
+            z_scores_area = np.abs(stats.zscore(group["root_area_ratio"]))
+        outlier_mask_count = (z_scores_count <= z_score_threshold) | (
+            group["root_count_ratio"] == 0
+        )
+        outlier_mask_area = (z_scores_area <= z_score_threshold) | (
+            group["root_area_ratio"] == 0
+        )
+        filtered_df_count = pd.concat([filtered_df_count, group[outlier_mask_count]])
+        filtered_df_area = pd.concat([filtered_df_area, group[outlier_mask_area]])
+    filtered_df_summary_count = (
+        filtered_df_count.dropna(subset=["root_count_ratio"])
+        .groupby(plant_group)[
+            ["root_count_ratio", "upper_root_count", "bottom_root_count"]
+        ]
+        .agg(
+            root_count_ratio_mean=("root_count_ratio", "mean"),
+            upper_root_count_mean=("upper_root_count", "mean"),
+            bottom_root_count_mean=("bottom_root_count", "mean"),
+            plant_number_count=("root_count_ratio", "size"),
+        )
+        .reset_index()
+    )
+    filtered_df_summary_area = (
+        filtered_df_area.groupby(plant_group)[
+            ["root_area_ratio", "upper_area", "bottom_area"]
+        ]
+        .agg(
+            root_area_ratio_mean=("root_area_ratio", "mean"),
+            upper_area_mean=("upper_area", "mean"),
+            bottom_area_mean=("bottom_area", "mean"),
+            plant_number_area=("root_area_ratio", "size"),
+        )
+        .reset_index()
+    )
+    filtered_df = pd.merge(
+        filtered_df_count[
+            [
+                "plant_path",
+                "plant_name",
+                "trt",
+                "root_count_ratio",
+                "upper_root_count",
+                "bottom_root_count",
+                "frame_number_count",
+            ]
+        ],
+        filtered_df_area[
+            [
+                "plant_path",
+                "plant_name",
+                "trt",
+                "root_area_ratio",
+                "upper_area",
+                "bottom_area",
+                "frame_number_area",
+            ]
+        ],
+        on="plant_name",
+        how="outer",
+    )
+    filtered_df["plant_path"] = filtered_df["plant_path_x"].fillna(
+        filtered_df["plant_path_y"]
+    )
+    filtered_df["trt"] = filtered_df["trt_x"].fillna(filtered_df["trt_y"])
+    filtered_df.drop(
+        columns=["plant_path_x", "plant_path_y", "trt_x", "trt_y"],
+        inplace=True,
+    )
+    column_order = ["trt", "plant_name", "plant_path"] + [
+        col
+        for col in filtered_df.columns
+        if col not in ["trt", "plant_name", "plant_path"]
+    ]
+    filtered_df = filtered_df[column_order]
+    filtered_df = filtered_df.sort_values(by="trt", ascending=True)
+    filtered_df.to_csv(os.path.join(save_path, "traits_filteredplants.csv"), index=False)
+    filtered_df_summary = pd.merge(
+        filtered_df_summary_count,
+        filtered_df_summary_area,
+        on=plant_group,
+        how="outer",
+    )
+    filtered_df_summary.to_csv(
+        os.path.join(save_path, "traits_filteredplants_summary.csv"), index=False
+    )
+    return filtered_df_summary_count, filtered_df_summary_area, filtered_df_summary
+
+
+def get_traits_table(seed):
+    """Traits of plants with outliers, equal frames, zeros, single frames and missing ratios."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(40):
+        plant = f"exp/P{i:02d}"
+        n_frames = int(rng.integers(1, 10))
+        kind = i % 8
+        for frame in range(1, n_frames + 1):
+            upper_count = int(rng.integers(0, 12))
+            bottom_count = int(rng.integers(0, 12))
+            upper_area = float(rng.integers(0, 5000))
+            bottom_area = float(rng.integers(0, 5000))
+            if kind == 1:
+                # every frame equal, with ratios that are exact in binary
+                upper_count, bottom_count, upper_area, bottom_area = 4, 2, 800.0, 200.0
+            elif kind == 2:
+                # no roots below the layer
+                bottom_count, bottom_area = 0, 0.0
+            elif kind == 3 and frame == 1:
+                # an outlier among frames that agree
+                bottom_count, bottom_area = 60, 40000.0
+            elif kind == 3:
+                upper_count, bottom_count, upper_area, bottom_area = 8, 4, 1000.0, 500.0
+            rows.append(
+                {
+                    "image_name": f"{plant}/{frame}.png",
+                    "plant": plant,
+                    "frame": frame,
+                    "layer_ind": 300,
+                    "upper_area": upper_area,
+                    "bottom_area": bottom_area,
+                    "upper_root_count": float(upper_count),
+                    "bottom_root_count": float(bottom_count),
+                }
+            )
+    # frames listed out of plant order, as a merged table may list them
+    traits = pd.DataFrame(rows).sample(frac=1, random_state=seed)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        traits["root_area_ratio"] = traits["bottom_area"] / traits["upper_area"]
+        traits["root_count_ratio"] = (
+            traits["bottom_root_count"] / traits["upper_root_count"]
+        )
+    # plants of a treatment of their own, without master data, and a treatment
+    # whose plants all have the same ratios once their outlier frame is removed
+    trt = [float(1 + i % 3) for i in range(39)]
+    trt[38] = 0.0
+    for i in range(3, 39, 8):
+        trt[i] = 4.0
+    master_data = pd.DataFrame({"barcode": [f"P{i:02d}" for i in range(39)], "trt": trt})
+    return traits, master_data
+
+
+def run_baseline(traits, master_data, save_path):
+    remove_0 = analysis.remove_frame_outlier_0_upper(traits, True, save_path)
+    df_filtered, _ = analysis.remove_frame_outlier_0_bottom(remove_0, 0.5, save_path)
+    count, area, _ = baseline_statistics_frames(df_filtered, save_path)
+    baseline_statistics_plants(save_path, master_data, "trt")
+    return count, area
+
+
+def run_filters(traits, master_data, save_path, in_memory=False):
+    remove_0 = analysis.remove_frame_outlier_0_upper(traits, True, save_path)
+    df_filtered, _ = analysis.remove_frame_outlier_0_bottom(remove_0, 0.5, save_path)
+    count, area, frames_summary = analysis.get_statistics_frames(df_filtered, save_path)
+    # the baseline read the frame summary back from its CSV file
+    analysis.get_statistics_plants(
+        save_path, master_data, "trt", data=frames_summary if in_memory else None
+    )
+    return count, area
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_filters_match_the_baseline(tmp_path, seed):
+    traits, master_data = get_traits_table(seed)
+    os.makedirs(tmp_path / "baseline")
+    os.makedirs(tmp_path / "filters")
+    expected = run_baseline(traits, master_data, str(tmp_path / "baseline"))
+    filtered = run_filters(traits, master_data, str(tmp_path / "filters"))
+
+    # the same frames are kept, in the same order
+    for expected_df, df in zip(expected, filtered):
+        pd.testing.assert_frame_equal(df, expected_df)
+    for csv_name in CSV_NAMES:
+        pd.testing.assert_frame_equal(
+            pd.read_csv(tmp_path / "filters" / csv_name),
+            pd.read_csv(tmp_path / "baseline" / csv_name),
+            check_exact=True,
+            obj=csv_name,
+        )
+
+
+def test_plants_filtered_in_memory(tmp_path):
+    # read_csv may round the last bit of the summaries the baseline read back,
+    # run_analysis hands them over in memory
+    traits, master_data = get_traits_table(0)
+    os.makedirs(tmp_path / "csv")
+    os.makedirs(tmp_path / "memory")
+    run_filters(traits, master_data, str(tmp_path / "csv"))
+    run_filters(traits, master_data, str(tmp_path / "memory"), in_memory=True)
+    for csv_name in CSV_NAMES:
+        pd.testing.assert_frame_equal(
+            pd.read_csv(tmp_path / "memory" / csv_name),
+            pd.read_csv(tmp_path / "csv" / csv_name),
+            rtol=1e-12,
+            obj=csv_name,
+        )
+
+
+def test_filters_keep_frames_and_remove_outliers():
+    traits, master_data = get_traits_table(0)
+    count, area, _ = analysis.get_statistics_frames(
+        filtering.drop_invalid_rows(traits), None
+    )
+    # the outlier frame is removed, the other frames of its plant are kept
+    plant = traits[traits["plant"] == "exp/P03"]
+    assert "exp/P03/1.png" not in set(count["image_name"])
+    assert len(count[count["plant"] == "exp/P03"]) == len(plant) - 1
+    # plants whose frames are all equal only keep their zeros
+    assert "exp/P01" not in set(count["plant"])
+    assert "exp/P01" not in set(area["plant"])
+
+
+def test_equal_plants_are_kept_whatever_their_rounding(tmp_path):
+    # Series.std() of three 0.1 is about 1e-17, so the baseline computed
+    # z-scores of rounding noise; the grouped standard deviation is exactly 0
+    summary = pd.DataFrame(
+        {
+            "plant_path": ["exp/A", "exp/B", "exp/C"],
+            "root_count_ratio": [0.1, 0.1, 0.1],
+            "upper_root_count": [10.0, 10.0, 10.0],
+            "bottom_root_count": [1.0, 1.0, 1.0],
+            "frame_number_count": [3, 3, 3],
+            "root_area_ratio": [0.7, 0.7, 0.7],
+            "upper_area": [100.0, 100.0, 100.0],
+            "bottom_area": [70.0, 70.0, 70.0],
+            "frame_number_area": [3, 3, 3],
+        }
+    )
+    master_data = pd.DataFrame({"barcode": ["A", "B", "C"], "trt": [1.0, 1.0, 1.0]})
+    count, area, _ = analysis.get_statistics_plants(
+        None, master_data, "trt", data=summary
+    )
+    assert count["plant_number_count"].tolist() == [3]
+    assert area["plant_number_area"].tolist() == [3]
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import torch
+
+smp = pytest.importorskip("segmentation_models_pytorch")
+
+import precision
+import segment
+
+
+@pytest.fixture
+def model_name(tmp_path, monkeypatch):
+    # the checkpoints are whole pickled modules, as segment.py saves them
+    monkeypatch.setenv("TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD", "1")
+    torch.manual_seed(0)
+    model = smp.Unet(encoder_name="resnet18", encoder_weights=None, classes=3)
+    model.eval()
+    torch.save(model, tmp_path / "model.pth")
+    return str(tmp_path / "model")
+
+
+@pytest.mark.parametrize("inference_precision", ["fp32", "bf16"])
+@pytest.mark.parametrize("channels_last", [False, True])
+def test_traced_model_gives_the_eager_masks(
+    model_name, inference_precision, channels_last
+):
+    device = torch.device("cpu")
+    eager = segment.load_model(model_name, device)
+    segment.load_model(model_name, device, scripted=True)
+    traced = segment.load_model(model_name, device, scripted=True)
+    assert isinstance(traced, torch.jit.ScriptModule)
+
+    # the model is traced on 64x64, the crops are larger and not square
+    x = torch.from_numpy(np.random.default_rng(0).random((2, 3, 96, 160), "float32"))
+    with torch.inference_mode():
+        logits = [
+            precision.get_inference_model(
+                m, device, precision=inference_precision, channels_last=channels_last
+            )(x)
+            for m in (eager, traced)
+        ]
+    assert logits[0].shape == logits[1].shape == (2, 3, 96, 160)
+    assert logits[1].dtype == torch.float32
+    np.testing.assert_allclose(logits[1].numpy(), logits[0].numpy(), atol=1e-4)
+    assert torch.equal(logits[0].argmax(1), logits[1].argmax(1))
+
+
+def test_bf16_autocast_applies_to_the_traced_model(model_name):
+    device = torch.device("cpu")
+    segment.load_model(model_name, device, scripted=True)
+    traced = segment.load_model(model_name, device, scripted=True)
+    x = torch.from_numpy(np.random.default_rng(1).random((1, 3, 96, 160), "float32"))
+    with torch.inference_mode():
+        fp32, bf16 = [
+            precision.get_inference_model(traced, device, precision=p)(x)
+            for p in ("fp32", "bf16")
+        ]
+    # bf16 rounds the activations, so its logits differ from fp32 ones
+    assert not torch.equal(fp32, bf16)
+    np.testing.assert_allclose(bf16.numpy(), fp32.numpy(), atol=0.5)
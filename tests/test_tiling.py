@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("albumentations")
+
+import tiling
+
+
+# predict_tiled_batch before the logits were blended in row bands, with a
+# full-frame sum of the logits of each image
+
+
+def baseline_predict_tiled_batch(
+    model, images, device, tile_size, overlap, tile_batch_size
+):
+    tiles = [
+        (i, y, x)
+        for i, image in enumerate(images)
+        for y in tiling.get_tile_starts(image.shape[1], tile_size, overlap)
+        for x in tiling.get_tile_starts(image.shape[2], tile_size, overlap)
+    ]
+    remaining = np.bincount([i for i, _, _ in tiles], minlength=len(images))
+    weight = tiling.get_tile_weight(tile_size, overlap).to(device)
+
+    logits_sum = {}
+    pred_masks = [None] * len(images)
+    for k in range(0, len(tiles), tile_batch_size):
+        chunk = tiles[k : k + tile_batch_size]
+        x_tensor = torch.from_numpy(
+            np.stack(
+                [
+                    images[i][:, y : y + tile_size, x : x + tile_size]
+                    for i, y, x in chunk
+                ]
+            )
+        ).to(device)
+        logits = model(x_tensor) * weight
+        for (i, y, x), tile_logits in zip(chunk, logits):
+            if i not in logits_sum:
+                logits_sum[i] = torch.zeros(
+                    (tile_logits.shape[0],) + images[i].shape[1:], device=device
+                )
+            logits_sum[i][:, y : y + tile_size, x : x + tile_size] += tile_logits
+            remaining[i] -= 1
+            if remaining[i] == 0:
+                pred_masks[i] = logits_sum.pop(i).argmax(dim=0).cpu().numpy()
+    return pred_masks
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return torch.nn.Sequential(
+        torch.nn.Conv2d(3, 8, 5, padding=2),
+        torch.nn.ReLU(),
+        torch.nn.Conv2d(8, 3, 3, padding=1),
+    ).eval()
+
+
+@pytest.mark.parametrize("overlap", [0, 16, 32])
+@pytest.mark.parametrize("tile_batch_size", [1, 3, 7])
+def test_row_bands_give_the_full_frame_masks(model, overlap, tile_batch_size):
+    rng = np.random.default_rng(0)
+    # one tile, a single tile row or column, and rows of uneven height
+    shapes = [(64, 64), (100, 64), (64, 150), (203, 177), (256, 96)]
+    images = [rng.standard_normal((3, h, w)).astype(np.float32) for h, w in shapes]
+    timings = {}
+    with torch.no_grad():
+        expected = baseline_predict_tiled_batch(
+            model, images, "cpu", 64, overlap, tile_batch_size
+        )
+        masks = tiling.predict_tiled_batch(
+            model, images, "cpu", 64, overlap, tile_batch_size, timings
+        )
+    assert set(timings) == {"forward", "argmax"}
+    for mask, expected_mask in zip(masks, expected):
+        assert mask.dtype == expected_mask.dtype
+        np.testing.assert_array_equal(mask, expected_mask)
@@ -0,0 +1,127 @@
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+import analysis
+
+# the ratios of get_frame_traits divide by zero counts
+pytestmark = pytest.mark.filterwarnings("ignore::RuntimeWarning")
+
+HEIGHT, WIDTH = 320, 90
+
+
+def get_baseline_traits(stack, layer_inds):
+    return pd.DataFrame(
+        [
+            analysis.get_frame_traits(seg_image, int(layer_ind))
+            for seg_image, layer_ind in zip(stack, layer_inds)
+        ],
+        dtype=float,
+    )
+
+
+def assert_same_traits(stack, layer_inds):
+    expected = get_baseline_traits(stack, layer_inds)
+    traits = analysis.get_stack_traits(stack, layer_inds)
+    pd.testing.assert_frame_equal(traits[expected.columns], expected)
+
+
+def get_random_mask(rng):
+    mask = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    for _ in range(rng.integers(0, 12)):
+        x, y = rng.integers(0, WIDTH), rng.integers(0, HEIGHT)
+        if rng.random() < 0.5:
+            # a root running down the frame
+            end = (int(rng.integers(0, WIDTH)), HEIGHT)
+            cv2.line(mask, (int(x), int(y)), end, 255, int(rng.integers(1, 4)))
+        else:
+            cv2.circle(mask, (int(x), int(y)), int(rng.integers(1, 15)), 255, -1)
+    return mask
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_masks(seed):
+    rng = np.random.default_rng(seed)
+    stack = np.stack([get_random_mask(rng) for _ in range(40)])
+    layer_inds = rng.integers(0, HEIGHT + 60, len(stack))
+    assert_same_traits(stack, layer_inds)
+
+
+def test_noise_masks():
+    # many small components, holes and components touching each other diagonally
+    rng = np.random.default_rng(5)
+    density = rng.random((30, 1, 1))
+    stack = (rng.random((30, HEIGHT, WIDTH)) < density).astype(np.uint8) * 255
+    assert_same_traits(stack, rng.integers(0, HEIGHT, len(stack)))
+
+
+@pytest.mark.parametrize(
+    "layer_ind", [0, 3, 40, 54, 55, 56, 120, 220, 260, 264, 265, 266, 300, 315, 320, 400]
+)
+def test_boundaries_near_the_edges(layer_ind):
+    rng = np.random.default_rng(layer_ind)
+    stack = np.stack(
+        [
+            np.zeros((HEIGHT, WIDTH), np.uint8),
+            np.full((HEIGHT, WIDTH), 255, np.uint8),
+            get_random_mask(rng),
+        ]
+    )
+    assert_same_traits(stack, [layer_ind] * len(stack))
+
+
+def test_empty_and_full_masks():
+    empty = np.zeros((HEIGHT, WIDTH), np.uint8)
+    # every pixel a root: np.unique finds one value, so the areas are 0
+    full = np.full((HEIGHT, WIDTH), 255, np.uint8)
+    # with the boundary at 260, the upper band is rows 205 to 210 and the
+    # bottom band rows 310 to 315, which is also the whole bottom layer
+    full_bands = empty.copy()
+    full_bands[180:210] = 255
+    full_bands[310:315] = 255
+    stack = np.stack([empty, full, full_bands])
+    assert_same_traits(stack, [260] * len(stack))
+    traits = analysis.get_stack_traits(stack, [260] * len(stack))
+    assert traits["upper_area"].tolist() == [0, 0, 30 * WIDTH]
+    assert traits["bottom_area"].tolist() == [0, 0, 0]
+
+
+def test_rings_with_roots_inside():
+    mask = np.zeros((HEIGHT, WIDTH), np.uint8)
+    # with the boundary at 150, the bands are rows 95 to 100 and 200 to 205
+    for top in [95, 200]:
+        # a closed ring, with a root in its hole and one touching it from outside
+        cv2.rectangle(mask, (5, top), (30, top + 4), 255, 1)
+        mask[top + 2, 15] = 255
+        mask[top + 2, 31:34] = 255
+        # a ring with diagonal corners is closed for 8-connected roots, but
+        # its hole touches the background outside diagonally
+        corners = [
+            [42, top],
+            [58, top],
+            [60, top + 2],
+            [58, top + 4],
+            [42, top + 4],
+            [40, top + 2],
+        ]
+        cv2.polylines(mask, [np.array(corners)], True, 255, 1, cv2.LINE_8)
+        mask[top + 2, 50] = 255
+        # roots cut by the edges of the band
+        mask[top - 3 : top + 1, 70] = 255
+        mask[top + 4 : top + 8, 80] = 255
+    stack = np.stack([mask, mask[:, ::-1], np.roll(mask, 1, axis=0)])
+    assert_same_traits(stack, [150, 150, 150])
+    traits = analysis.get_stack_traits(stack, [150, 150, 150])
+    # the ring with the root touching it, the other ring and the two cut roots
+    assert traits["upper_root_count"][0] == 4
+
+
+def test_colour_coded_masks():
+    rng = np.random.default_rng(7)
+    gray = np.stack([get_random_mask(rng) for _ in range(5)])
+    stack = np.repeat(gray[..., None], 3, axis=3)
+    layer_inds = rng.integers(100, 250, len(stack))
+    expected = get_baseline_traits(stack, layer_inds)
+    traits = analysis.get_stack_traits(stack, layer_inds)
+    pd.testing.assert_frame_equal(traits[expected.columns], expected)